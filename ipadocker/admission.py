@@ -0,0 +1,158 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Admission control of resource-heavy steps across simultaneous runner
+invocations
+
+Every resource class (e.g. builds or server installs) has a configurable
+number of slots per Docker host. A slot is a lock file in a directory shared
+by all runner processes, held by `flock` for the duration of the step. A step
+which does not get a slot waits until one is freed, so that excess runs queue
+up instead of overcommitting the host. The locks are released by the kernel
+when the process holding them dies
+"""
+
+import fcntl
+import logging
+import os
+import re
+import time
+
+from ipadocker import constants
+
+logger = logging.getLogger(__name__)
+
+# resource classes of the steps that are subject to admission control
+STEP_RESOURCE_CLASSES = {
+    'lint': 'build',
+    'build': 'build',
+    'tox': 'build',
+    'webui_unit': 'build',
+    # rebuilds and upgrades the installed server, bounded by the build
+    'bisect_update': 'build',
+    'install_server': 'server_install',
+}
+
+# bounds of the interval between attempts to get a slot, in seconds
+POLL_INTERVAL_MIN = 0.1
+POLL_INTERVAL_MAX = 5.0
+
+
+def _sanitize(name):
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_')
+
+
+class Slot:
+    """
+    A slot held by this process
+
+    :param resource_class: resource class the slot belongs to
+    :param path: path to the lock file
+    :param fd: file descriptor of the locked file
+    """
+    def __init__(self, resource_class, path, fd):
+        self.resource_class = resource_class
+        self.path = path
+        self.fd = fd
+
+    def release(self):
+        if self.fd is None:
+            return
+
+        os.close(self.fd)
+        self.fd = None
+
+
+class AdmissionControl:
+    """
+    Grants slots of resource classes to the steps
+
+    :param slots: mapping of resource class names to the number of slots. 0
+        means that the class is not limited
+    :param lock_dir: directory holding the lock files. Defaults to the cache
+        directory
+    """
+    def __init__(self, slots, lock_dir=None):
+        self.slots = slots
+        self.lock_dir = lock_dir or os.path.join(
+            constants.CACHE_DIR, 'slots')
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Create admission control from the 'admission' section of the config
+        """
+        admission_config = config['admission']
+        slots = {
+            key: value for key, value in admission_config.items()
+            if key != 'lock_dir'
+        }
+        return cls(slots, lock_dir=admission_config['lock_dir'])
+
+    def _slot_paths(self, resource_class, host):
+        slot_dir = os.path.join(
+            self.lock_dir, _sanitize(host), resource_class)
+        os.makedirs(slot_dir, exist_ok=True)
+
+        return [
+            os.path.join(slot_dir, 'slot-{}.lock'.format(i))
+            for i in range(self.slots[resource_class])
+        ]
+
+    def try_acquire(self, resource_class, host=constants.DEFAULT_DOCKER_URL):
+        """
+        Try to take a free slot without waiting
+
+        :returns: Slot instance or None if all slots are taken
+        """
+        for path in self._slot_paths(resource_class, host):
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+
+            # leave a note for humans inspecting the slots
+            os.ftruncate(fd, 0)
+            os.write(fd, '{}\n'.format(os.getpid()).encode())
+            return Slot(resource_class, path, fd)
+
+        return None
+
+    async def acquire(self, step_name, host=constants.DEFAULT_DOCKER_URL):
+        """
+        Wait for a free slot of the step's resource class on the host
+
+        :param step_name: name of the step
+        :param host: base URL of the Docker host running the step
+        :returns: Slot instance or None if the step is not limited
+        """
+        import asyncio
+
+        resource_class = STEP_RESOURCE_CLASSES.get(step_name)
+        if not self.slots.get(resource_class):
+            return None
+
+        interval = POLL_INTERVAL_MIN
+        start = time.time()
+        while True:
+            slot = self.try_acquire(resource_class, host)
+            if slot is not None:
+                break
+
+            if interval == POLL_INTERVAL_MIN:
+                logger.info(
+                    "All %d '%s' slots on %s are taken, waiting",
+                    self.slots[resource_class], resource_class, host)
+
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, POLL_INTERVAL_MAX)
+
+        waited = time.time() - start
+        if waited >= POLL_INTERVAL_MIN:
+            logger.info(
+                "Got '%s' slot after %.1f seconds", resource_class, waited)
+
+        return slot
@@ -0,0 +1,253 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Asyncio support for the Docker API
+
+docker-py is a blocking library, so the API calls are dispatched to a single
+bounded pool of worker threads shared by all containers. Streamed output is
+consumed chunk by chunk by a daemon thread per stream, since the streams are
+open as long as their commands run and would take up the pool. A runner
+process can thus drive many containers from one event loop without buffering
+whole command outputs
+"""
+
+import collections
+import functools
+import threading
+
+# asyncio and concurrent.futures are imported on first use, they take longer
+# to import than the rest of the CLI
+
+# upper bound of threads blocked in Docker API calls at any given time
+MAX_WORKERS = 32
+
+# maximum number of streamed items buffered between a worker and event loop
+STREAM_BUFFER = 256
+
+_executor = None
+_executor_lock = threading.Lock()
+_local = threading.local()
+
+_END_OF_STREAM = object()
+
+
+def get_executor():
+    """
+    Return the thread pool executing the blocking Docker API calls
+    """
+    import concurrent.futures
+
+    global _executor
+
+    with _executor_lock:
+        if _executor is None:
+            _executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=MAX_WORKERS)
+
+    return _executor
+
+
+def run_blocking(func, *args, **kwargs):
+    """
+    Run blocking function in the shared executor
+
+    :returns: awaitable future of the function result
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(
+        get_executor(), functools.partial(func, *args, **kwargs))
+
+
+def run_in_thread(func, *args, **kwargs):
+    """
+    Run blocking function which may take as long as the container lives
+    (e.g. waiting for it to stop) in its own daemon thread, so that it does
+    not hold a worker of the shared executor. Cancelling the returned future
+    does not interrupt the function, its result is discarded
+
+    :returns: awaitable future of the function result
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    future = loop.create_future()
+
+    def set_result(result, error):
+        if future.done():
+            return
+
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def target():
+        result, error = None, None
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            error = e
+
+        try:
+            loop.call_soon_threadsafe(set_result, result, error)
+        except RuntimeError:
+            # the event loop is closed
+            pass
+
+    threading.Thread(target=target, daemon=True).start()
+    return future
+
+
+async def consume(iterable, callback):
+    """
+    Consume a blocking iterable (e.g. streamed exec output) without blocking
+    the event loop. The iterable is drained by its own thread (see
+    `run_in_thread`) which hands the items over to the event loop in batches.
+    At most `STREAM_BUFFER` items are held in memory, the thread waits for
+    the event loop when it falls behind
+
+    :param iterable: iterable whose items are retrieved in the thread
+    :param callback: function called in the event loop for every item
+    """
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    items = collections.deque()
+    slots = threading.Semaphore(STREAM_BUFFER)
+    stopped = threading.Event()
+    finished = loop.create_future()
+
+    def drain():
+        while items and not finished.done():
+            item = items.popleft()
+            slots.release()
+
+            if item is _END_OF_STREAM:
+                finished.set_result(None)
+                return
+
+            try:
+                callback(item)
+            except Exception as e:
+                stopped.set()
+                finished.set_exception(e)
+
+    def put(item):
+        slots.acquire()
+        items.append(item)
+        if len(items) == 1:
+            loop.call_soon_threadsafe(drain)
+
+    def pump():
+        for item in iterable:
+            if stopped.is_set():
+                return
+            put(item)
+
+        put(_END_OF_STREAM)
+
+    def pump_done(pump_future):
+        if not pump_future.cancelled() and pump_future.exception():
+            if not finished.done():
+                finished.set_exception(pump_future.exception())
+
+    run_in_thread(pump).add_done_callback(pump_done)
+
+    try:
+        await finished
+    finally:
+        if (not finished.done() or finished.cancelled() or
+                finished.exception() is not None):
+            # unblock the thread if it waits for a free slot
+            stopped.set()
+            slots.release()
+
+
+async def gather_all(*aws):
+    """
+    Run the awaitables concurrently. When one of them fails, the others are
+    cancelled and waited for before the error is raised, so that they can
+    clean up (e.g. remove the container they created)
+
+    :returns: list of the results in the order of the awaitables
+    """
+    import asyncio
+
+    futures = [asyncio.ensure_future(aw) for aw in aws]
+    try:
+        done, pending = await asyncio.wait(
+            futures, return_when=asyncio.FIRST_EXCEPTION)
+    except asyncio.CancelledError:
+        for future in futures:
+            future.cancel()
+        await asyncio.wait(futures)
+        raise
+
+    for future in pending:
+        future.cancel()
+    if pending:
+        await asyncio.wait(pending)
+
+    for future in futures:
+        if future in done and future.exception() is not None:
+            raise future.exception()
+
+    return [future.result() for future in futures]
+
+
+def run(coro):
+    """
+    Run the coroutine to completion from synchronous code. Every thread uses
+    its own event loop which is kept for subsequent calls
+
+    :param coro: coroutine object
+    :returns: the result of the coroutine
+    """
+    import asyncio
+
+    loop = getattr(_local, 'loop', None)
+    if loop is None or loop.is_closed():
+        loop = _local.loop = asyncio.new_event_loop()
+
+    asyncio.set_event_loop(loop)
+    return loop.run_until_complete(coro)
+
+
+class AsyncDockerClient:
+    """
+    Asynchronous facade of the Docker client. All methods of the wrapped
+    client are available as coroutines running the blocking calls in the
+    shared executor
+
+    :param docker_client: Docker Client API instance
+    """
+    def __init__(self, docker_client):
+        self.docker_client = docker_client
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        attr = getattr(self.docker_client, name)
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            return run_blocking(attr, *args, **kwargs)
+
+        return call
+
+
+def async_client(docker_client):
+    """
+    Wrap the Docker client into `AsyncDockerClient` unless it is already
+    wrapped
+    """
+    if isinstance(docker_client, AsyncDockerClient):
+        return docker_client
+
+    return AsyncDockerClient(docker_client)
@@ -0,0 +1,184 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Checkpoints of the container after the successful steps
+
+When checkpoints are enabled, the container is committed to an image after
+each of the expensive steps listed in the 'checkpoints' config section. The
+completed steps are recorded in the cache directory along with the hash of
+the sources (see `ipadocker.snapshot.source_hash`). A resumed run with the
+same sources and the same base image starts from the image of the last
+checkpoint and skips the steps completed before it, so that e.g. a typo in
+the test path does not cost a rebuild and reinstall of the server.
+
+There is one checkpoint per base image, every new run with checkpoints
+replaces the images and the record of the previous one.
+"""
+
+import json
+import logging
+import os
+
+# hashlib is imported on first use in order to keep the startup of the CLI
+# fast
+
+from ipadocker import constants, statefile
+
+logger = logging.getLogger(__name__)
+
+
+def default_checkpoint_dir():
+    return os.path.join(constants.CACHE_DIR, 'checkpoints')
+
+
+class Checkpoint:
+    """
+    Record of the steps completed by the run and of the checkpoint images
+    of the container
+
+    :param config: IPADockerConfig instance of the run
+    :param source_digest: hash of the sources the run tests
+    :param plan_steps: list of (step name, ExecutionStep) tuples the action
+        executes (see `ipadocker.command.ExecutionPlan`)
+    :param directory: directory holding the records (default: `checkpoints`
+        in the cache directory)
+    """
+    def __init__(self, config, source_digest, plan_steps, directory=None):
+        import hashlib
+
+        self.repository = config['images']['repository']
+        self.base_image = config['container']['image']
+        self.checkpoint_steps = set(config['checkpoints']['steps'])
+        self.source_hash = source_digest
+        self.plan = [(name, step.commands) for name, step in plan_steps]
+
+        self.key = hashlib.sha256(self.base_image.encode()).hexdigest()[:12]
+        self.filename = os.path.join(
+            directory or default_checkpoint_dir(), '{}.json'.format(self.key))
+
+        # URL of the Docker host holding the checkpoint images
+        self.base_url = None
+        self.steps = []
+        # steps completed before the checkpoint the run was resumed from
+        self.pending = []
+
+    def tag(self, step_name):
+        """
+        Return the repository and the tag of the checkpoint image of the step
+        """
+        return self.repository, 'checkpoint-{}-{}'.format(self.key, step_name)
+
+    def wants(self, step_name):
+        """
+        Whether the container is committed after the step
+        """
+        return step_name in self.checkpoint_steps
+
+    def _commands(self, step_name):
+        return dict(self.plan).get(step_name)
+
+    def load(self):
+        """
+        Load the record of the previous run
+
+        :returns: the record or None if there is none
+        """
+        try:
+            with open(self.filename, 'r') as record_file:
+                return json.load(record_file)
+        except (OSError, ValueError) as e:
+            logger.debug("Cannot load checkpoint: %s", e)
+            return None
+
+    def resume(self):
+        """
+        Find the last checkpoint of the previous run which the run can
+        continue from. The previous run must have tested the same sources with
+        the same base image and executed the same commands as this run up to
+        the checkpoint
+
+        :returns: the checkpoint image or None if there is none
+        """
+        record = self.load()
+        if record is None:
+            return None
+
+        if (record.get('source_hash') != self.source_hash or
+                record.get('base_image') != self.base_image):
+            logger.info("Sources or image changed since the last checkpoint")
+            return None
+
+        completed = 0
+        image = None
+        for index, (recorded, planned) in enumerate(
+                zip(record.get('steps', []), self.plan)):
+            if (recorded['name'], recorded['commands']) != (
+                    planned[0], list(planned[1])):
+                break
+
+            if recorded.get('image') is not None:
+                completed = index + 1
+                image = recorded['image']
+
+        if image is None:
+            return None
+
+        self.base_url = record.get('base_url')
+        self.steps = record['steps'][:completed]
+        self.pending = [step['name'] for step in self.steps]
+
+        logger.info(
+            "Resuming from checkpoint %s after step %s", image,
+            self.pending[-1])
+        return image
+
+    def skip(self, step_name):
+        """
+        Whether the step was completed before the checkpoint the run resumed
+        from. The steps must be queried in the order of execution
+        """
+        if self.pending and self.pending[0] == step_name:
+            self.pending.pop(0)
+            return True
+
+        self.pending = []
+        return False
+
+    def record_step(self, step_name, image=None, base_url=None):
+        """
+        Record the completed step and save the record
+
+        :param step_name: name of the step
+        :param image: checkpoint image committed after the step, if any
+        :param base_url: URL of the Docker host holding the image
+        """
+        commands = self._commands(step_name)
+        if commands is None:
+            return
+
+        if image is not None:
+            self.base_url = base_url
+
+        self.steps.append({
+            'name': step_name,
+            'commands': list(commands),
+            'image': image
+        })
+        self.save()
+
+    def to_dict(self):
+        return {
+            'source_hash': self.source_hash,
+            'base_image': self.base_image,
+            'base_url': self.base_url,
+            'steps': self.steps
+        }
+
+    def save(self):
+        try:
+            with statefile.locked(self.filename):
+                statefile.write_atomic(
+                    self.filename, json.dumps(self.to_dict(), indent=2))
+        except OSError as e:
+            logger.warning("Cannot save checkpoint: %s", e)
@@ -6,18 +6,30 @@ CLI facing part
 """
 
 import argparse
+import functools
+import inspect
 import logging
 import os
 import sys
+import time
 
-import docker
-
-from ipadocker import command, config, constants, container
+from ipadocker import (
+    admission, aio, checkpoint, command, config, constants, container,
+    events, gitbisect, images, latency, metrics, profiling, recording,
+    report, scheduler, snapshot)
 
 
 DEFAULT_MAKE_TARGET = 'rpms'
 DEFAULT_DEVEL_MODE = False
 DEFAULT_BUILD_OPTS = ['-D "with_lint 1"']
+DEFAULT_MATRIX_PARALLEL = 4
+DEFAULT_QUEUE_PARALLEL = 2
+DEFAULT_PROFILE_DIR = 'ipa-profile'
+
+# steps preparing the container which the following runs in the same warm
+# container do not repeat (see `ipadocker.service`)
+REUSABLE_STEPS = ('sync_sources', 'builddep', 'configure', 'build',
+                  'install_packages', 'install_server', 'prepare_tests')
 
 logger = logging.getLogger(__name__)
 
@@ -127,6 +139,83 @@ def make_parser():
         default=False,
         help="Do not stop and remove container at the end"
     )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        default=False,
+        help="Validate and print the execution plan along with expected "
+             "durations and exit"
+    )
+    parser.add_argument(
+        '--report',
+        default=None,
+        metavar="FILENAME",
+        help="Write JSON report of the run into a file"
+    )
+    parser.add_argument(
+        '--record',
+        default=None,
+        metavar="FILENAME",
+        help="Record the Docker API session into a file"
+    )
+    parser.add_argument(
+        '--replay',
+        default=None,
+        metavar="FILENAME",
+        help="Replay recorded Docker API session instead of talking to "
+             "Docker daemon"
+    )
+    parser.add_argument(
+        '--replay-speed',
+        default=1.0,
+        type=float,
+        metavar="FACTOR",
+        help="Speed of the replay relative to the recording (0 means "
+             "no delays)"
+    )
+    parser.add_argument(
+        '--events',
+        default=None,
+        metavar="FILENAME",
+        help="Write newline-delimited JSON events of the run into a file "
+             "(use /dev/fd/N for an inherited file descriptor)"
+    )
+    parser.add_argument(
+        '--events-output',
+        action='store_true',
+        default=False,
+        help="Include every chunk of command output with its text in the "
+             "events, not only byte counts"
+    )
+    parser.add_argument(
+        '--checkpoint',
+        action='store_true',
+        default=False,
+        help="Commit the container to an image after each expensive step so "
+             "that a failed run can be resumed"
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        default=False,
+        help="Continue from the last checkpoint of the previous run with the "
+             "same sources and image (implies '--checkpoint')"
+    )
+    parser.add_argument(
+        '--matrix',
+        action='append',
+        default=[],
+        metavar='IMAGE[,IMAGE...]',
+        help="Run the action with each of the images (or image variants, "
+             "see 'build-image') concurrently"
+    )
+    parser.add_argument(
+        '--matrix-parallel',
+        default=DEFAULT_MATRIX_PARALLEL,
+        type=int,
+        metavar='N',
+        help="Maximum number of concurrent runs in the matrix mode"
+    )
     parser.add_argument(
         '--git-repo',
         dest='cli_overrides',
@@ -191,6 +280,117 @@ def make_parser():
         metavar='PATH',
         help="list of paths to execute"
     )
+    run_test_cmd.add_argument(
+        '--profile',
+        action='store_true',
+        default=False,
+        help="profile the test modules and export pstats, flamegraph stacks "
+             "and test durations to the host"
+    )
+    run_test_cmd.add_argument(
+        '--profile-dir',
+        default=DEFAULT_PROFILE_DIR,
+        metavar='DIR',
+        help="directory to export the profiling results into (default: "
+             "%(default)s)"
+    )
+    run_test_cmd.add_argument(
+        '--server-latency',
+        action='store_true',
+        default=False,
+        help="report the slowest IPA commands and LDAP operations of the "
+             "tests from the server logs"
+    )
+
+    unit_tests_cmd = subcommands.add_parser(
+        'unit-tests',
+        help="run tests which do not need a server in-tree, without building "
+             "and installing the packages"
+    )
+    unit_tests_cmd.add_argument(
+        'path',
+        nargs="*",
+        metavar='PATH',
+        help="list of paths to execute (all server-independent tests by "
+             "default)"
+    )
+
+    bisect_cmd = subcommands.add_parser(
+        'bisect',
+        help="find the first commit on which the tests fail or get slow"
+    )
+    bisect_cmd.add_argument(
+        'good',
+        metavar='GOOD',
+        help="commit on which the tests pass"
+    )
+    bisect_cmd.add_argument(
+        'bad',
+        metavar='BAD',
+        help="commit on which the tests fail or get slow"
+    )
+    bisect_cmd.add_argument(
+        'path',
+        nargs="*",
+        metavar='PATH',
+        help="list of paths to execute"
+    )
+    bisect_cmd.add_argument(
+        '--max-duration',
+        default=0.0,
+        type=float,
+        metavar='SECONDS',
+        help="consider the commit bad also when the tests take longer"
+    )
+
+    serve_cmd = subcommands.add_parser(
+        'serve',
+        help="run the queue service executing the submitted jobs"
+    )
+    serve_cmd.add_argument(
+        '--socket',
+        default=None,
+        metavar='PATH',
+        help="Unix socket to listen on (default: queue.sock in the cache "
+             "directory)"
+    )
+    serve_cmd.add_argument(
+        '--parallel',
+        default=DEFAULT_QUEUE_PARALLEL,
+        type=int,
+        metavar='N',
+        help="maximum number of batches of jobs running at once"
+    )
+    serve_cmd.add_argument(
+        '--metrics-address',
+        default=None,
+        metavar='[HOST:]PORT',
+        help="serve OpenMetrics of the jobs over HTTP at /metrics (host "
+             "defaults to 127.0.0.1)"
+    )
+
+    submit_cmd = subcommands.add_parser(
+        'submit',
+        help="submit a job to the queue service and print its output"
+    )
+    submit_cmd.add_argument(
+        '--socket',
+        default=None,
+        metavar='PATH',
+        help="Unix socket of the service (default: queue.sock in the cache "
+             "directory)"
+    )
+    submit_cmd.add_argument(
+        '--commit',
+        default='HEAD',
+        help="commit to test (default: HEAD of the git repo of the service)"
+    )
+    submit_cmd.add_argument(
+        'job',
+        nargs=argparse.REMAINDER,
+        metavar='-- ARGUMENTS',
+        help="command line of the job, e.g. '-- run-tests test_xmlrpc'"
+    )
 
     subcommands.add_parser(
         'sample-config',
@@ -210,24 +410,176 @@ def make_parser():
         'webui-unit',
         help="run webui unit tests in the container."
     )
+
+    build_image_cmd = subcommands.add_parser(
+        'build-image',
+        help="build test runner images on the Docker hosts"
+    )
+    build_image_cmd.add_argument(
+        'variants',
+        nargs='*',
+        metavar='VARIANT',
+        help="image variants from the Dockerfile directory to build "
+             "(all of them by default unless '--builddep' is specified)"
+    )
+    build_image_cmd.add_argument(
+        '--builddep',
+        action='store_true',
+        default=False,
+        help="build image with the build dependencies of the current spec "
+             "file on top of the configured container image"
+    )
+    build_image_cmd.add_argument(
+        '-b',
+        '--builddep-opts',
+        default=DEFAULT_BUILD_OPTS,
+        action='append',
+        help="options to pass to 'dnf builddep'"
+    )
+    build_image_cmd.add_argument(
+        '--pull',
+        action='store_true',
+        default=False,
+        help="pull the newest versions of the base images"
+    )
+    build_image_cmd.add_argument(
+        '--no-cache',
+        action='store_true',
+        default=False,
+        help="do not use the layer cache"
+    )
     return parser
 
 
-def run_step(docker_container, step_name, **kwargs):
+async def run_step(docker_container, step_name, **kwargs):
 
-    step_cfg = docker_container.config['steps']
-    flat_cfg = docker_container.config.flatten()
+    resolved_cfg = docker_container.config.resolve()
+    kwargs.setdefault('jobs', docker_container.jobs)
+    kwargs.setdefault(
+        'source_dir', container.source_dir(docker_container.config))
 
     try:
         step = command.ExecutionStep(
-            step_cfg[step_name],
-            flat_cfg,
+            resolved_cfg.templates[step_name],
+            resolved_cfg.flat,
             **kwargs
         )
-        step(docker_container)
     except KeyError as e:
         raise RuntimeError('Invalid template variable: {}'.format(e))
 
+    if isinstance(docker_container, command.ExecutionPlan):
+        docker_container.add_step(step_name, step)
+        return
+
+    run_checkpoint = getattr(docker_container, 'checkpoint', None)
+    if run_checkpoint is not None and run_checkpoint.skip(step_name):
+        logger.info("Skipping step %s completed before the checkpoint",
+                    step_name)
+        events.emit('cache_hit', step=step_name, cache='checkpoint',
+                    container_id=docker_container.container_id)
+        docker_container.report.add_step(step_name, 0.0, resumed=True)
+        return
+
+    completed_steps = getattr(docker_container, 'completed_steps', None)
+    if (completed_steps is not None and
+            completed_steps.get(step_name) == step.commands):
+        logger.info("Step %s was already done in the container", step_name)
+        events.emit('cache_hit', step=step_name, cache='container',
+                    container_id=docker_container.container_id)
+        docker_container.report.add_step(step_name, 0.0, reused=True)
+        return
+
+    host = getattr(docker_container, 'host', None)
+    admission_control = admission.AdmissionControl.from_config(
+        docker_container.config)
+
+    queued_since = time.time()
+    slot = await admission_control.acquire(
+        step_name,
+        host=host.base_url if host is not None else
+        constants.DEFAULT_DOCKER_URL)
+
+    execution = docker_container.config['execution']
+
+    start = time.time()
+    details = {'queued': start - queued_since}
+    events.emit('step_start', step=step_name,
+                container_id=docker_container.container_id,
+                commands=len(step.commands), queued=details['queued'])
+    retry_policy = command.RetryPolicy.from_config(
+        execution['retries'][step_name])
+    success = False
+    end = None
+    try:
+        await step.run(
+            docker_container,
+            command_timeout=execution['command_timeout'],
+            step_timeout=execution['step_timeouts'].get(step_name, 0),
+            kill_grace_period=execution['kill_grace_period'],
+            retry_policy=retry_policy)
+        end = time.time()
+        success = True
+
+        if completed_steps is not None and step_name in REUSABLE_STEPS:
+            completed_steps[step_name] = step.commands
+
+        if run_checkpoint is not None:
+            commit_time = await checkpoint_step(docker_container, step_name)
+            if commit_time is not None:
+                details['checkpoint'] = commit_time
+    except command.ContainerExecTimeout as e:
+        details['timeout'] = e.timeout
+        raise
+    except command.ContainerDied as e:
+        details['container_died'] = e.exit_code
+        details['oom_killed'] = e.oom_killed
+        raise
+    finally:
+        if slot is not None:
+            slot.release()
+
+        if retry_policy.retries:
+            details['retries'] = retry_policy.retries
+
+        duration = (end or time.time()) - start
+        docker_container.report.add_step(
+            step_name, duration, success=success, **details)
+        events.emit('step_end', step=step_name,
+                    container_id=docker_container.container_id,
+                    success=success, duration=duration, **details)
+
+
+async def checkpoint_step(docker_container, step_name):
+    """
+    Record the completed step in the checkpoint of the run and commit the
+    container to the checkpoint image if the step is configured for it
+
+    :returns: time the commit took in seconds or None if not committed
+    """
+    run_checkpoint = docker_container.checkpoint
+    host = getattr(docker_container, 'host', None)
+
+    if not run_checkpoint.wants(step_name):
+        run_checkpoint.record_step(step_name)
+        return None
+
+    start = time.time()
+    try:
+        image = await docker_container.commit_async(
+            *run_checkpoint.tag(step_name))
+    except Exception as e:
+        logger.warning("Cannot checkpoint step %s: %s", step_name, e)
+        run_checkpoint.record_step(step_name)
+        return None
+
+    logger.info("Checkpoint %s created", image)
+    run_checkpoint.record_step(
+        step_name, image,
+        base_url=host.base_url if host is not None else
+        constants.DEFAULT_DOCKER_URL)
+
+    return time.time() - start
+
 
 def prerequisite(*prerequisites):
     """
@@ -237,9 +589,22 @@ def prerequisite(*prerequisites):
     parameters (see `tests.test_cli` module for an illustration of how this
     works)
 
+    If the decorated function is a coroutine function, the prerequisites must
+    be coroutine functions as well and are awaited in order.
+
     :param prerequisites: functions to call before decorated is executed
     """
     def mark_prerequisite(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapped_async(docker_container, parsed_args):
+                for prer_func in prerequisites:
+                    await prer_func(docker_container, parsed_args)
+
+                await func(docker_container, parsed_args)
+            return wrapped_async
+
+        @functools.wraps(func)
         def wrapped(docker_container, parsed_args):
             for prer_func in prerequisites:
                 prer_func(docker_container, parsed_args)
@@ -249,79 +614,453 @@ def prerequisite(*prerequisites):
     return mark_prerequisite
 
 
-def builddep(docker_container, args):
+async def sources(docker_container, args):
+    if not container.build_in_tmpfs(docker_container.config):
+        # the build runs directly in the git repo
+        return
+
+    await run_step(docker_container, 'sync_sources')
+
+
+@prerequisite(sources)
+async def builddep(docker_container, args):
+    if docker_container.config['images']['builddep']:
+        # the dependencies are already installed in the image
+        return
+
     builddep_opts = getattr(args, 'builddep_opts', DEFAULT_BUILD_OPTS)
 
-    run_step(
+    await run_step(
         docker_container, 'builddep', builddep_opts=' '.join(builddep_opts))
 
 
 @prerequisite(builddep)
-def configure(docker_container, args):
-    run_step(docker_container, 'configure')
+async def configure(docker_container, args):
+    await run_step(docker_container, 'configure')
 
 
 @prerequisite(builddep)
-def tox(docker_container, args):
+async def tox(docker_container, args):
     developer_mode = getattr(args, 'developer_mode', DEFAULT_DEVEL_MODE)
 
     if developer_mode:
         return
 
-    run_step(docker_container, 'tox')
+    await run_step(docker_container, 'tox')
 
 
 @prerequisite(configure)
-def lint(docker_container, args):
+async def lint(docker_container, args):
     developer_mode = getattr(args, 'developer_mode', DEFAULT_DEVEL_MODE)
 
     if developer_mode:
         return
 
-    run_step(docker_container, 'lint')
+    await run_step(docker_container, 'lint')
 
 
 @prerequisite(lint)
-def build(docker_container, args):
+async def build(docker_container, args):
     make_target = getattr(args, 'make_target', DEFAULT_MAKE_TARGET)
-    run_step(docker_container, 'build', make_target=make_target)
+    await run_step(docker_container, 'build', make_target=make_target)
+
+    if container.build_in_tmpfs(docker_container.config):
+        await run_step(docker_container, 'export_artifacts')
 
 
 @prerequisite(configure)
-def webui_unit(docker_container, args):
-    run_step(docker_container, 'webui_unit')
+async def webui_unit(docker_container, args):
+    await run_step(docker_container, 'webui_unit')
 
 
 @prerequisite(build)
-def install_packages(docker_container, args):
-    run_step(docker_container, 'install_packages')
+async def install_packages(docker_container, args):
+    await run_step(docker_container, 'install_packages')
 
 
 @prerequisite(install_packages)
-def install_server(docker_container, args):
-    run_step(docker_container, 'install_server')
+async def install_server(docker_container, args):
+    await run_step(docker_container, 'install_server')
 
 
 @prerequisite(install_server)
-def prepare_tests(docker_container, args):
-    run_step(docker_container, 'prepare_tests')
+async def prepare_tests(docker_container, args):
+    await run_step(docker_container, 'prepare_tests')
 
 
-@prerequisite(prepare_tests)
-def run_tests(docker_container, args):
-    path = getattr(args, 'path', [])
-    ignore_config = docker_container.config['tests']['ignore']
-    verbose_config = docker_container.config['tests']['verbose']
+def _tests_options(ipaconfig):
+    ignore_config = ipaconfig['tests']['ignore']
+    verbose_config = ipaconfig['tests']['verbose']
 
     tests_ignore = ['--ignore {}'.format(p) for p in ignore_config]
     tests_verbose = '' if not verbose_config else '--verbose'
 
-    run_step(
+    return {
+        'tests_ignore': ' '.join(tests_ignore),
+        'tests_verbose': tests_verbose
+    }
+
+
+@prerequisite(prepare_tests)
+async def run_tests(docker_container, args):
+    path = getattr(args, 'path', [])
+
+    offsets = None
+    if getattr(args, 'server_latency', False):
+        await run_step(docker_container, 'latency_setup')
+        if not isinstance(docker_container, command.ExecutionPlan):
+            offsets = await latency.log_offsets(docker_container)
+
+    try:
+        if getattr(args, 'profile', False):
+            await profile_tests(docker_container, args)
+        else:
+            await run_step(
+                docker_container,
+                'run_tests',
+                path=' '.join(path),
+                **_tests_options(docker_container.config))
+    finally:
+        if offsets is not None:
+            await latency.collect(docker_container, offsets)
+
+
+async def profile_tests(docker_container, args):
+    """
+    Run the tests under the profiler and export the results to the host
+    """
+    options = dict(
+        path=' '.join(getattr(args, 'path', [])),
+        profile_dir=profiling.PROFILE_DIR,
+        profile_plugin=profiling.PLUGIN_MODULE,
+        **_tests_options(docker_container.config))
+
+    if isinstance(docker_container, command.ExecutionPlan):
+        await run_step(docker_container, 'profile_tests', **options)
+        return
+
+    await profiling.install_plugin(docker_container)
+    try:
+        await run_step(docker_container, 'profile_tests', **options)
+    finally:
+        await profiling.export_results(docker_container, args.profile_dir)
+
+
+def split_test_paths(ipaconfig, paths):
+    """
+    Split the test paths into those which do not need a running server and
+    those which do
+
+    :returns: tuple of the lists of server-independent and server paths
+    """
+    unit_paths = [p.rstrip('/') for p in ipaconfig['unit_tests']['paths']]
+    independent = []
+    needs_server = []
+
+    for path in paths:
+        test_path = path[len('ipatests/'):] if path.startswith(
+            'ipatests/') else path
+
+        if any(test_path == p or test_path.startswith(p + '/') or
+               test_path.startswith(p + '::') for p in unit_paths):
+            independent.append(path)
+        else:
+            needs_server.append(path)
+
+    return independent, needs_server
+
+
+@prerequisite(configure)
+async def unit_tests(docker_container, args):
+    path = getattr(args, 'path', [])
+    independent, needs_server = split_test_paths(
+        docker_container.config, path)
+
+    if needs_server:
+        logger.warning(
+            "Skipping tests which need a server, use 'run-tests' for them: "
+            "%s", ' '.join(needs_server))
+
+    if path and not independent:
+        return
+
+    await run_step(
         docker_container,
-        'run_tests',
-        path=' '.join(path),
-        tests_ignore=' '.join(tests_ignore),
-        tests_verbose=tests_verbose)
+        'unit_tests',
+        path=' '.join(
+            independent or docker_container.config['unit_tests']['paths']),
+        **_tests_options(docker_container.config))
+
+
+def fast_lane(ipaconfig, args, action):
+    """
+    Run 'run-tests' as 'unit-tests' when none of the requested paths needs a
+    running server
+
+    :returns: action to run
+    :raises: ValueError if all paths passed to 'unit-tests' need a server, so
+        that no container is created for nothing
+    """
+    path = getattr(args, 'path', [])
+    if action is unit_tests and path:
+        if not split_test_paths(ipaconfig, path)[0]:
+            raise ValueError(
+                "None of the tests can run without a server, use 'run-tests' "
+                "for them: {}".format(' '.join(path)))
+
+        return action
+
+    if (action is not run_tests or not path or
+            getattr(args, 'profile', False) or
+            getattr(args, 'server_latency', False)):
+        return action
+
+    if split_test_paths(ipaconfig, path)[1]:
+        return action
+
+    logger.info(
+        "None of the tests needs a server, running them in-tree without "
+        "building and installing the packages")
+    return unit_tests
+
+
+async def bisect_update(docker_container, args):
+    """
+    Rebuild the packages of the checked out commit and upgrade the installed
+    server to them
+    """
+    make_target = getattr(args, 'make_target', DEFAULT_MAKE_TARGET)
+
+    await configure(docker_container, args)
+    await run_step(docker_container, 'bisect_update', make_target=make_target)
+
+
+async def bisect_test(docker_container, args):
+    """
+    Run the tests of the bisection
+
+    :returns: tuple of the bisect result of the commit and the duration of
+        the tests
+    """
+    try:
+        await run_step(
+            docker_container,
+            'run_tests',
+            path=' '.join(args.path),
+            **_tests_options(docker_container.config))
+    except command.ContainerExecError as e:
+        logger.info("Tests failed: %s", e)
+        return gitbisect.BAD, docker_container.report.steps[-1]['duration']
+
+    duration = docker_container.report.steps[-1]['duration']
+    if args.max_duration and duration > args.max_duration:
+        logger.info("Tests took %s, more than %s",
+                    report.format_duration(duration),
+                    report.format_duration(args.max_duration))
+        return gitbisect.BAD, duration
+
+    return gitbisect.GOOD, duration
+
+
+async def bisect_async(ipaconfig, args):
+    """
+    Find the first bad commit between `args.good` and `args.bad`. The commits
+    are bisected in a separate checkout of the git repo, with a single
+    container for all of them: the server is installed from the first tested
+    commit and only upgraded to the packages built from the following ones.
+    The commits which fail to build or install are skipped
+
+    :returns: exit code, 0 if the first bad commit was found
+    """
+    git_repo = ipaconfig['git_repo']
+    source_snapshot = snapshot.SourceSnapshot(git_repo)
+    try:
+        good = snapshot.rev_parse(git_repo, args.good)
+        bad = snapshot.rev_parse(git_repo, args.bad)
+        await aio.run_blocking(source_snapshot.create)
+    except snapshot.SnapshotError as e:
+        logger.error("Cannot prepare the git repo for bisection: %s", e)
+        return 2
+
+    bisection = None
+
+    async def start_bisection():
+        nonlocal bisection
+
+        checkout = await source_snapshot.checkout_async('bisect')
+        bisection = gitbisect.GitBisect(checkout)
+        await aio.run_blocking(bisection.start, good, bad)
+        return checkout
+
+    # linter errors are not what is being bisected
+    bisect_args = argparse.Namespace(**vars(args))
+    bisect_args.developer_mode = True
+
+    host_scheduler = None
+    ipacontainer = None
+    results = []
+    try:
+        host_scheduler = create_scheduler(ipaconfig, args)
+        # the image is pulled while the first commit is checked out
+        ipacontainer = await create_container(
+            ipaconfig, host_scheduler, checkout=start_bisection)
+
+        installed = False
+        while not bisection.finished:
+            commit = await aio.run_blocking(bisection.current)
+            logger.info("Testing commit %s", commit)
+
+            result, duration = gitbisect.SKIP, None
+            try:
+                if installed:
+                    await bisect_update(ipacontainer, bisect_args)
+                else:
+                    await prepare_tests(ipacontainer, bisect_args)
+                    installed = True
+
+                result, duration = await bisect_test(
+                    ipacontainer, bisect_args)
+            except command.ContainerExecError as e:
+                logger.error(
+                    "Cannot install commit %s, skipping it: %s", commit, e)
+            finally:
+                # the files created in the container must not block the
+                # checkout of the next commit
+                try:
+                    await cleanup(ipacontainer)
+                except command.ContainerExecError as e:
+                    logger.error(
+                        "An exception has occured during cleanup: %s", e)
+
+            results.append((commit, result, duration))
+            await aio.run_blocking(bisection.mark, result)
+    except (gitbisect.BisectError, snapshot.SnapshotError) as e:
+        logger.error("Bisection failed: %s", e)
+        return 2
+    except Exception as e:
+        logger.error("Bisection failed: %s", e)
+        logger.debug(e, exc_info=e)
+        return 2
+    finally:
+        if ipacontainer is not None:
+            if args.no_cleanup:
+                logger.info(
+                    "Container %s and checkout %s are left behind",
+                    ipacontainer.container_id, ipacontainer.config['git_repo'])
+            else:
+                await stop_and_remove_container(ipacontainer)
+
+            await host_scheduler.release(ipacontainer)
+            record_step_history(ipacontainer.report)
+            write_report(ipacontainer.report, args.report)
+
+        if host_scheduler is not None:
+            host_scheduler.close()
+
+        if not args.no_cleanup:
+            source_snapshot.remove()
+
+    print_bisect_results(bisection, results, git_repo)
+    return 0 if bisection.first_bad is not None else 1
+
+
+def print_bisect_results(bisection, results, git_repo):
+    print("Tested commits:")
+    for commit, result, duration in results:
+        print("  {}  {:<6} {:>12}".format(
+            commit[:12], result, report.format_duration(duration)))
+
+    if bisection.first_bad is not None:
+        print("First bad commit: {}".format(
+            snapshot.describe_commit(git_repo, bisection.first_bad)))
+    else:
+        print("The first bad commit could be any of:")
+        for commit in bisection.candidates:
+            print("  {}".format(commit))
+
+
+def bisect(ipaconfig, args):
+    """
+    Synchronous version of `bisect_async`
+    """
+    return aio.run(bisect_async(ipaconfig, args))
+
+
+def serve(ipaconfig, args):
+    """
+    Run the queue service until interrupted
+    """
+    # the service module imports this one
+    from ipadocker import service
+
+    metrics_address = None
+    if args.metrics_address is not None:
+        try:
+            metrics_address = metrics.parse_address(args.metrics_address)
+        except ValueError:
+            logger.error("Invalid metrics address: %s", args.metrics_address)
+            return 2
+
+    queue = service.QueueService(ipaconfig, args, parallel=args.parallel)
+    try:
+        aio.run(queue.serve(args.socket or service.default_socket_path(),
+                            metrics_address=metrics_address))
+    except KeyboardInterrupt:
+        logger.info("Queue service stopped")
+    except OSError as e:
+        logger.error("Cannot run queue service: %s", e)
+        return 2
+
+    return 0
+
+
+def submit(ipaconfig, args):
+    """
+    Submit the job to the queue service and stream its output
+
+    :returns: exit code of the job
+    """
+    from ipadocker import service
+
+    job_argv = args.job[1:] if args.job[:1] == ['--'] else args.job
+    if not job_argv:
+        logger.error("No job to submit")
+        return 2
+
+    try:
+        config_overrides = submitted_config(job_argv)
+        return aio.run(service.submit_async(
+            args.socket or service.default_socket_path(), args.commit,
+            job_argv, service.print_event, config_overrides=config_overrides))
+    except (OSError, ValueError, config.ConfigValidationError) as e:
+        logger.error("Cannot submit job: %s", e)
+        return 2
+
+
+def submitted_config(job_argv):
+    """
+    Load the config file given on the command line of the job. The service
+    gets its contents, it does not share the working directory of the client
+
+    :returns: the contents of the config file or None if there is none
+    """
+    parser = make_parser()
+
+    def error(message):
+        raise SystemExit(2)
+
+    # the invalid command line is reported by the service
+    parser.error = error
+    try:
+        job_args = parser.parse_args(job_argv)
+    except SystemExit:
+        return None
+
+    if job_args.config is None:
+        return None
+
+    with open(job_args.config, 'r') as config_file:
+        return config.load_config_from_file(config_file)
 
 
 def sample_config(ipaconfig, logger):
@@ -335,6 +1074,67 @@ def sample_config(ipaconfig, logger):
         ipaconfig.write_config(default_config_file)
 
 
+async def build_image_async(ipaconfig, args):
+    """
+    Build the selected image variants and the builddep image on all Docker
+    hosts
+
+    :raises: ValueError if unknown variant is selected
+    """
+    variants = images.find_variants(images.dockerfile_dir(ipaconfig))
+    unknown = set(args.variants) - set(variants)
+    if unknown:
+        raise ValueError(
+            "Unknown image variant(s) {}, available are: {}".format(
+                ', '.join(sorted(unknown)), ', '.join(sorted(variants))))
+
+    if args.variants:
+        selected = [variants[name] for name in args.variants]
+    elif not args.builddep:
+        selected = list(variants.values())
+    else:
+        selected = []
+
+    builddep_opts = ' '.join(args.builddep_opts)
+    host_scheduler = create_scheduler(ipaconfig, args)
+    try:
+        for host in host_scheduler.hosts:
+            logger.info("Building images on %s", host.base_url)
+            docker_client = await host_scheduler.get_client(host)
+
+            tags = await images.build_variants(
+                docker_client, ipaconfig, selected, pull=args.pull,
+                nocache=args.no_cache)
+
+            if args.builddep:
+                tags.append(await images.build_builddep_image(
+                    docker_client, ipaconfig, builddep_opts,
+                    nocache=args.no_cache))
+
+            host.images.update(tags)
+    finally:
+        host_scheduler.close()
+
+
+def build_image(ipaconfig, args):
+    """
+    Synchronous version of `build_image_async`
+
+    :returns: exit code
+    """
+    try:
+        aio.run(build_image_async(ipaconfig, args))
+    except (ValueError, OSError, images.ImageBuildError) as e:
+        logger.error("%s", e)
+        return 1
+    except Exception as e:
+        logger.error("Failed to build images: %s", e)
+        logger.debug(e, exc_info=e)
+        return 2
+
+    return 0
+
+
 def get_action(cli_name):
     return {
         'build': build,
@@ -343,35 +1143,139 @@ def get_action(cli_name):
         'webui-unit': webui_unit,
         'tox': tox,
         'run-tests': run_tests,
-        'sample-config': sample_config
+        'unit-tests': unit_tests,
+        'sample-config': sample_config,
+        'build-image': build_image,
+        'bisect': bisect,
+        'serve': serve,
+        'submit': submit
     }[cli_name]
 
 
-def create_container(ipaconfig, args):
+def create_docker_client(args, base_url=constants.DEFAULT_DOCKER_URL,
+                         index=0):
+    # docker (and requests with it) is imported only when the container is
+    # really needed in order to keep the startup of the CLI fast
+    import docker
+
+    if args.replay is not None:
+        return recording.ReplayClient(args.replay, speed=args.replay_speed)
+
+    docker_client = docker.Client(base_url=base_url, version='auto')
+
+    if args.record is not None:
+        # sessions with other hosts than the first one go to separate files
+        filename = args.record
+        if index:
+            filename = '{}.{}'.format(filename, index)
+
+        return recording.RecordingClient(docker_client, filename)
+
+    return docker_client
+
+
+def close_docker_client(docker_client):
+    close = getattr(docker_client, 'close', None)
+    if close is None:
+        return
+
     try:
-        docker_client = docker.Client(base_url='unix://var/run/docker.sock',
-                                      version='auto')
-        return container.IPAContainer(docker_client, ipaconfig)
-    except ConnectionError as e:
-        logger.error("Failed to connect to Docker daemon: %s", e)
-        logger.error(
-            "Make sure that Docker is running and you have adequate"
-            "permissions to communicate with it")
-        logger.error("See 'journalctl -xe' for more details")
-        raise
-    except docker.errors.APIError as e:
-        logger.error("Docker API returned an error: %s", e)
-        raise
+        close()
     except Exception as e:
-        logger.error(
-            "An exception has occured while connecting to Docker "
-            "daemon: %s", e)
+        logger.warning("Cannot close Docker client: %s", e)
+
+
+def create_scheduler(ipaconfig, args):
+    if args.replay is not None:
+        # the whole session is replayed from a single file
+        hosts = [scheduler.DockerHost(0, constants.DEFAULT_DOCKER_URL)]
+    else:
+        hosts = scheduler.hosts_from_config(ipaconfig['hosts'])
+
+    return scheduler.HostScheduler(
+        hosts,
+        lambda host: create_docker_client(args, host.base_url, host.index))
+
+
+async def place_during_checkout(ipaconfig, host_scheduler, run_report,
+                                checkout):
+    """
+    Pick the host and pull the image there while the sources are checked
+    out. The slot on the host is returned if the checkout fails
+
+    :param checkout: coroutine function returning the path to the checkout
+    :returns: tuple of the DockerHost instance and the path to the checkout
+    """
+    import asyncio
+
+    async def timed_checkout():
+        started = time.time()
+        git_repo = await checkout()
+        if run_report is not None:
+            run_report.add_startup_stage('checkout', started)
+
+        return git_repo
+
+    place_task = asyncio.ensure_future(
+        host_scheduler.place(ipaconfig, run_report=run_report))
+    try:
+        host, git_repo = await aio.gather_all(place_task, timed_checkout())
+    except BaseException:
+        if (place_task.done() and not place_task.cancelled() and
+                place_task.exception() is None):
+            await host_scheduler.release_host(place_task.result())
+        raise
+
+    return host, git_repo
+
+
+async def create_container(ipaconfig, host_scheduler, run_report=None,
+                           checkout=None):
+    """
+    Create the container on the best host
+
+    :param checkout: coroutine function checking out the git repo to
+        bind-mount and returning its path. It runs while the host is picked
+        and the image is pulled, the container is created when both are done
+    """
+    import docker
+
+    try:
+        if checkout is None:
+            return await host_scheduler.create_container(
+                ipaconfig, run_report=run_report)
+
+        host, git_repo = await place_during_checkout(
+            ipaconfig, host_scheduler, run_report, checkout)
+        return await host_scheduler.create_container(
+            ipaconfig.override({'git_repo': git_repo}),
+            run_report=run_report, host=host)
+    except scheduler.NoHostAvailable as e:
+        for base_url, error in e.errors:
+            if isinstance(error, ConnectionError):
+                logger.error(
+                    "Failed to connect to Docker daemon %s: %s",
+                    base_url, error)
+                logger.error(
+                    "Make sure that Docker is running and you have adequate"
+                    "permissions to communicate with it")
+                logger.error("See 'journalctl -xe' for more details")
+            elif isinstance(error, docker.errors.APIError):
+                logger.error(
+                    "Docker API of %s returned an error: %s", base_url, error)
+            elif isinstance(error, container.ContainerNotReady):
+                logger.error(
+                    "Container on %s failed to boot: %s", base_url, error)
+            else:
+                logger.error(
+                    "An exception has occured while connecting to Docker "
+                    "daemon %s: %s", base_url, error)
         raise
 
 
-def stop_and_remove_container(container):
+async def stop_and_remove_container(container):
     try:
-        container.stop_and_remove()
+        await container.stop_and_remove_async()
     except Exception as e:
         logger.warning("Cannot remove container: %s", e)
 
@@ -383,35 +1287,487 @@ def chown_git_repo(container):
         logger.warning("Cannot chown working directory: %s", e)
 
 
-def run_action(ipaconfig, args, action):
-    ipacontainer = create_container(ipaconfig, args)
+async def cleanup(docker_container):
+    if getattr(docker_container, 'death', None) is not None:
+        logger.warning("Container is not running, skipping cleanup")
+        return
+
+    await run_step(
+        docker_container, 'cleanup', uid=os.getuid(), gid=os.getgid())
+
+
+async def plan_action_async(ipaconfig, args, action):
+    """
+    Render all steps which the action and its prerequisites execute,
+    including the final cleanup, without creating the container
+
+    :returns: ExecutionPlan instance
+    :raises: RuntimeError if some of the step templates are invalid
+    """
+    plan = command.ExecutionPlan(ipaconfig)
+    await action(plan, args)
+    await cleanup(plan)
+
+    return plan
+
+
+def plan_action(ipaconfig, args, action):
+    """
+    Synchronous version of `plan_action_async`
+    """
+    return aio.run(plan_action_async(ipaconfig, args, action))
+
+
+def print_plan(plan, args, history):
+    image = plan.config['container']['image']
+    print("Execution plan of '{}' using image {}:".format(
+        args.action_name, image))
+
+    total = 0.0
+    unknown = 0
+    for step_name, step in plan.steps:
+        estimate = history.estimate(image, step_name)
+        if estimate is None:
+            unknown += 1
+        else:
+            total += estimate
+
+        print("  {:<20} {:>12}".format(
+            step_name, report.format_duration(estimate)))
+
+        for cmd in step.commands:
+            print("      {}".format(cmd))
+
+    print("Expected duration: {}{}".format(
+        report.format_duration(total),
+        " (+{} steps without history)".format(unknown) if unknown else ""))
+
+
+def record_step_history(run_report):
+    history = report.StepHistory()
+    history.record_report(run_report)
+    history.save()
+
+
+def record_metrics(ipaconfig, run_report, action_name, exit_code):
+    """
+    Add the results of the run to the accumulated metrics and re-write the
+    metrics textfile, if configured
+    """
+    textfile = ipaconfig['metrics']['textfile']
+    if not textfile:
+        return
+
+    metrics.record_run(run_report, action_name, exit_code, textfile)
+
+
+def create_checkpoint(ipaconfig, args, plan):
+    """
+    Create the checkpoint of the run if checkpoints are enabled
+
+    :returns: Checkpoint instance or None
+    """
+    if not (getattr(args, 'checkpoint', False) or
+            getattr(args, 'resume', False)):
+        return None
+
+    if container.build_in_tmpfs(ipaconfig):
+        # the tmpfs is not part of the committed image
+        logger.warning(
+            "Checkpoints do not include the tmpfs build directory, "
+            "checkpoints disabled")
+        return None
 
     try:
-        action(ipacontainer, args)
+        source_digest = snapshot.source_hash(ipaconfig['git_repo'])
+    except snapshot.SnapshotError as e:
+        logger.warning("Cannot hash the sources, checkpoints disabled: %s", e)
+        return None
+
+    return checkpoint.Checkpoint(ipaconfig, source_digest, plan.steps)
+
+
+def write_report(run_report, filename):
+    run_report.log_summary()
+
+    if filename is None:
+        return
+
+    try:
+        with open(filename, 'w') as report_file:
+            run_report.write(report_file)
+    except OSError as e:
+        logger.warning("Cannot write report: %s", e)
+
+
+async def run_action_async(ipaconfig, args, action, host_scheduler=None,
+                           run_report=None, checkout=None):
+    """
+    Run the action in a new container
+
+    :param ipaconfig: IPADockerConfig instance
+    :param args: parsed CLI arguments
+    :param action: action coroutine function
+    :param host_scheduler: HostScheduler instance placing the container. If
+        not specified, a scheduler using the hosts from config is created for
+        the run
+    :param run_report: RunReport instance collecting the results of the run.
+        The container creates its own if not specified
+    :param checkout: coroutine function checking out the git repo for the
+        run, see `create_container`
+    """
+    logger.info("Validating execution plan")
+    try:
+        plan = await plan_action_async(ipaconfig, args, action)
+    except RuntimeError as e:
+        logger.error("Invalid execution plan: %s", e)
+        raise
+
+    # the steps are reported with the original image when resuming
+    run_report = run_report or report.RunReport(
+        image=ipaconfig['container']['image'])
+
+    run_checkpoint = None
+    resumed_image = None
+    resume = getattr(args, 'resume', False)
+    if checkout is not None and (resume or getattr(args, 'checkpoint', False)):
+        # the checkpoint is keyed by the hash of the checked out sources
+        ipaconfig = ipaconfig.override({'git_repo': await checkout()})
+        checkout = None
+    if resume:
+        # the image of the container is known only after the checkpoint is
+        # found
+        run_checkpoint = await prepare_checkpoint(
+            ipaconfig, args, plan, run_report)
+    if run_checkpoint is not None:
+        resumed_image = run_checkpoint.resume()
+        if resumed_image is None:
+            logger.info("No checkpoint to resume from, running all steps")
+        else:
+            ipaconfig = ipaconfig.override(
+                {'container': {'image': resumed_image}})
+
+    own_scheduler = host_scheduler is None
+    if own_scheduler:
+        try:
+            host_scheduler = create_scheduler(ipaconfig, args)
+        except ValueError as e:
+            logger.error("Invalid host inventory: %s", e)
+            raise
+
+    if resumed_image is not None:
+        # the checkpoint image exists only on the host which committed it
+        for host in host_scheduler.hosts:
+            if host.base_url == run_checkpoint.base_url:
+                host.images.add(resumed_image)
+
+    started = time.time()
+    events.emit('run_start', action=action.__name__,
+                image=ipaconfig['container']['image'])
+    exit_code = 2
+    try:
+        prepare = None
+        if getattr(args, 'checkpoint', False) and not resume:
+            # the sources are hashed while the container starts
+            prepare = prepare_checkpoint(ipaconfig, args, plan, run_report)
+
+        await run_in_container(
+            ipaconfig, args, action, host_scheduler, run_report=run_report,
+            run_checkpoint=run_checkpoint, prepare=prepare,
+            checkout=checkout)
+        exit_code = 0
+    except command.ContainerExecError as e:
+        exit_code = e.exit_code
+        raise
+    finally:
+        events.emit('run_end', action=action.__name__, exit_code=exit_code,
+                    duration=time.time() - started)
+        if own_scheduler:
+            host_scheduler.close()
+
+
+async def prepare_checkpoint(ipaconfig, args, plan, run_report):
+    """
+    Create the checkpoint of the run in the executor, hashing the sources may
+    take a while
+
+    :returns: Checkpoint instance or None
+    """
+    started = time.time()
+    run_checkpoint = await aio.run_blocking(
+        create_checkpoint, ipaconfig, args, plan)
+    run_report.add_startup_stage('checkpoint', started)
+
+    return run_checkpoint
+
+
+async def start_container(ipaconfig, host_scheduler, run_report, prepare,
+                          checkout=None):
+    """
+    Create the container while the checkpoint of the run is prepared, so
+    that the image pull and the container boot overlap with hashing the
+    sources. The container is removed if the preparation fails
+
+    :param prepare: `prepare_checkpoint` coroutine
+    :param checkout: see `create_container`
+    :returns: tuple of the IPAContainer instance and the result of `prepare`
+    """
+    import asyncio
+
+    container_task = asyncio.ensure_future(
+        create_container(ipaconfig, host_scheduler, run_report=run_report,
+                         checkout=checkout))
+    try:
+        ipacontainer, prepared = await aio.gather_all(
+            container_task, prepare)
+    except BaseException:
+        if (container_task.done() and not container_task.cancelled() and
+                container_task.exception() is None):
+            await stop_and_remove_container(container_task.result())
+            await host_scheduler.release(container_task.result())
+        raise
+
+    return ipacontainer, prepared
+
+
+async def run_in_container(ipaconfig, args, action, host_scheduler,
+                           run_report=None, run_checkpoint=None,
+                           prepare=None, checkout=None):
+    """
+    Create the container and run the action in it
+
+    :param prepare: `prepare_checkpoint` coroutine run while the container
+        starts, its result is used as the checkpoint of the run
+    :param checkout: see `create_container`
+    """
+    import docker
+
+    if prepare is None:
+        ipacontainer = await create_container(
+            ipaconfig, host_scheduler, run_report=run_report,
+            checkout=checkout)
+    else:
+        ipacontainer, run_checkpoint = await start_container(
+            ipaconfig, host_scheduler, run_report, prepare,
+            checkout=checkout)
+    ipacontainer.checkpoint = run_checkpoint
+
+    exit_code = 2
+    try:
+        await action(ipacontainer, args)
+        exit_code = 0
     except docker.errors.APIError as e:
         logger.error("Docker API returned an error: %s", e)
         raise
     except command.ContainerExecError as e:
         logger.error(e)
+        exit_code = e.exit_code
+        if (isinstance(e, command.ContainerDied) and
+                ipacontainer.checkpoint is not None):
+            logger.info("Use --resume to continue from the last checkpoint")
         raise
     except Exception as e:
         logger.error("An exception has occured when running command: %s", e)
         raise
     finally:
         try:
-            run_step(ipacontainer, 'cleanup', uid=os.getuid(), gid=os.getgid())
-        except command.ContainerExecError:
+            await cleanup(ipacontainer)
+        except command.ContainerExecError as e:
             logger.error("An exception has occured during cleanup: %s", e)
 
         if args.no_cleanup:
+            ipacontainer.unwatch()
             logger.info("Container cleanup suppressed.")
             logger.info(
                 "You can access and inspect the container using ID: %s",
                 ipacontainer.container_id)
             logger.info("You will have to stop and remove it manually")
-            return
+        else:
+            await stop_and_remove_container(ipacontainer)
 
-        stop_and_remove_container(ipacontainer)
+        await host_scheduler.release(ipacontainer)
+        record_step_history(ipacontainer.report)
+        record_metrics(
+            ipaconfig, ipacontainer.report, action.__name__, exit_code)
+        write_report(ipacontainer.report, args.report)
+
+
+def run_action(ipaconfig, args, action):
+    """
+    Run the action in a new container. Synchronous version of
+    `run_action_async`
+    """
+    aio.run(run_action_async(ipaconfig, args, action))
+
+
+def matrix_images(ipaconfig, args):
+    """
+    Return the images of the matrix run. Names of the image variants (see
+    `build-image`) are translated to the tags of their images
+    """
+    try:
+        variants = images.find_variants(images.dockerfile_dir(ipaconfig))
+    except OSError:
+        variants = {}
+
+    names = [name.strip() for value in args.matrix
+             for name in value.split(',') if name.strip()]
+
+    return [
+        images.variant_tag(ipaconfig, variants[name]) if name in variants
+        else name
+        for name in names
+    ]
+
+
+def builddep_lookup_client(ipaconfig, args):
+    """
+    Return the Docker client of the first host of the inventory on which the
+    builddep image is looked up (`build-image` builds it on all of them).
+    Dry runs do not talk to Docker and the recorded sessions hold the calls
+    of the runs only, the image is not looked up then
+
+    :returns: Docker client or None
+    """
+    import docker
+
+    if (not ipaconfig['images']['builddep'] or
+            getattr(args, 'dry_run', False) or
+            getattr(args, 'record', None) is not None or
+            getattr(args, 'replay', None) is not None):
+        return None
+
+    try:
+        host = scheduler.hosts_from_config(ipaconfig['hosts'])[0]
+        return docker.Client(base_url=host.base_url, version='auto')
+    except Exception as e:
+        logger.debug("Cannot look up builddep image: %s", e)
+        return None
+
+
+def builddep_config(ipaconfig, args, docker_client=None):
+    """
+    Return the config of the run using the builddep image if it is enabled,
+    see `images.use_builddep_image`
+    """
+    return images.use_builddep_image(
+        ipaconfig,
+        ' '.join(getattr(args, 'builddep_opts', DEFAULT_BUILD_OPTS)),
+        docker_client=docker_client)
+
+
+def matrix_config(ipaconfig, args, image, docker_client=None):
+    """
+    Return the config of the run with the image in the matrix mode
+
+    :param docker_client: see `builddep_lookup_client`
+    """
+    return builddep_config(
+        ipaconfig.override({'container': {'image': image}}), args,
+        docker_client=docker_client)
+
+
+async def run_matrix_async(ipaconfig, args, action, image_names):
+    """
+    Run the action with each of the images concurrently. At most
+    `args.matrix_parallel` runs are active at once and they share the host
+    scheduler. All runs use their own checkout of the same snapshot of the
+    git repo
+
+    :returns: MatrixReport instance
+    """
+    import asyncio
+
+    source_snapshot = snapshot.SourceSnapshot(ipaconfig['git_repo'])
+    try:
+        await aio.run_blocking(source_snapshot.create)
+    except snapshot.SnapshotError as e:
+        logger.error("Cannot create snapshot of the git repo: %s", e)
+        raise
+
+    try:
+        host_scheduler = create_scheduler(ipaconfig, args)
+    except ValueError as e:
+        logger.error("Invalid host inventory: %s", e)
+        raise
+
+    parallel = asyncio.Semaphore(max(args.matrix_parallel, 1))
+    lookup_client = await aio.run_blocking(
+        builddep_lookup_client, ipaconfig, args)
+
+    # the combined report is written at the end instead of the reports of
+    # the individual runs
+    run_args = argparse.Namespace(**vars(args))
+    run_args.report = None
+
+    async def run_image(image):
+        run_report = report.RunReport(image=image)
+        exit_code = 0
+
+        async with parallel:
+            start = time.time()
+            try:
+                # the builddep image is looked up from the spec file in the
+                # git repo, the snapshot holds the same one
+                image_config = await aio.run_blocking(
+                    matrix_config, ipaconfig, args, image, lookup_client)
+                run_report.image = image_config['container']['image']
+
+                # the image is pulled while the snapshot is checked out
+                await run_action_async(
+                    image_config, run_args, action, host_scheduler,
+                    run_report=run_report,
+                    checkout=functools.partial(
+                        source_snapshot.checkout_async, image))
+            except command.ContainerExecError as e:
+                exit_code = e.exit_code
+            except Exception as e:
+                logger.error("Run with image %s failed: %s", image, e)
+                logger.debug(e, exc_info=e)
+                exit_code = 2
+
+            return run_report, exit_code, time.time() - start
+
+    matrix_report = report.MatrixReport(args.action_name)
+    try:
+        results = await asyncio.gather(
+            *[run_image(image) for image in image_names])
+    finally:
+        host_scheduler.close()
+        close_docker_client(lookup_client)
+        if not args.no_cleanup:
+            source_snapshot.remove()
+
+    for run_report, exit_code, duration in results:
+        matrix_report.add_run(run_report, exit_code, duration)
+
+    return matrix_report
+
+
+def run_matrix(ipaconfig, args, action, image_names):
+    """
+    Synchronous version of `run_matrix_async` which prints the results
+
+    :returns: exit code of the first failed run or 0
+    """
+    try:
+        matrix_report = aio.run(
+            run_matrix_async(ipaconfig, args, action, image_names))
+    except Exception as e:
+        logger.debug(e, exc_info=e)
+        return 2
+
+    for line in matrix_report.format_table():
+        print(line)
+
+    if args.report is not None:
+        try:
+            with open(args.report, 'w') as report_file:
+                matrix_report.write(report_file)
+        except OSError as e:
+            logger.warning("Cannot write report: %s", e)
+
+    return matrix_report.exit_code
 
 
 def load_config_file(filename):
@@ -453,15 +1809,57 @@ def main():
 
     setup_loggers(args)
 
+    if args.events is not None:
+        try:
+            events.open_stream(args.events, output_text=args.events_output)
+        except OSError as e:
+            argparser.error("Cannot open event stream: {}".format(e))
+
     logger.debug("Argument namespace: %s", args)
     logger.info("Starting %s", sys.argv[0])
 
     ipaconfig = create_ipaconfig(args)
 
-    action = get_action(args.action_name)
+    try:
+        action = fast_lane(ipaconfig, args, get_action(args.action_name))
+    except ValueError as e:
+        argparser.error(str(e))
+
     if action is sample_config:
         sample_config(ipaconfig, logger)
         sys.exit(0)
+    elif action is build_image:
+        sys.exit(build_image(ipaconfig, args))
+    elif action in (bisect, serve, submit):
+        sys.exit(action(ipaconfig, args))
+
+    if args.matrix:
+        image_names = matrix_images(ipaconfig, args)
+        if not args.dry_run:
+            sys.exit(run_matrix(ipaconfig, args, action, image_names))
+
+        ipaconfigs = [matrix_config(ipaconfig, args, image)
+                      for image in image_names]
+    else:
+        lookup_client = builddep_lookup_client(ipaconfig, args)
+        try:
+            ipaconfig = builddep_config(ipaconfig, args, lookup_client)
+        finally:
+            close_docker_client(lookup_client)
+        ipaconfigs = [ipaconfig]
+
+    if args.dry_run:
+        try:
+            plans = [plan_action(image_config, args, action)
+                     for image_config in ipaconfigs]
+        except RuntimeError as e:
+            logger.error("Invalid execution plan: %s", e)
+            sys.exit(2)
+
+        history = report.StepHistory()
+        for plan in plans:
+            print_plan(plan, args, history)
+        sys.exit(0)
 
     try:
         run_action(ipaconfig, args, action)
@@ -5,8 +5,14 @@
 The command execution engine
 """
 
+import binascii
 import logging
+import os
+import re
 import string
+import time
+
+from ipadocker import aio, events, resources
 
 logger = logging.getLogger(__name__)
 
@@ -25,45 +31,363 @@ class ContainerExecError(Exception):
         super(ContainerExecError, self).__init__(msg)
 
 
-def exec_command(docker_client, container_id, cmd):
+class ContainerExecTimeout(ContainerExecError):
+    """
+    Exception raised when the command does not finish in time. The exit code
+    is 124, the same as of `timeout` utility
+
+    :param cmd: the command that timed out
+    :param timeout: the timeout in seconds
+    :param diagnostics: processes of the command at the time of the timeout
+    """
+    exit_code = 124
+
+    def __init__(self, cmd, timeout, diagnostics=''):
+        self.timeout = timeout
+        self.diagnostics = diagnostics
+        Exception.__init__(
+            self, "Command {} timed out after {} seconds".format(
+                cmd, timeout))
+
+
+class ContainerDied(ContainerExecError):
+    """
+    Exception raised when the container stops while a command runs in it,
+    e.g. because it was killed by the OOM killer or its init system crashed.
+    The exit code is the one of the container
+
+    :param cmd: the command that was running
+    :param state: 'State' of the inspected container
+    """
+    def __init__(self, cmd, state):
+        self.state = state
+        self.oom_killed = bool(state.get('OOMKilled'))
+        self.exit_code = state.get('ExitCode') or 1
+
+        msg = "Command {} aborted, the container {} (exit code {})".format(
+            cmd,
+            'was OOM killed' if self.oom_killed else
+            state.get('Status', 'died'),
+            self.exit_code)
+        if state.get('Error'):
+            msg = '{}: {}'.format(msg, state['Error'])
+
+        Exception.__init__(self, msg)
+
+
+# directory in the container holding the session IDs of commands with timeout
+PIDFILE_DIR = '/run'
+
+_PIDFILE_NAME_RE = re.compile(r'\bipadocker-[0-9a-f]{16}\.pid\b')
+
+KILL_SCRIPT = (
+    'sid=$(cat {pidfile}) || exit 0; '
+    'ps -s $sid -o pid,ppid,stat,etime,args; '
+    'pkill -TERM -s $sid; '
+    'for i in $(seq {grace_period}); do '
+    'pgrep -s $sid > /dev/null || break; sleep 1; done; '
+    'pkill -KILL -s $sid; '
+    'rm -f {pidfile}'
+)
+
+
+def normalize_command(cmd):
+    """
+    Replace the random names of the pidfiles in the command wrapped for the
+    timeout, so that the runs of the same command compare equal (e.g. in the
+    replayed sessions)
+    """
+    if not isinstance(cmd, str):
+        return cmd
+
+    return _PIDFILE_NAME_RE.sub('ipadocker-PID.pid', cmd)
+
+
+def _bash_command(cmd):
+    if not isinstance(cmd, str):
+        command = ' '.join(cmd)
+    else:
+        command = cmd
+
+    return "bash -c '{}'".format(command.replace("'", "'\\''"))
+
+
+async def _kill_session(docker_client, container_id, pidfile,
+                        grace_period):
+    """
+    Kill all processes of the command running in its own session
+
+    :returns: the list of the processes before they were killed
+    """
+    _exit_code, output = await exec_output_async(
+        docker_client, container_id,
+        KILL_SCRIPT.format(pidfile=pidfile, grace_period=grace_period))
+
+    return output
+
+
+async def _consume_while_alive(consumer, watcher, cmd):
+    """
+    Await the consumer of the exec output unless the container dies first
+
+    :raises: ContainerDied if the watcher reports the death of the container
+    """
+    import asyncio
+
+    consumer = asyncio.ensure_future(consumer)
+    try:
+        await asyncio.wait(
+            [consumer, watcher], return_when=asyncio.FIRST_COMPLETED)
+        if not consumer.done() and not watcher.cancelled():
+            state = watcher.result()
+            if state is not None:
+                raise ContainerDied(cmd, state)
+
+        await consumer
+    finally:
+        if not consumer.done():
+            consumer.cancel()
+
+
+async def _check_alive(docker_client, container_id, cmd):
+    """
+    Tell the failure of the command from the death of the container, which
+    closes the exec output stream as well
+
+    :raises: ContainerDied if the container does not run anymore
+    """
+    try:
+        state = (await docker_client.inspect_container(container_id))['State']
+    except Exception as e:
+        logger.debug("Cannot inspect container: %s", e)
+        return
+
+    if state.get('Status') != 'running':
+        raise ContainerDied(cmd, state)
+
+
+async def exec_command_async(docker_client, container_id, cmd, timeout=0,
+                             kill_grace_period=10, run_report=None,
+                             watcher=None):
     """
     Execute a command in running container. A small wrapper around
     `exec_create` and `exec_start` methods. The command is run inside a spawned
-    bash session
+    bash session and its output is streamed to the exec logger as it arrives
 
-    :param docker_client: Docker Client API instance
+    If the timeout is set, the command runs in a new session. When the command
+    does not finish in time, all processes in the session are killed
+
+    :param docker_client: Docker Client API instance, either synchronous or
+        `ipadocker.aio.AsyncDockerClient`
     :param container_id: ID of the running container
     :param cmd: Command to run, either string or list
+    :param timeout: timeout in seconds, 0 means no timeout
+    :param kill_grace_period: time in seconds between SIGTERM and SIGKILL
+        sent to the processes of the command which timed out
+    :param run_report: RunReport instance recording the duration of the
+        command and the latency of the exec API calls, if any
+    :param watcher: future of the container watcher (see
+        `IPAContainer.watch`). When it reports the death of the container,
+        the command is aborted right away instead of waiting for the exec
+        output stream
 
-    :raises: ContainerExecError if the command failed for some reason
+    :raises: ContainerExecError if the command failed for some reason,
+        ContainerExecTimeout if it timed out, ContainerDied if the container
+        stopped meanwhile
     """
     exec_logger = logging.getLogger('.'.join([__name__, 'exec']))
+    docker_client = aio.async_client(docker_client)
 
-    if not isinstance(cmd, str):
-        command = ' '.join(cmd)
+    if timeout:
+        if not isinstance(cmd, str):
+            cmd = ' '.join(cmd)
+
+        pidfile = os.path.join(PIDFILE_DIR, 'ipadocker-{}.pid'.format(
+            binascii.hexlify(os.urandom(8)).decode()))
+        bash_command = 'setsid --wait {}'.format(
+            _bash_command('echo $$ > {0}; trap "rm -f {0}" EXIT; {1}'.format(
+                pidfile, cmd)))
     else:
-        command = cmd
+        bash_command = _bash_command(cmd)
+
+    started = time.time()
+    events.emit('command_start', container_id=container_id,
+                command=cmd if isinstance(cmd, str) else ' '.join(cmd))
+
+    # the records carry the container ID so that the output of concurrent
+    # runs can be told apart (see `ipadocker.service`)
+    extra = {'container_id': container_id}
+    output_counter = events.OutputCounter(container_id)
 
-    bash_command = "bash -c '{}'".format(command.replace("'", "'\\''"))
+    def handle_output(output):
+        output_counter.add(output)
+        exec_logger.info(output.decode().rstrip(), extra=extra)
 
-    exec_id = docker_client.exec_create(container_id, cmd=bash_command)
+    exit_code = None
+    try:
+        exec_id = await docker_client.exec_create(
+            container_id, cmd=bash_command)
+        latency = time.time() - started
+        stream = await docker_client.exec_start(exec_id, stream=True)
+        consumer = aio.consume(stream, handle_output)
+        if watcher is not None:
+            consumer = _consume_while_alive(consumer, watcher, cmd)
 
-    for output in docker_client.exec_start(exec_id, stream=True):
-        exec_logger.info(output.decode().rstrip())
+        if timeout:
+            import asyncio
 
-    exec_status = docker_client.exec_inspect(exec_id)
-    exit_code = exec_status["ExitCode"]
+            try:
+                await asyncio.wait_for(consumer, timeout)
+            except asyncio.TimeoutError:
+                exit_code = ContainerExecTimeout.exit_code
+                logger.error(
+                    "Command %s timed out after %s seconds, killing it",
+                    cmd, timeout)
+                diagnostics = await _kill_session(
+                    docker_client, container_id, pidfile, kill_grace_period)
+                logger.error("Processes of the command:\n%s", diagnostics)
+                raise ContainerExecTimeout(cmd, timeout, diagnostics)
+        else:
+            await consumer
+
+        inspected = time.time()
+        exec_status = await docker_client.exec_inspect(exec_id)
+        exit_code = exec_status["ExitCode"]
+
+        if run_report is not None:
+            run_report.add_command(
+                time.time() - started, latency + time.time() - inspected)
+
+        if exit_code and watcher is not None:
+            await _check_alive(docker_client, container_id, cmd)
+    except ContainerExecError:
+        raise
+    except Exception:
+        # the exec API fails when the container is gone
+        if watcher is not None:
+            await _check_alive(docker_client, container_id, cmd)
+        raise
+    finally:
+        output_counter.report()
+        events.emit(
+            'command_end', container_id=container_id, exit_code=exit_code,
+            duration=time.time() - started, bytes=output_counter.bytes,
+            chunks=output_counter.chunks)
 
     if exit_code:
         raise ContainerExecError(cmd, exit_code)
 
 
+def exec_command(docker_client, container_id, cmd):
+    """
+    Synchronous version of `exec_command_async`
+    """
+    aio.run(exec_command_async(docker_client, container_id, cmd))
+
+
+async def exec_output_async(docker_client, container_id, cmd):
+    """
+    Execute a short command (e.g. a probe) in running container and capture
+    its output instead of logging it. Failure of the command is not an error
+
+    :param docker_client: Docker Client API instance, either synchronous or
+        `ipadocker.aio.AsyncDockerClient`
+    :param container_id: ID of the running container
+    :param cmd: Command to run, either string or list
+
+    :returns: tuple of exit code and the decoded output
+    """
+    docker_client = aio.async_client(docker_client)
+
+    exec_id = await docker_client.exec_create(
+        container_id, cmd=_bash_command(cmd))
+    output = await docker_client.exec_start(exec_id)
+    exec_status = await docker_client.exec_inspect(exec_id)
+
+    return exec_status["ExitCode"], output.decode(errors='replace')
+
+
+class RetryPolicy:
+    """
+    Policy of retrying failed operations (commands, image pulls)
+
+    :param attempts: maximum number of attempts, 1 means no retry
+    :param backoff: delay before the first retry in seconds, doubled with
+        every further retry
+    :param exit_codes: exit codes of the commands which are retried. Any
+        failure is retried if empty
+
+    The number of retries made is counted in the `retries` attribute
+    """
+    def __init__(self, attempts=1, backoff=0, exit_codes=()):
+        self.attempts = max(attempts, 1)
+        self.backoff = backoff
+        self.exit_codes = set(exit_codes)
+        self.retries = 0
+
+    @classmethod
+    def from_config(cls, retry_config):
+        """
+        Create the policy from the entry in the 'retries' subsection of the
+        'execution' config section
+        """
+        return cls(retry_config['attempts'], retry_config['backoff'],
+                   retry_config['exit_codes'])
+
+    def is_retryable(self, error):
+        # hung command would most likely hang again, and nothing runs in a
+        # dead container
+        if isinstance(error, (ContainerExecTimeout, ContainerDied)):
+            return False
+
+        if isinstance(error, ContainerExecError) and self.exit_codes:
+            return error.exit_code in self.exit_codes
+
+        return True
+
+    def delay(self, attempt):
+        """
+        Return the delay before the next attempt after a failed one
+        """
+        return self.backoff * 2 ** (attempt - 1)
+
+    async def run(self, func, *args, deadline=None, **kwargs):
+        """
+        Await `func(*args, **kwargs)` and retry it if it fails
+
+        :param deadline: time after which no further attempt is started
+        :returns: the result of the last attempt
+        """
+        import asyncio
+
+        attempt = 1
+        while True:
+            try:
+                return await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                delay = self.delay(attempt)
+                if (attempt >= self.attempts or not self.is_retryable(e) or
+                        deadline is not None and
+                        time.time() + delay >= deadline):
+                    raise
+
+                logger.warning(
+                    "Attempt %d of %d failed: %s. Retrying in %s seconds",
+                    attempt, self.attempts, e, delay)
+                await asyncio.sleep(delay)
+
+            attempt += 1
+            self.retries += 1
+
+
 class ExecutionStep:
     """
     A single step of execution in the container
 
     :param commands: list of command string to execute, including interpolation
-        variables
+        variables. Pre-compiled `string.Template` objects are accepted too
     :param template_mapping: a mapping containing key-value pairs to substitute
         into the command strings
     :param kwargs: additional keyword arguments for the template substitution
@@ -75,24 +399,85 @@ class ExecutionStep:
         self.commands = []
 
         for command in commands:
-            logger.debug("Command before substitution: %s", command)
-            cmd_template = string.Template(command)
+            if isinstance(command, string.Template):
+                cmd_template = command
+            else:
+                cmd_template = string.Template(command)
+
+            logger.debug(
+                "Command before substitution: %s", cmd_template.template)
             self.commands.append(
                 cmd_template.substitute(template_mapping, **kwargs)
             )
 
-    def __call__(self, container):
+    async def run(self, container, command_timeout=0, step_timeout=0,
+                  kill_grace_period=10, retry_policy=None):
         """
         Execute the commands in container
 
         :params container: the IPAContainer instance holding container info
+        :param command_timeout: timeout of each command in seconds
+        :param step_timeout: timeout of all commands in seconds
+        :param kill_grace_period: time in seconds between SIGTERM and SIGKILL
+            sent to the processes of the command which timed out
+        :param retry_policy: RetryPolicy instance applied to each of the
+            commands. The commands are not retried if not specified
 
         :raises: ContainerExecError when the process exists with non-zero
-        status
+        status, ContainerExecTimeout when any of the timeouts expires,
+        ContainerDied when the container stops
         """
         container_id = container.container_id
-        docker_client = container.docker_client
+        docker_client = aio.async_client(container.docker_client)
+        deadline = time.time() + step_timeout if step_timeout else None
+        retry_policy = retry_policy or RetryPolicy()
+
+        async def execute(cmd):
+            timeout = command_timeout
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0.001)
+                timeout = min(timeout or remaining, remaining)
+
+            await exec_command_async(
+                docker_client, container_id, cmd, timeout=timeout,
+                kill_grace_period=kill_grace_period,
+                run_report=getattr(container, 'report', None),
+                watcher=getattr(container, 'watcher', None))
 
         for cmd in self.commands:
-            logger.info("Executing command: %s", cmd)
-            exec_command(docker_client, container_id, cmd)
+            logger.info("Executing command: %s", cmd,
+                        extra={'container_id': container_id})
+            await retry_policy.run(execute, cmd, deadline=deadline)
+
+    def __call__(self, container):
+        """
+        Synchronous version of `run`
+        """
+        aio.run(self.run(container))
+
+
+class ExecutionPlan:
+    """
+    A stand-in for the IPAContainer instance which collects the execution
+    steps of an action instead of running them. Since all the commands are
+    rendered when the steps are added, the plan is also a cheap validation of
+    the step templates which does not need a running container
+
+    The number of parallel jobs is derived from the CPUs and memory of the
+    local machine since the Docker host is not known yet
+
+    :param config: IPADockerConfig instance
+    """
+    def __init__(self, config):
+        self.config = config
+        self.steps = []
+        self.jobs = resources.parallel_jobs(config['host'])
+
+    def add_step(self, step_name, step):
+        """
+        Add step to the plan
+
+        :param step_name: name of the step
+        :param step: ExecutionStep instance
+        """
+        self.steps.append((step_name, step))
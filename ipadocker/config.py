@@ -2,11 +2,13 @@
 # See LICENSE file for license
 
 from collections import ChainMap
+from collections.abc import Mapping
+import copy
 import itertools
 import logging
 import os
-
-import yaml
+import string
+from types import MappingProxyType
 
 from ipadocker import constants
 
@@ -98,6 +100,8 @@ def load_config_from_file(input_file):
 
     :returns: dictionary of parsed values
     """
+    import yaml
+
     logger.info("Parsing YAML configuration")
     config = yaml.safe_load(input_file)
     logger.debug("Retrieved configuration: %s", config)
@@ -261,6 +265,51 @@ def deepen_mapping(mapping, separator='_',
     return deep_mapping
 
 
+def freeze_value(value):
+    """
+    Return a read-only copy of a configuration value. Dictionaries are turned
+    into read-only mappings and lists into tuples, recursively
+    """
+    if isinstance(value, dict):
+        return MappingProxyType(
+            {k: freeze_value(v) for k, v in value.items()})
+    elif isinstance(value, (list, tuple)):
+        return tuple(freeze_value(v) for v in value)
+
+    return value
+
+
+class ResolvedConfig(Mapping):
+    """
+    A frozen view of the merged configuration. The lookups are not passing
+    through the chain of overrides anymore, so their cost does not depend on
+    the number of override layers. The flat representation of the
+    configuration and the command templates of all steps are computed only
+    once
+
+    :param config_dict: merged configuration as returned by
+        `IPADockerConfig.to_dict`
+    :param separator: separator used to construct keys of the flat view
+    """
+    def __init__(self, config_dict, separator='_'):
+        self._config = freeze_value(config_dict)
+        self.flat = freeze_value(
+            flatten_mapping(config_dict, separator=separator))
+        self.templates = MappingProxyType({
+            step_name: tuple(string.Template(cmd) for cmd in commands)
+            for step_name, commands in config_dict['steps'].items()
+        })
+
+    def __getitem__(self, item):
+        return self._config[item]
+
+    def __iter__(self):
+        return iter(self._config)
+
+    def __len__(self):
+        return len(self._config)
+
+
 class IPADockerConfig(object):
     """
     An object which encapsulates the merged default options and options
@@ -277,8 +326,17 @@ class IPADockerConfig(object):
         """
         overrides += (load_default_config_file(), constants.DEFAULT_CONFIG)
         self.config = DeepChainMap(*overrides)
+        self._resolved = None
 
-        logger.debug("Flat configuration: %s", self.to_dict())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Flat configuration: %s", self.to_dict())
+
+    def __getstate__(self):
+        # copies are usually modified afterwards (see `ipadocker.container`)
+        # so the resolved view must be computed for them again
+        state = self.__dict__.copy()
+        state['_resolved'] = None
+        return state
 
     def __getitem__(self, item):
         try:
@@ -286,6 +344,17 @@ class IPADockerConfig(object):
         except KeyError:
             raise AttributeError
 
+    def override(self, overrides):
+        """
+        Return a copy of the config in which `overrides` take precedence over
+        the current values
+
+        :param overrides: (nested) mapping of the overridden options
+        """
+        new_config = copy.copy(self)
+        new_config.config = self.config.new_child(overrides)
+        return new_config
+
     def to_dict(self):
         """
         Squash the config to single dict and return that
@@ -304,11 +373,26 @@ class IPADockerConfig(object):
         """
         return flatten_mapping(self.config.to_dict(), separator=separator)
 
+    def resolve(self):
+        """
+        Return the frozen view of the configuration (see `ResolvedConfig`).
+        The view is computed on the first call and cached, so the
+        configuration must not be modified afterwards
+
+        :returns: ResolvedConfig instance
+        """
+        if self._resolved is None:
+            self._resolved = ResolvedConfig(self.to_dict())
+
+        return self._resolved
+
     def write_config(self, output_file):
         """
         Dump the current configuration to file as YaML
 
         :param f: file-like object open for writing
         """
+        import yaml
+
         logger.info("Dumping YAML configuration")
         yaml.safe_dump(self.to_dict(), output_file, default_flow_style=False)
@@ -9,6 +9,7 @@ import os
 
 
 FREEIPA_MNT_POINT = os.path.join('/', 'freeipa')
+FREEIPA_SOURCE_MNT_POINT = os.path.join('/', 'freeipa-source')
 SYS_FS_CGROUP = os.path.join('/', 'sys', 'fs', 'cgroup')
 DEV_URANDOM = os.path.join('/', 'dev', 'urandom')
 DEV_RANDOM = os.path.join('/', 'dev', 'random')
@@ -27,10 +28,80 @@ DEFAULT_CONFIG_FILE = os.path.join(
     'config.yaml'
 )
 
+CACHE_ROOT = os.environ.get(
+    'XDG_CACHE_HOME', os.path.expanduser('~/.cache'))
+
+CACHE_DIR = os.path.join(CACHE_ROOT, APP_NAME)
+
 DEFAULT_IMAGE = 'martbab/freeipa-fedora-test-runner:master-latest'
 
 DEFAULT_GIT_REPO = '/path/to/repo'
 
+DEFAULT_DOCKER_URL = 'unix://var/run/docker.sock'
+
+# Dockerfiles shipped in the project git repo
+DEFAULT_DOCKERFILE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'data', 'dockerfiles')
+
+# inventory of Docker hosts along with the number of containers each of them
+# can run at once
+DEFAULT_HOSTS_CONFIG = [
+    {
+        'base_url': DEFAULT_DOCKER_URL,
+        'slots': 4
+    }
+]
+
+# number of steps of each resource class which may run at once on a Docker
+# host across all runner processes sharing the lock directory (0 = no limit)
+DEFAULT_ADMISSION_CONFIG = {
+    'lock_dir': '',
+    'build': 0,
+    'server_install': 0
+}
+
+# images built by the runner. When 'builddep' is set, the runs use the image
+# with build dependencies of the current spec file baked in (see the
+# 'build-image' subcommand) instead of running the 'builddep' step
+DEFAULT_IMAGES_CONFIG = {
+    'dockerfile_dir': '',
+    'repository': 'ipa-docker-test-runner',
+    'builddep': False
+}
+
+# steps after which the container is committed to a checkpoint image when
+# running with '--checkpoint' or '--resume'
+DEFAULT_CHECKPOINTS_CONFIG = {
+    'steps': ['builddep', 'build', 'install_packages', 'install_server',
+              'prepare_tests']
+}
+
+# readiness probe run after the container starts. The container is ready
+# when the last line of the probe output is one of 'ready_states' (or when the
+# probe succeeds if the list is empty). An empty command disables the probe
+DEFAULT_READINESS_CONFIG = {
+    'command': 'systemctl is-system-running',
+    'ready_states': ['running', 'degraded'],
+    'failed_states': ['maintenance', 'stopping'],
+    'timeout': 300
+}
+
+# build in a tmpfs of 'tmpfs_size' (e.g. '4g') mounted at the working
+# directory of the container. The git repo is then mounted at 'source_dir',
+# copied into the tmpfs before the build and only the built packages are
+# copied back. An empty size builds directly in the bind-mounted git repo
+DEFAULT_BUILD_DIR_CONFIG = {
+    'tmpfs_size': '',
+    'source_dir': FREEIPA_SOURCE_MNT_POINT
+}
+
+# OpenMetrics textfile re-written after each run with the metrics accumulated
+# from all runs (see `ipadocker.metrics`). Empty value disables the metrics
+DEFAULT_METRICS_CONFIG = {
+    'textfile': ''
+}
+
 DEFAULT_CONTAINER_CONFIG = {
     'image': DEFAULT_IMAGE,
     'hostname': 'master.ipa.test',
@@ -46,7 +117,13 @@ DEFAULT_HOST_CONFIG = {
     ],
     'tmpfs': [TMP, RUN],
     'privileged': False,
-    'security_opt': ['label:disable']
+    'security_opt': ['label:disable'],
+    # resource limits, e.g. '0-3', 200000 and '8g'. The number of parallel
+    # build jobs (${jobs}) is derived from them
+    'cpuset_cpus': '',
+    'cpu_quota': 0,
+    'cpu_period': 0,
+    'mem_limit': ''
 }
 
 DEFAULT_SERVER_CONFIG = {
@@ -65,18 +142,36 @@ DEFAULT_IPA_RUN_TEST_CONFIG = {
     'verbose': True
 }
 
+# test paths (relative to ipatests) which do not need a running server. They
+# are run in-tree by 'unit-tests' right after 'configure', 'run-tests' with
+# only such paths does the same
+DEFAULT_UNIT_TESTS_CONFIG = {
+    'paths': [
+        'test_ipalib',
+        'test_ipaplatform',
+        'test_ipapython',
+        'test_pkcs10',
+    ]
+}
+
 DEFAULT_STEP_CONFIG = {
+    'sync_sources': [
+        'cp -a ${source_dir}/. ${container_working_dir}/'
+    ],
     'builddep': [
         'dnf builddep -y ${builddep_opts} --spec freeipa.spec.in',
     ],
     'tox': [
-        'tox'
+        # -p needs tox 3.7 or newer
+        ('if [ ${jobs} -gt 1 ] && printf "3.7\\n%s\\n" '
+         '"$$(tox --version | cut -d" " -f1)" | sort -C -V; '
+         'then tox -p ${jobs}; else tox; fi')
     ],
     'configure': [
         'autoreconf -i && ./configure',
     ],
     'lint': [
-        'make lint'
+        'make -j${jobs} lint'
     ],
     'webui_unit': [
         'dnf install -y npm'
@@ -86,7 +181,11 @@ DEFAULT_STEP_CONFIG = {
          'node_modules/grunt/bin/grunt --verbose qunit')
     ],
     'build': [
-        'make ${make_target}'
+        'make -j${jobs} ${make_target}'
+    ],
+    'export_artifacts': [
+        'mkdir -p ${source_dir}/dist',
+        'cp -a ${container_working_dir}/dist/. ${source_dir}/dist/'
     ],
     'install_packages': [
         ('dnf install -y ${container_working_dir}/dist/rpms/*.rpm --best '
@@ -108,16 +207,83 @@ DEFAULT_STEP_CONFIG = {
     'run_tests': [
         'ipa-run-tests ${tests_ignore} ${tests_verbose} ${path}'
     ],
+    'latency_setup': [
+        ('printf "dn: cn=config\\nchangetype: modify\\n'
+         'replace: nsslapd-accesslog-logbuffering\\n'
+         'nsslapd-accesslog-logbuffering: off\\n" | '
+         'ldapmodify -x -D "cn=Directory Manager" -w ${server_password}'),
+        ('echo \'LogFormat "%h %t \\"%r\\" %>s %D" ipadocker_latency\' > '
+         '/etc/httpd/conf.d/zz-ipadocker-latency.conf'),
+        ('echo \'CustomLog logs/ipadocker_latency_log ipadocker_latency\' >> '
+         '/etc/httpd/conf.d/zz-ipadocker-latency.conf'),
+        'systemctl reload httpd'
+    ],
+    'profile_tests': [
+        'rm -rf ${profile_dir}/results',
+        ('PYTHONPATH=${profile_dir} ipa-run-tests -p ${profile_plugin} '
+         '--ipadocker-profile-dir=${profile_dir}/results --durations=25 '
+         '${tests_ignore} ${tests_verbose} ${path}')
+    ],
+    'unit_tests': [
+        'make ipasetup.py ipapython/version.py ipaplatform/override.py',
+        ('PYTHONPATH=${container_working_dir} python3 ipatests/ipa-run-tests '
+         '--skip-ipaapi ${tests_ignore} ${tests_verbose} ${path}')
+    ],
+    'bisect_update': [
+        'rm -rf ${container_working_dir}/dist/rpms',
+        'make -j${jobs} ${make_target}',
+        'rpm -Uvh --force --nodeps ${container_working_dir}/dist/rpms/*.rpm',
+        'ipa-server-upgrade'
+    ],
     'cleanup': [
-        'chown -R ${uid}:${gid} ${container_working_dir}'
+        'chown -R ${uid}:${gid} ${source_dir}'
     ]
 }
 
+# retry policies of the image pull and the commands of the steps. A failed
+# command is attempted again after 'backoff' seconds (doubled with every
+# further retry) if its exit code is one of 'exit_codes' or if the list is
+# empty. Pull is retried when it fails to reach the registry
+DEFAULT_RETRY_CONFIG = {
+    'attempts': 1,
+    'backoff': 10,
+    'exit_codes': []
+}
+
+# operations downloading packages which fail on network glitches
+NETWORK_OPERATIONS = ('pull', 'builddep', 'webui_unit', 'install_packages')
+
+DEFAULT_RETRIES_CONFIG = {
+    name: dict(DEFAULT_RETRY_CONFIG,
+               attempts=3 if name in NETWORK_OPERATIONS else 1,
+               exit_codes=list(DEFAULT_RETRY_CONFIG['exit_codes']))
+    for name in ['pull'] + list(DEFAULT_STEP_CONFIG)
+}
+
+# timeouts of the commands and steps in seconds, 0 means no timeout. The
+# processes of the command which timed out are killed, those that do not exit
+# within the grace period after SIGTERM are killed by SIGKILL
+DEFAULT_EXECUTION_CONFIG = {
+    'command_timeout': 0,
+    'step_timeouts': {step_name: 0 for step_name in DEFAULT_STEP_CONFIG},
+    'kill_grace_period': 10,
+    'retries': DEFAULT_RETRIES_CONFIG
+}
+
 DEFAULT_CONFIG = {
     'git_repo': DEFAULT_GIT_REPO,
+    'hosts': DEFAULT_HOSTS_CONFIG,
+    'admission': DEFAULT_ADMISSION_CONFIG,
+    'images': DEFAULT_IMAGES_CONFIG,
+    'checkpoints': DEFAULT_CHECKPOINTS_CONFIG,
+    'build_dir': DEFAULT_BUILD_DIR_CONFIG,
     'container': DEFAULT_CONTAINER_CONFIG,
     'host': DEFAULT_HOST_CONFIG,
+    'readiness': DEFAULT_READINESS_CONFIG,
     'server': DEFAULT_SERVER_CONFIG,
     'tests': DEFAULT_IPA_RUN_TEST_CONFIG,
-    'steps': DEFAULT_STEP_CONFIG
+    'unit_tests': DEFAULT_UNIT_TESTS_CONFIG,
+    'steps': DEFAULT_STEP_CONFIG,
+    'execution': DEFAULT_EXECUTION_CONFIG,
+    'metrics': DEFAULT_METRICS_CONFIG
 }
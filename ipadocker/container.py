@@ -7,98 +7,479 @@ Class encapsulating the state and operations on an IPA container
 
 import copy
 import logging
+import time
+
+from ipadocker import aio, command, events, report, resources
+
+# bounds of the interval between the readiness probes, in seconds
+PROBE_INTERVAL_MIN = 0.1
+PROBE_INTERVAL_MAX = 2.0
+
+
+class ContainerNotReady(Exception):
+    """
+    Raised when the container does not become ready after start
+
+    :param state: the last state reported by the readiness probe
+    :param reason: why the container is considered not ready
+    """
+    def __init__(self, state, reason):
+        self.state = state
+        super(ContainerNotReady, self).__init__(
+            "Container is not ready ({}): {}".format(
+                state or 'unknown state', reason))
+
+
+def build_in_tmpfs(config):
+    """
+    Whether the sources are built in a tmpfs instead of the bind-mounted git
+    repo (see the 'build_dir' config section)
+    """
+    return bool(config['build_dir']['tmpfs_size'])
+
+
+def source_dir(config):
+    """
+    Return the directory in the container where the git repo is mounted
+    """
+    if build_in_tmpfs(config):
+        return config['build_dir']['source_dir']
+
+    return config['container']['working_dir']
 
 
 def _bind_git_repo(config):
     binds = config['host']['binds']
     git_repo = config['git_repo']
-    working_dir = config['container']['working_dir']
 
-    binds.append(':'.join([git_repo, working_dir, 'rw,Z']))
+    binds.append(':'.join([git_repo, source_dir(config), 'rw,Z']))
 
+    if build_in_tmpfs(config):
+        config['host']['tmpfs'].append('{}:rw,exec,size={}'.format(
+            config['container']['working_dir'],
+            config['build_dir']['tmpfs_size']))
 
-def create_container(docker_client, config, logger):
+
+async def image_exists_async(docker_client, image):
+    """
+    Whether the image is present on the Docker host
+
+    :param docker_client: Docker client, synchronous or asynchronous
+    """
+    try:
+        await aio.async_client(docker_client).inspect_image(image)
+    except Exception:
+        return False
+
+    return True
+
+
+async def create_container_async(docker_client, config, logger,
+                                 run_report=None, known_images=()):
     """
     Create container. If the image specified from the passed in config is not
-    found, it will be pulled from Docker hub.
+    found, it will be pulled from Docker hub. The images built or committed
+    locally (e.g. builddep images, checkpoints) are never pulled, they are not
+    in any registry.
 
-    :param docker_client: Instance of Docker client
+    :param docker_client: Instance of Docker client, either synchronous or
+        `ipadocker.aio.AsyncDockerClient`
     :param config: instance of IPADockerConfig
     :param logger: logger instance
+    :param run_report: RunReport instance recording the time of the pull and
+        the creation, if any
+    :param known_images: images known to be present on the Docker host, they
+        are not looked up
     """
+    docker_client = aio.async_client(docker_client)
 
-    image = config['container']['image']
     logger.info(
-        "Creating container from %s", image)
-
-    logger.info("Pulling image %s, this may take several minutes.", image)
-    output = docker_client.pull(image)
-    logger.debug(output)
+        "Creating container from %s", config['container']['image'])
+    await pull_image_async(docker_client, config, logger,
+                           run_report=run_report, known_images=known_images)
 
-    logger.info("Image pulled in successfuly.")
-
-    result = docker_client.create_container(
-        host_config=docker_client.create_host_config(
-            **config['host']),
+    started = time.time()
+    host_config = await docker_client.create_host_config(
+        **resources.host_config_options(config['host']))
+    result = await docker_client.create_container(
+        host_config=host_config,
         **config['container'])
 
+    if run_report is not None:
+        run_report.add_startup_stage('create', started)
+
     return result['Id']
 
 
+async def pull_image_async(docker_client, config, logger, run_report=None,
+                           known_images=()):
+    """
+    Pull the image of the container unless it is present on the Docker host.
+    See `create_container_async` for the parameters
+    """
+    docker_client = aio.async_client(docker_client)
+
+    image = config['container']['image']
+    if (image in known_images or
+            await image_exists_async(docker_client, image)):
+        logger.info("Image %s is present on the Docker host", image)
+    else:
+        logger.info("Pulling image %s, this may take several minutes.", image)
+        retry_policy = command.RetryPolicy.from_config(
+            config['execution']['retries']['pull'])
+        started = time.time()
+        output = await retry_policy.run(docker_client.pull, image)
+        logger.debug(output)
+
+        if run_report is not None:
+            run_report.pull_time = time.time() - started
+            run_report.add_startup_stage('pull', started)
+
+        logger.info("Image pulled in successfuly.")
+
+
+def create_container(docker_client, config, logger):
+    """
+    Synchronous version of `create_container_async`
+    """
+    return aio.run(create_container_async(docker_client, config, logger))
+
+
 class IPAContainer:
     """
     Class which encapsulates the creation and manipulation of a Docker
     container. The configuration is passed as a IPADockerConfig instance (see
     `ipadocker.config` module)
 
+    The container is created and started during instantiation. Use the
+    `create` coroutine to do that from asynchronous code. All operations on
+    the container have asynchronous variants (suffixed by `_async`), the
+    synchronous methods are thin wrappers around them.
+
+    After the start, the readiness probe from the 'readiness' config section is
+    polled until the init system in the container finishes booting. The
+    container which does not become ready is removed.
+
     :param docker_client: Docker Client API instance
     :param config: IPADockerConfig instance
+    :param start: whether to create and start the container right away
+    :param run_report: RunReport instance collecting the results of the run.
+        A new one is created if not specified
     """
 
-    def __init__(self, docker_client, config):
+    def __init__(self, docker_client, config, start=True, run_report=None):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.docker_client = docker_client
+        self.async_client = aio.async_client(docker_client)
 
         # create a deep copy of the config. We want to add git repo to binds
         # without changing the format of original config
         self.config = copy.deepcopy(config)
         _bind_git_repo(self.config)
 
+        self.report = run_report or report.RunReport(
+            image=self.config['container']['image'])
+        self.container_id = None
+        # DockerHost the container was placed on (see `ipadocker.scheduler`)
+        self.host = None
+        # number of parallel build jobs fitting into the container limits,
+        # refined from the Docker host resources once the container starts
+        self.jobs = resources.parallel_jobs(self.config['host'])
+        # Checkpoint instance recording the completed steps, if enabled (see
+        # `ipadocker.checkpoint`)
+        self.checkpoint = None
+        # commands of the steps completed in the container keyed by step name
+        # when the container is re-used by several runs, None otherwise
+        self.completed_steps = None
+        # future of the watcher resolved to the 'State' of the container when
+        # it dies (see `watch`)
+        self.watcher = None
+        # 'State' of the container which died, None if it did not
+        self.death = None
+
+        if start:
+            aio.run(self.start_async())
+
+    @classmethod
+    async def create(cls, docker_client, config, run_report=None, host=None):
+        """
+        Asynchronously instantiate, create and start the container
+
+        :param host: DockerHost instance the container is placed on
+        :returns: IPAContainer instance
+        """
+        ipacontainer = cls(
+            docker_client, config, start=False, run_report=run_report)
+        ipacontainer.host = host
+        await ipacontainer.start_async()
+        return ipacontainer
+
+    async def start_async(self):
+        """
+        Create the container and start it. The container is removed if it
+        does not become ready or the start is cancelled
+        """
+        import asyncio
+
         self.logger.info(
             "Creating container from %s", self.config['container']['image'])
 
-        self.container_id = create_container(
-            self.docker_client, self.config, self.logger)
+        self.container_id = await create_container_async(
+            self.async_client, self.config, self.logger,
+            run_report=self.report,
+            known_images=self.host.images if self.host is not None else ())
 
         self.logger.info("SUCCESS")
+        events.emit('container_create', container_id=self.container_id,
+                    image=self.config['container']['image'])
 
         self.logger.info("Starting container ID: %s", self.container_id)
-        response = self.docker_client.start(container=self.container_id)
-        self.logger.debug("API response: %s", response)
+        started = time.time()
+        try:
+            response = await self.async_client.start(
+                container=self.container_id)
+            self.logger.debug("API response: %s", response)
+            self.report.add_startup_stage('start', started)
+
+            # the Docker host is queried while the container boots. The boot
+            # is timed from the return of the start call, not from its start
+            self.jobs, _ready = await aio.gather_all(
+                self._host_resources_async(),
+                self.wait_until_ready_async())
+        except ContainerNotReady as e:
+            self.logger.error("%s", e)
+            await self.stop_and_remove_async()
+            raise
+        except asyncio.CancelledError:
+            # e.g. the preparation of the run failed meanwhile
+            await self.stop_and_remove_async()
+            raise
+
+        self.logger.info("Using %d parallel build jobs", self.jobs)
+        self.watch()
+
+        events.emit('container_ready', container_id=self.container_id,
+                    boot_time=self.report.boot_time, jobs=self.jobs)
+
+    def watch(self):
+        """
+        Start watching the container for its death. The commands run in the
+        container are aborted as soon as it stops, they do not wait for their
+        output streams which may hang in such case
+        """
+        import asyncio
+
+        # the replayed session has the calls in the recorded order, waiting
+        # for the end of the container would take them out of turn
+        if (self.watcher is not None or
+                not getattr(self.docker_client, 'watch_containers', True)):
+            return
+
+        self.watcher = asyncio.ensure_future(self._watch_async())
+
+    def unwatch(self):
+        """
+        Stop watching the container, e.g. before it is stopped on purpose
+        """
+        if self.watcher is not None and not self.watcher.done():
+            self.watcher.cancel()
+
+    async def _watch_async(self):
+        import asyncio
+
+        try:
+            await aio.run_in_thread(self.docker_client.wait, self.container_id)
+            state = (await self.inspect_async())['State']
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.debug("Cannot watch the container: %s", e)
+            return None
+
+        self.death = state
+        self.logger.error(
+            "Container %s %s with exit code %s%s", self.container_id,
+            'was OOM killed' if state.get('OOMKilled') else
+            state.get('Status', 'died'),
+            state.get('ExitCode'),
+            ': {}'.format(state['Error']) if state.get('Error') else '')
+        events.emit('container_died', container_id=self.container_id,
+                    status=state.get('Status'),
+                    exit_code=state.get('ExitCode'),
+                    oom_killed=bool(state.get('OOMKilled')),
+                    error=state.get('Error') or None)
+        return state
+
+    async def probe_async(self):
+        """
+        Run the readiness probe
+
+        :returns: tuple of the probe exit code and the reported state
+        """
+        exit_code, output = await command.exec_output_async(
+            self.async_client, self.container_id,
+            self.config['readiness']['command'])
+
+        lines = output.strip().splitlines()
+        return exit_code, lines[-1].strip() if lines else ''
+
+    async def wait_until_ready_async(self, started=None):
+        """
+        Poll the readiness probe with increasing interval until the container
+        is ready and record the boot time in the report
+
+        :param started: time when the container was started. Defaults to now
+        :raises: ContainerNotReady if the probe reports failed state, the
+            container stops or the timeout expires
+        """
+        import asyncio
+
+        readiness = self.config['readiness']
+        if not readiness['command']:
+            return
+
+        started = started or time.time()
+        deadline = started + readiness['timeout']
+        interval = PROBE_INTERVAL_MIN
+
+        self.logger.info("Waiting for the container to boot")
+        while True:
+            try:
+                exit_code, state = await self.probe_async()
+            except Exception as e:
+                # the exec may fail early during boot
+                self.logger.debug("Readiness probe failed: %s", e)
+                exit_code, state = None, ''
+
+            if readiness['ready_states']:
+                ready = state in readiness['ready_states']
+            else:
+                ready = exit_code == 0
+
+            if ready:
+                break
+
+            if state in readiness['failed_states']:
+                raise ContainerNotReady(state, "boot failed")
+
+            if time.time() + interval > deadline:
+                raise ContainerNotReady(
+                    state, "timed out after {} seconds".format(
+                        readiness['timeout']))
+
+            container_state = (await self.inspect_async())['State']
+            if container_state['Status'] != 'running':
+                raise ContainerNotReady(
+                    state, "container {} with exit code {}".format(
+                        container_state['Status'],
+                        container_state.get('ExitCode')))
+
+            self.logger.debug("Container state: %s", state or 'unknown')
+            await asyncio.sleep(interval)
+            interval = min(interval * 2, PROBE_INTERVAL_MAX)
+
+        self.report.boot_time = time.time() - started
+        self.report.add_startup_stage('boot', started)
+        self.logger.info(
+            "Container is ready (%s) after %.1f seconds", state or 'probe OK',
+            self.report.boot_time)
+
+    async def parallel_jobs_async(self):
+        """
+        Return the number of parallel build jobs fitting into the CPU and
+        memory available to the container on its Docker host
+        """
+        try:
+            info = await self.async_client.info()
+        except Exception as e:
+            self.logger.warning(
+                "Cannot get Docker host resources, using local ones: %s", e)
+            return resources.parallel_jobs(self.config['host'])
+
+        return resources.parallel_jobs(
+            self.config['host'],
+            host_cpus=info.get('NCPU'),
+            host_memory=info.get('MemTotal'))
+
+    async def _host_resources_async(self):
+        started = time.time()
+        jobs = await self.parallel_jobs_async()
+        self.report.add_startup_stage('resources', started)
+        return jobs
+
+    async def inspect_async(self):
+        """
+        Return the low-level information about the container
+        """
+        return await self.async_client.inspect_container(self.container_id)
 
     @property
     def status(self):
         """
         Return container status (Running, Dead, etc.)
         """
-        return self.docker_client.inspect_container(
-            self.container_id)['State']['Status']
+        return aio.run(self.inspect_async())['State']['Status']
+
+    async def commit_async(self, repository, tag):
+        """
+        Commit the current state of the container to an image
+
+        :returns: name of the image
+        """
+        response = await self.async_client.commit(
+            self.container_id, repository=repository, tag=tag)
+        self.logger.debug("API response: %s", response)
+
+        return '{}:{}'.format(repository, tag)
+
+    async def get_archive_async(self, path):
+        """
+        Copy a file or directory from the container
+
+        :returns: tar archive of the path as bytes
+        """
+        def read_archive():
+            stream, _stat = self.docker_client.get_archive(
+                self.container_id, path)
+            return stream.read()
+
+        return await aio.run_blocking(read_archive)
+
+    async def stop_async(self):
+        """
+        Coroutine variant of `stop`
+        """
+        self.unwatch()
+        await self.async_client.stop(self.container_id)
 
     def stop(self):
         """
         Stop the running container
         """
-        self.docker_client.stop(self.container_id)
+        aio.run(self.stop_async())
+
+    async def remove_async(self):
+        """
+        Coroutine variant of `remove`
+        """
+        await self.async_client.remove_container(self.container_id)
+        events.emit('container_remove', container_id=self.container_id)
 
     def remove(self):
         """
         Remove the container
         """
-        self.docker_client.remove_container(self.container_id)
+        aio.run(self.remove_async())
+
+    async def stop_and_remove_async(self):
+        """
+        Coroutine variant of `stop_and_remove`
+        """
+        await self.stop_async()
+        await self.remove_async()
 
     def stop_and_remove(self):
         """
         Convenience method that stops and removes running container
         """
-        self.stop()
-        self.remove()
+        aio.run(self.stop_and_remove_async())
@@ -0,0 +1,162 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Machine-readable stream of the run events
+
+When enabled (see `--events`), every event of the run is written to a file as
+a single line of JSON with the 'event' name, the 'time' and event-specific
+fields, e.g.:
+
+    {"event":"step_start","time":1489061203.12,"step":"build",...}
+
+The events are:
+
+* run_start, run_end: the action run by `run_action`
+* container_create, container_ready, container_remove: container lifecycle
+* container_died: the container stopped unexpectedly, with its status, exit
+  code, OOM flag and error
+* step_start, step_end: steps run by `run_step`
+* cache_hit: a step skipped because it was done before the checkpoint the run
+  resumed from or earlier in the same warm container
+* command_start, command_end: commands run by `exec_command`, with the exit
+  code and the number of output bytes and chunks
+* output: output of a running command. By default only the number of bytes
+  and chunks received since the previous output event, at most every
+  `OUTPUT_INTERVAL` seconds. With `--events-output` every chunk is reported
+  along with its text
+
+The stream is buffered. Output events stay in the buffer until it fills up
+or another event arrives, the other events are flushed right away so that the
+consumers (e.g. CI dashboards) see them without delay.
+"""
+
+import atexit
+import json
+import time
+
+# size of the write buffer in bytes
+BUFFER_SIZE = 64 * 1024
+
+# minimal interval between output events of a command in seconds
+OUTPUT_INTERVAL = 1.0
+
+_stream = None
+
+
+class EventStream:
+    """
+    Writer of the events into a file object
+
+    :param fileobj: file object open for writing text
+    :param output_text: whether to report every output chunk with its text
+    """
+    def __init__(self, fileobj, output_text=False):
+        self.fileobj = fileobj
+        self.output_text = output_text
+        self._encoder = json.JSONEncoder(separators=(',', ':'))
+
+    def write(self, event, fields, flush=True):
+        fields['event'] = event
+        fields['time'] = time.time()
+        self.fileobj.write(self._encoder.encode(fields))
+        self.fileobj.write('\n')
+        if flush:
+            self.fileobj.flush()
+
+    def close(self):
+        self.fileobj.close()
+
+
+class OutputCounter:
+    """
+    Counter of the output of a single command, reporting it as output events
+
+    :param container_id: ID of the container running the command
+    """
+    def __init__(self, container_id):
+        self.container_id = container_id
+        self.bytes = 0
+        self.chunks = 0
+        self._pending_bytes = 0
+        self._pending_chunks = 0
+        self._last_report = time.time()
+
+    def add(self, chunk):
+        """
+        Count the output chunk
+        """
+        self.bytes += len(chunk)
+        self.chunks += 1
+
+        if _stream is None:
+            return
+
+        if _stream.output_text:
+            _stream.write(
+                'output',
+                {'container_id': self.container_id, 'bytes': len(chunk),
+                 'chunks': 1, 'text': chunk.decode(errors='replace')},
+                flush=False)
+            return
+
+        self._pending_bytes += len(chunk)
+        self._pending_chunks += 1
+        if time.time() - self._last_report >= OUTPUT_INTERVAL:
+            self.report()
+
+    def report(self):
+        """
+        Emit the output event for the chunks counted since the last one
+        """
+        if _stream is not None and self._pending_chunks:
+            _stream.write(
+                'output',
+                {'container_id': self.container_id,
+                 'bytes': self._pending_bytes,
+                 'chunks': self._pending_chunks},
+                flush=False)
+
+        self._pending_bytes = 0
+        self._pending_chunks = 0
+        self._last_report = time.time()
+
+
+def open_stream(filename, output_text=False):
+    """
+    Start writing the events into a file. File descriptors inherited from
+    the caller can be used via '/dev/fd/N'
+
+    :param filename: name of the file, it is truncated
+    :param output_text: whether to report every output chunk with its text
+    :raises: OSError if the file can not be opened
+    """
+    global _stream
+
+    close_stream()
+    _stream = EventStream(
+        open(filename, 'w', buffering=BUFFER_SIZE), output_text=output_text)
+    atexit.register(close_stream)
+
+
+def close_stream():
+    """
+    Flush and close the event stream, if any
+    """
+    global _stream
+
+    if _stream is not None:
+        stream, _stream = _stream, None
+        stream.close()
+
+
+def enabled():
+    return _stream is not None
+
+
+def emit(event, **fields):
+    """
+    Write the event into the stream. Does nothing if the stream is not open
+    """
+    if _stream is not None:
+        _stream.write(event, fields)
@@ -0,0 +1,126 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Control of `git bisect` in a checkout of the git repo
+
+The bisection is driven step by step (`git bisect good/bad/skip`) instead of
+by `git bisect run`, so that the runner can keep a single container with the
+installed server for all the tested commits
+"""
+
+import logging
+import re
+import subprocess
+
+logger = logging.getLogger(__name__)
+
+GOOD = 'good'
+BAD = 'bad'
+SKIP = 'skip'
+
+
+class BisectError(Exception):
+    """
+    Raised when git refuses to bisect
+    """
+
+
+def _bisect(repo, *args):
+    """
+    Run 'git bisect' subcommand
+
+    :returns: tuple of the exit code and the output
+    """
+    cmd = ['git', '-C', repo, 'bisect'] + list(args)
+    try:
+        result = subprocess.run(
+            cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError as e:
+        raise BisectError("'{}' failed: {}".format(' '.join(cmd), e))
+
+    return result.returncode, result.stdout.decode().strip()
+
+
+class GitBisect:
+    """
+    Bisection of the commits between a good and a bad one
+
+    :param repo: path to the git repo. The bisection checks out the tested
+        commits in it
+    """
+    def __init__(self, repo):
+        self.repo = repo
+        self.first_bad = None
+        # commits which may be the first bad one when the bisection ended
+        # because of skipped commits
+        self.candidates = []
+        self.finished = False
+
+    def current(self):
+        """
+        Return the ID of the commit to test
+        """
+        return subprocess.check_output(
+            ['git', '-C', self.repo, 'rev-parse', 'BISECT_HEAD']
+        ).decode().strip()
+
+    def start(self, good, bad):
+        """
+        Start the bisection and check out the first commit to test. The
+        working tree is updated by the runner, not by git, see `_checkout`
+
+        :param good: commit known to be good
+        :param bad: commit known to be bad
+        :raises: BisectError if git can not bisect the range
+        """
+        exit_code, output = _bisect(
+            self.repo, 'start', '--no-checkout', bad, good)
+        if exit_code:
+            raise BisectError(output)
+
+        self._checkout()
+        logger.info(output.splitlines()[-1] if output else "Bisecting")
+
+    def _checkout(self):
+        """
+        Check out BISECT_HEAD, the commit selected by git. Changes to the
+        tracked files made by the build are discarded
+        """
+        try:
+            subprocess.check_call(
+                ['git', '-C', self.repo, 'checkout', '--quiet', '--force',
+                 '--detach', 'BISECT_HEAD'],
+                stdout=subprocess.DEVNULL)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise BisectError("Cannot check out the commit to test: {}".format(
+                e))
+
+    def mark(self, result):
+        """
+        Mark the current commit and check out the next one to test
+
+        :param result: one of GOOD, BAD or SKIP
+        :returns: True if the bisection finished
+        """
+        exit_code, output = _bisect(self.repo, result, 'BISECT_HEAD')
+
+        match = re.search(r'^([0-9a-f]{40}) is the first bad commit', output,
+                          re.MULTILINE)
+        if match is not None:
+            self.first_bad = match.group(1)
+            self.finished = True
+        elif 'only \'skip\'ped commits left' in output:
+            self.candidates = re.findall(r'^[0-9a-f]{40}$', output,
+                                         re.MULTILINE)
+            self.finished = True
+        elif exit_code:
+            raise BisectError(output)
+        else:
+            self._checkout()
+            logger.info(output.splitlines()[-1] if output else "Bisecting")
+
+        return self.finished
+
+    def reset(self):
+        _bisect(self.repo, 'reset')
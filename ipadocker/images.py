@@ -0,0 +1,300 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Building of the test runner images
+
+The image variants are built from the Dockerfiles shipped in `data/dockerfiles`
+(one directory per distribution, `Dockerfile.<variant>` files in it). The
+variants sharing a base image pull it only once and all builds re-use the
+layer cache of the Docker host, so only the layers which actually changed are
+rebuilt.
+
+On top of any image, a derived image with the build dependencies of the
+current `freeipa.spec.in` baked in can be built. It is tagged by the hash of
+the spec file, the base image and the `builddep` step, so it is rebuilt only
+when any of them changes, and the runs using it do not need to run `builddep`
+at all.
+"""
+
+import collections
+import io
+import logging
+import os
+import re
+
+# hashlib and tarfile are imported on first use in order to keep the startup
+# of the CLI fast
+
+from ipadocker import aio, command, constants
+
+logger = logging.getLogger(__name__)
+
+SPEC_FILE = 'freeipa.spec.in'
+
+# location of the spec file in the builddep image build
+BUILDDEP_DIR = '/root/builddep'
+
+BUILDDEP_DOCKERFILE = """\
+FROM {base_image}
+COPY {spec_file} {builddep_dir}/{spec_file}
+RUN cd {builddep_dir} && {commands} && dnf clean all && rm -rf {builddep_dir}
+LABEL org.freeipa.ipa-docker-test-runner.spec-hash="{spec_hash}"
+"""
+
+
+class ImageBuildError(Exception):
+    """
+    Raised when Docker fails to build the image
+
+    :param tag: tag of the image
+    :param message: error reported by Docker
+    """
+    def __init__(self, tag, message):
+        self.tag = tag
+        super(ImageBuildError, self).__init__(
+            "Failed to build image {}: {}".format(tag, message))
+
+
+Variant = collections.namedtuple(
+    'Variant', ['name', 'path', 'dockerfile', 'base_image'])
+
+
+def dockerfile_dir(config):
+    return (config['images']['dockerfile_dir'] or
+            constants.DEFAULT_DOCKERFILE_DIR)
+
+
+def base_image(dockerfile_path):
+    """
+    Return the image the Dockerfile is based on
+    """
+    with open(dockerfile_path) as dockerfile:
+        for line in dockerfile:
+            match = re.match(r'^\s*FROM\s+(\S+)', line, re.IGNORECASE)
+            if match is not None:
+                return match.group(1)
+
+    raise ValueError("No FROM instruction in {}".format(dockerfile_path))
+
+
+def find_variants(directory):
+    """
+    Find the image variants in the Dockerfile directory. `Dockerfile` in the
+    `fedora` subdirectory is the variant 'fedora', `Dockerfile.rawhide` is
+    the variant 'rawhide'
+
+    :returns: dict of Variant instances keyed by name
+    """
+    variants = {}
+    for distro in sorted(os.listdir(directory)):
+        distro_dir = os.path.join(directory, distro)
+        if not os.path.isdir(distro_dir):
+            continue
+
+        for filename in sorted(os.listdir(distro_dir)):
+            if filename == 'Dockerfile':
+                name = distro
+            elif filename.startswith('Dockerfile.'):
+                name = filename[len('Dockerfile.'):]
+            else:
+                continue
+
+            path = os.path.join(distro_dir, filename)
+            variants[name] = Variant(name, distro_dir, filename,
+                                     base_image(path))
+
+    return variants
+
+
+def variant_tag(config, variant):
+    return '{}:{}'.format(config['images']['repository'], variant.name)
+
+
+async def _build(docker_client, tag, **kwargs):
+    """
+    Build the image and log the build output
+
+    :raises: ImageBuildError if the build fails
+    """
+    docker_client = aio.async_client(docker_client)
+    errors = []
+
+    def log_output(chunk):
+        if 'error' in chunk:
+            errors.append(chunk['error'].strip())
+        elif 'stream' in chunk:
+            logger.debug(chunk['stream'].rstrip())
+
+    logger.info("Building image %s", tag)
+    output = await docker_client.build(
+        tag=tag, rm=True, forcerm=True, stream=True, decode=True, **kwargs)
+    await aio.consume(output, log_output)
+
+    if errors:
+        raise ImageBuildError(tag, errors[-1])
+
+    logger.info("Image %s built", tag)
+
+
+async def build_variants(docker_client, config, variants, pull=False,
+                         nocache=False):
+    """
+    Build the image variants. Base images are pulled once for all variants
+    using them, the layer cache of the Docker host is re-used unless
+    `nocache` is set
+
+    :param docker_client: Docker client, synchronous or asynchronous
+    :param config: IPADockerConfig instance
+    :param variants: list of Variant instances
+    :param pull: pull the newest versions of the base images first
+    :param nocache: do not use layer cache
+    :returns: list of the tags built
+    """
+    docker_client = aio.async_client(docker_client)
+
+    if pull:
+        for image in sorted({variant.base_image for variant in variants}):
+            logger.info("Pulling base image %s", image)
+            logger.debug(await docker_client.pull(image))
+
+    tags = []
+    for variant in sorted(variants, key=lambda v: (v.base_image, v.name)):
+        tag = variant_tag(config, variant)
+        await _build(docker_client, tag, path=variant.path,
+                     dockerfile=variant.dockerfile, nocache=nocache)
+        tags.append(tag)
+
+    return tags
+
+
+def builddep_commands(config, builddep_opts):
+    """
+    Render the commands of the 'builddep' step for the image build
+
+    :param config: IPADockerConfig instance
+    :param builddep_opts: options passed to 'dnf builddep'
+    """
+    resolved_cfg = config.resolve()
+    step = command.ExecutionStep(
+        resolved_cfg.templates['builddep'], resolved_cfg.flat,
+        builddep_opts=builddep_opts, jobs=1)
+
+    return step.commands
+
+
+def spec_hash(config, builddep_opts):
+    """
+    Compute the hash identifying the builddep image of the current spec file
+
+    :param config: IPADockerConfig instance
+    :param builddep_opts: options passed to 'dnf builddep'
+    :raises: OSError if the spec file can not be read
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    digest.update(config['container']['image'].encode())
+    for cmd in builddep_commands(config, builddep_opts):
+        digest.update(b'\0' + cmd.encode())
+
+    with open(os.path.join(config['git_repo'], SPEC_FILE), 'rb') as spec:
+        digest.update(b'\0' + spec.read())
+
+    return digest.hexdigest()
+
+
+def builddep_tag(config, spec_digest):
+    return '{}:builddep-{}'.format(
+        config['images']['repository'], spec_digest[:12])
+
+
+def builddep_context(config, builddep_opts, spec_digest):
+    """
+    Create the build context of the builddep image: the Dockerfile and the
+    spec file, without the rest of the git repo
+
+    :returns: file-like object with uncompressed tar archive
+    """
+    import tarfile
+
+    dockerfile = BUILDDEP_DOCKERFILE.format(
+        base_image=config['container']['image'],
+        spec_file=SPEC_FILE,
+        builddep_dir=BUILDDEP_DIR,
+        commands=' && '.join(builddep_commands(config, builddep_opts)),
+        spec_hash=spec_digest).encode()
+
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode='w') as tar:
+        dockerfile_info = tarfile.TarInfo('Dockerfile')
+        dockerfile_info.size = len(dockerfile)
+        tar.addfile(dockerfile_info, io.BytesIO(dockerfile))
+        tar.add(os.path.join(config['git_repo'], SPEC_FILE), arcname=SPEC_FILE)
+
+    context.seek(0)
+    return context
+
+
+async def build_builddep_image(docker_client, config, builddep_opts,
+                               nocache=False):
+    """
+    Build the image with the build dependencies of the current spec file on
+    top of the configured container image
+
+    :param docker_client: Docker client, synchronous or asynchronous
+    :param config: IPADockerConfig instance
+    :param builddep_opts: options passed to 'dnf builddep'
+    :param nocache: do not use layer cache
+    :returns: tag of the image
+    """
+    spec_digest = spec_hash(config, builddep_opts)
+    tag = builddep_tag(config, spec_digest)
+
+    await _build(aio.async_client(docker_client), tag,
+                 fileobj=builddep_context(config, builddep_opts, spec_digest),
+                 custom_context=True, nocache=nocache)
+
+    return tag
+
+
+def use_builddep_image(config, builddep_opts, docker_client=None):
+    """
+    Switch the container image to the builddep image of the current spec
+    file if the config asks for it
+
+    :param config: IPADockerConfig instance
+    :param builddep_opts: options passed to 'dnf builddep'
+    :param docker_client: synchronous Docker client of the host on which the
+        builddep image is looked up. If it is not there, the base image is
+        used. The image is not looked up if not specified
+    :returns: IPADockerConfig instance
+    """
+    if not config['images']['builddep']:
+        return config
+
+    try:
+        tag = builddep_tag(config, spec_hash(config, builddep_opts))
+    except OSError as e:
+        logger.warning(
+            "Cannot use builddep image, dependencies will be installed "
+            "during the run: %s", e)
+        return config.override({'images': {'builddep': False}})
+
+    if docker_client is not None:
+        import docker
+
+        try:
+            docker_client.inspect_image(tag)
+        except docker.errors.NotFound:
+            logger.warning(
+                "Builddep image %s does not exist, dependencies will be "
+                "installed during the run. Run 'build-image --builddep' to "
+                "build it", tag)
+            return config.override({'images': {'builddep': False}})
+        except Exception as e:
+            # the run reports the Docker host which can not be reached
+            logger.debug("Cannot look up builddep image %s: %s", tag, e)
+
+    logger.info("Using image %s with pre-installed build dependencies", tag)
+    return config.override({'container': {'image': tag}})
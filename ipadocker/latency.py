@@ -0,0 +1,305 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Server-side latency of the IPA API calls and LDAP operations
+
+With `run-tests --server-latency`, the `latency_setup` step enables the
+logging needed (unbuffered 389-ds access log, httpd access log with request
+durations) before the tests and the sizes of the server logs are noted.
+After the tests, the parts of the logs written during the run are read from
+the container and summarized:
+
+* IPA commands from the framework log lines in the httpd error log, e.g.
+  `[jsonserver_session] admin@IPA.TEST: user_add/1(...): SUCCESS etime=...`.
+  The durations are only available from the servers logging `etime`
+  (nanoseconds), otherwise the commands are just counted
+* HTTP requests from the httpd access log, by method and path
+* LDAP operations from the 389-ds access log, by operation type, along with
+  the slowest individual operations
+
+The summary is logged and stored in the run report (see `--report`).
+"""
+
+import logging
+import math
+import os
+import re
+
+from ipadocker import command
+
+logger = logging.getLogger(__name__)
+
+IPA_LOG = os.path.join('/', 'var', 'log', 'httpd', 'error_log')
+HTTPD_LOG = os.path.join('/', 'var', 'log', 'httpd', 'ipadocker_latency_log')
+DIRSRV_LOGS = os.path.join('/', 'var', 'log', 'dirsrv', 'slapd-*', 'access')
+
+# number of rows of each table in the summary
+TOP = 15
+
+_IPA_COMMAND_RE = re.compile(
+    r'\[(?:json|xml)server\w*\] \S+: (?P<command>\w+)(?:/\d+)?\(.*\): '
+    r'(?P<result>\w+)(?: etime=(?P<etime>\d+))?\s*$')
+
+_HTTPD_REQUEST_RE = re.compile(
+    r'"(?P<method>[A-Z]+) (?P<path>[^ ?"]+)[^"]*" (?P<status>\d+) '
+    r'(?P<usec>\d+)\s*$')
+
+_LDAP_OPERATION_RE = re.compile(
+    r'conn=(?P<conn>\d+) op=(?P<op>-?\d+) (?P<type>[A-Z]+)(?P<detail>.*)$')
+
+_LDAP_RESULT_RE = re.compile(
+    r'conn=(?P<conn>\d+) op=(?P<op>-?\d+) RESULT .*\betime=(?P<etime>[\d.]+)')
+
+
+def percentile(sorted_values, fraction):
+    """
+    Return the nearest-rank percentile of the sorted values
+    """
+    index = max(int(math.ceil(fraction * len(sorted_values))) - 1, 0)
+    return sorted_values[index]
+
+
+class LatencyStats:
+    """
+    Durations of the operations grouped by name
+    """
+    def __init__(self):
+        self.durations = {}
+        self.counts = {}
+
+    def add(self, name, duration=None):
+        """
+        Record an operation
+
+        :param name: name of the operation, e.g. the IPA command
+        :param duration: duration of the operation in seconds, if known
+        """
+        self.counts[name] = self.counts.get(name, 0) + 1
+        if duration is not None:
+            self.durations.setdefault(name, []).append(duration)
+
+    def summary(self):
+        """
+        :returns: list of dicts with the count and the percentiles of the
+            durations of each operation, the most time-consuming first
+        """
+        rows = []
+        for name, count in self.counts.items():
+            durations = sorted(self.durations.get(name, []))
+            row = {'name': name, 'count': count}
+            if durations:
+                row.update(
+                    total=sum(durations),
+                    p50=percentile(durations, 0.5),
+                    p90=percentile(durations, 0.9),
+                    p99=percentile(durations, 0.99),
+                    max=durations[-1])
+            rows.append(row)
+
+        return sorted(rows, key=lambda row: (-row.get('total', 0),
+                                             -row['count'], row['name']))
+
+
+def parse_ipa_log(lines):
+    """
+    Parse the IPA commands from the framework log
+
+    :returns: LatencyStats instance
+    """
+    stats = LatencyStats()
+    for line in lines:
+        match = _IPA_COMMAND_RE.search(line)
+        if match is None:
+            continue
+
+        etime = match.group('etime')
+        stats.add(match.group('command'),
+                  int(etime) / 1e9 if etime is not None else None)
+
+    return stats
+
+
+def parse_httpd_log(lines):
+    """
+    Parse the requests from the httpd access log with durations (%D)
+
+    :returns: LatencyStats instance
+    """
+    stats = LatencyStats()
+    for line in lines:
+        match = _HTTPD_REQUEST_RE.search(line)
+        if match is not None:
+            stats.add(
+                '{} {}'.format(match.group('method'), match.group('path')),
+                int(match.group('usec')) / 1e6)
+
+    return stats
+
+
+def parse_dirsrv_log(lines, top=TOP):
+    """
+    Parse the LDAP operations from the 389-ds access log
+
+    :returns: tuple of LatencyStats instance and the list of the slowest
+        operations
+    """
+    stats = LatencyStats()
+    operations = {}
+    slowest = []
+
+    for line in lines:
+        match = _LDAP_RESULT_RE.search(line)
+        if match is not None:
+            operation = operations.pop(
+                (match.group('conn'), match.group('op')), None)
+            if operation is None:
+                # started before the tests
+                continue
+
+            etime = float(match.group('etime'))
+            stats.add(operation[0], etime)
+            slowest.append({'name': operation[0],
+                            'detail': operation[1].strip(),
+                            'duration': etime})
+            continue
+
+        match = _LDAP_OPERATION_RE.search(line)
+        if match is not None and match.group('type') != 'RESULT':
+            operations[(match.group('conn'), match.group('op'))] = (
+                match.group('type'), match.group('detail'))
+
+    slowest.sort(key=lambda operation: -operation['duration'])
+    return stats, slowest[:top]
+
+
+def _format_ms(seconds):
+    if seconds is None:
+        return '-'
+
+    return '{:.1f}'.format(seconds * 1000)
+
+
+def format_table(title, rows, top=TOP):
+    """
+    Format the summary of the operations as a table
+
+    :returns: list of lines
+    """
+    lines = [title, '  {:<40} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+        'NAME', 'COUNT', 'P50 ms', 'P90 ms', 'P99 ms', 'MAX ms', 'TOTAL ms')]
+    for row in rows[:top]:
+        lines.append(
+            '  {:<40} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}'.format(
+                row['name'][:40], row['count'],
+                *[_format_ms(row.get(key))
+                  for key in ('p50', 'p90', 'p99', 'max', 'total')]))
+
+    return lines
+
+
+async def log_offsets(ipacontainer):
+    """
+    Return the current sizes of the server logs
+
+    :returns: dict of the sizes keyed by the path of the log
+    """
+    # a log missing at this point is read from the start
+    _exit_code, output = await command.exec_output_async(
+        ipacontainer.async_client, ipacontainer.container_id,
+        'stat -c "%s %n" {} {} {}'.format(IPA_LOG, HTTPD_LOG, DIRSRV_LOGS))
+
+    offsets = {}
+    for line in output.splitlines():
+        size, _sep, path = line.strip().partition(' ')
+        if size.isdigit() and path.startswith('/'):
+            offsets[path] = int(size)
+
+    return offsets
+
+
+async def read_log(ipacontainer, path, offset=0):
+    """
+    Read the part of the log after the offset from the container. Only that
+    part is transferred, the logs of a long-lived container may be large. The
+    log smaller than the offset was rotated meanwhile and is read whole
+
+    :returns: list of the lines or an empty list if there is no such log
+    """
+    import shlex
+
+    async def read_tail(offset):
+        exit_code, output = await command.exec_output_async(
+            ipacontainer.async_client, ipacontainer.container_id,
+            'stat -c %s {path} 2>/dev/null && '
+            'tail -c +{start} {path} 2>/dev/null'.format(
+                path=shlex.quote(path), start=offset + 1))
+        size, _sep, content = output.partition('\n')
+        if exit_code != 0 or not size.strip().isdigit():
+            raise ValueError("no such log")
+
+        return int(size), content
+
+    try:
+        size, content = await read_tail(offset)
+        if size < offset:
+            logger.warning(
+                "%s was rotated during the tests, reading it whole", path)
+            size, content = await read_tail(0)
+    except Exception as e:
+        logger.warning("Cannot read %s: %s", path, e)
+        return []
+
+    return content.splitlines()
+
+
+async def collect(ipacontainer, offsets):
+    """
+    Summarize the server logs written since the offsets were taken, log the
+    summary and store it in the run report
+
+    :param offsets: sizes of the logs returned by `log_offsets`
+    :returns: the summary or None if the logs can not be read
+    """
+    try:
+        _exit_code, output = await command.exec_output_async(
+            ipacontainer.async_client, ipacontainer.container_id,
+            'ls -1 {}'.format(DIRSRV_LOGS))
+    except Exception as e:
+        logger.warning("Cannot collect the server-side latency: %s", e)
+        return None
+
+    dirsrv_logs = [path for path in output.split() if path.startswith('/')]
+
+    ipa_stats = parse_ipa_log(
+        await read_log(ipacontainer, IPA_LOG, offsets.get(IPA_LOG, 0)))
+    httpd_stats = parse_httpd_log(
+        await read_log(ipacontainer, HTTPD_LOG, offsets.get(HTTPD_LOG, 0)))
+
+    ldap_lines = []
+    for path in dirsrv_logs:
+        ldap_lines.extend(
+            await read_log(ipacontainer, path, offsets.get(path, 0)))
+    ldap_stats, slowest_ldap = parse_dirsrv_log(ldap_lines)
+
+    summary = {
+        'ipa_commands': ipa_stats.summary(),
+        'http_requests': httpd_stats.summary(),
+        'ldap_operations': ldap_stats.summary(),
+        'slowest_ldap_operations': slowest_ldap
+    }
+
+    lines = (
+        format_table("IPA commands:", summary['ipa_commands']) +
+        format_table("HTTP requests:", summary['http_requests']) +
+        format_table("LDAP operations:", summary['ldap_operations']) +
+        ["Slowest LDAP operations:"] +
+        ['  {:>9} ms {} {}'.format(
+            _format_ms(operation['duration']), operation['name'],
+            operation['detail'])
+         for operation in slowest_ldap])
+    logger.info("Server-side latency during the tests:\n%s",
+                '\n'.join(lines))
+
+    ipacontainer.report.server_latency = summary
+    return summary
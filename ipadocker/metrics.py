@@ -0,0 +1,362 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Runner metrics in the OpenMetrics text format
+
+The metrics are collected from the run reports (see `ipadocker.report`) into
+histograms and counters labelled by the action and the image. Since most runs
+are separate processes, the metrics are accumulated in `metrics.json` in the
+cache directory and the OpenMetrics text is re-written from it after each run
+into the textfile set by `textfile` in the 'metrics' config section (e.g. for
+the textfile collector of the Prometheus node exporter). The file is updated
+under a `flock` so that the concurrent runners do not lose each other's
+updates (see `record_run`). The queue service can also serve the metrics over
+HTTP (see `serve_http`).
+"""
+
+import json
+import logging
+import os
+
+from ipadocker import constants, statefile
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+# upper bounds of the histogram buckets in seconds
+DURATION_BUCKETS = (1, 5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+
+def default_state_file():
+    return os.path.join(constants.CACHE_DIR, 'metrics.json')
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        # counts
+        return str(value)
+    elif value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value))
+
+
+def _format_labels(labels):
+    return ','.join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+                '\n', '\\n'))
+        for name, value in labels)
+
+
+class Metric:
+    """
+    Metric family with samples grouped by the values of its labels
+
+    :param name: name of the metric
+    :param help_text: description of the metric
+    :param unit: unit of the metric, the name must end with it
+    """
+    metric_type = None
+
+    def __init__(self, name, help_text, unit=None):
+        self.name = name
+        self.help_text = help_text
+        self.unit = unit
+        # values of the metric keyed by sorted tuples of (label, value) pairs
+        self.values = {}
+
+    def _value(self, labels):
+        key = tuple(sorted(labels.items()))
+        if key not in self.values:
+            self.values[key] = self.initial_value()
+
+        return self.values[key]
+
+    def initial_value(self):
+        raise NotImplementedError
+
+    def samples(self, labels, value):
+        """
+        Yield (suffix, labels, value) tuples of a single labelled value
+        """
+        raise NotImplementedError
+
+    def render(self):
+        """
+        :returns: list of the lines of the metric family
+        """
+        lines = [
+            '# TYPE {} {}'.format(self.name, self.metric_type),
+            '# HELP {} {}'.format(self.name, self.help_text)
+        ]
+        if self.unit is not None:
+            lines.append('# UNIT {} {}'.format(self.name, self.unit))
+
+        for labels in sorted(self.values):
+            for suffix, sample_labels, value in self.samples(
+                    labels, self.values[labels]):
+                lines.append('{}{}{{{}}} {}'.format(
+                    self.name, suffix, _format_labels(sample_labels),
+                    _format_value(value)))
+
+        return lines
+
+    def to_list(self):
+        return [[dict(labels), value] for labels, value in self.values.items()]
+
+    def load(self, values):
+        for labels, value in values:
+            self.values[tuple(sorted(labels.items()))] = value
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def initial_value(self):
+        return 0
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self._value(labels) + amount
+
+    def samples(self, labels, value):
+        yield '_total', labels, value
+
+
+class Histogram(Metric):
+    """
+    :param buckets: upper bounds of the buckets, the +Inf bucket is implied
+    """
+    metric_type = 'histogram'
+
+    def __init__(self, name, help_text, buckets, unit='seconds'):
+        super(Histogram, self).__init__(name, help_text, unit=unit)
+        self.buckets = tuple(buckets) + (float('inf'),)
+
+    def initial_value(self):
+        # number of the observations falling into each of the buckets (not
+        # cumulative), their sum and count
+        return {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+
+    def observe(self, value, **labels):
+        histogram = self._value(labels)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                histogram['buckets'][index] += 1
+                break
+
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+    def samples(self, labels, value):
+        cumulative = 0
+        for bound, count in zip(self.buckets, value['buckets']):
+            cumulative += count
+            bucket_labels = labels + (('le', _format_value(float(bound))),)
+            yield '_bucket', bucket_labels, cumulative
+
+        yield '_count', labels, value['count']
+        yield '_sum', labels, value['sum']
+
+
+class MetricsRegistry:
+    """
+    The metrics of the runner
+    """
+    def __init__(self):
+        self.runs = Counter(
+            'ipadocker_runs', "Finished runs by result")
+        self.steps = Counter(
+            'ipadocker_steps',
+            "Steps by result, 'resumed' and 'reused' steps were skipped "
+            "thanks to a checkpoint or a warm container")
+        self.step_duration = Histogram(
+            'ipadocker_step_duration_seconds', "Duration of the steps",
+            DURATION_BUCKETS)
+        self.command_duration = Histogram(
+            'ipadocker_command_duration_seconds',
+            "Duration of the commands run in the container",
+            DURATION_BUCKETS)
+        self.pull_duration = Histogram(
+            'ipadocker_image_pull_duration_seconds',
+            "Duration of the image pulls", DURATION_BUCKETS)
+        self.boot_duration = Histogram(
+            'ipadocker_container_boot_duration_seconds',
+            "Time between the start of the container and its readiness",
+            DURATION_BUCKETS)
+        self.exec_latency = Histogram(
+            'ipadocker_exec_latency_seconds',
+            "Round-trip latency of the Docker API calls creating and "
+            "inspecting the execs of the commands", LATENCY_BUCKETS)
+
+    @property
+    def metrics(self):
+        return [self.runs, self.steps, self.step_duration,
+                self.command_duration, self.pull_duration,
+                self.boot_duration, self.exec_latency]
+
+    def record_run(self, run_report, action_name, exit_code=0):
+        """
+        Record the results of the run
+
+        :param run_report: RunReport instance of the run
+        :param action_name: name of the action which was run
+        :param exit_code: exit code of the run
+        """
+        labels = {'action': action_name, 'image': run_report.image}
+
+        self.runs.inc(
+            result='success' if not exit_code else 'failure', **labels)
+
+        for step in run_report.steps:
+            if step.get('resumed'):
+                result = 'resumed'
+            elif step.get('reused'):
+                result = 'reused'
+            else:
+                result = 'success' if step['success'] else 'failure'
+                self.step_duration.observe(
+                    step['duration'], step=step['name'], **labels)
+
+            self.steps.inc(step=step['name'], result=result, **labels)
+
+        for cmd in run_report.commands:
+            self.command_duration.observe(cmd['duration'], **labels)
+            self.exec_latency.observe(cmd['latency'], **labels)
+
+        if run_report.pull_time is not None:
+            self.pull_duration.observe(run_report.pull_time, **labels)
+
+        if run_report.boot_time is not None:
+            self.boot_duration.observe(run_report.boot_time, **labels)
+
+    def render(self):
+        """
+        :returns: the metrics in the OpenMetrics text format
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        lines.append('# EOF')
+
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        return {metric.name: metric.to_list() for metric in self.metrics}
+
+    @classmethod
+    def load(cls, filename=None):
+        """
+        Load the accumulated metrics
+
+        :param filename: name of the file holding them (default:
+            `metrics.json` in the cache directory)
+        """
+        registry = cls()
+        try:
+            with open(filename or default_state_file(), 'r') as state_file:
+                state = json.load(state_file)
+
+            for metric in registry.metrics:
+                metric.load(state.get(metric.name, []))
+        except (OSError, ValueError, TypeError, KeyError) as e:
+            logger.debug("Cannot load metrics: %s", e)
+
+        return registry
+
+    def save(self, filename=None):
+        _write_atomic(filename or default_state_file(),
+                      json.dumps(self.to_dict()))
+
+    def write_textfile(self, filename):
+        _write_atomic(filename, self.render())
+
+
+def record_run(run_report, action_name, exit_code, textfile, filename=None):
+    """
+    Add the results of the run to the metrics accumulated by all runner
+    processes and re-write the metrics textfile
+
+    :param run_report: RunReport instance of the run
+    :param action_name: name of the action which was run
+    :param exit_code: exit code of the run
+    :param textfile: name of the metrics textfile
+    :param filename: name of the file holding the accumulated metrics
+        (default: `metrics.json` in the cache directory)
+    :returns: MetricsRegistry instance with the accumulated metrics, None if
+        they can not be updated
+    """
+    filename = filename or default_state_file()
+
+    try:
+        with statefile.locked(filename):
+            registry = MetricsRegistry.load(filename)
+            registry.record_run(run_report, action_name, exit_code)
+            registry.save(filename)
+    except OSError as e:
+        logger.warning("Cannot update metrics: %s", e)
+        return None
+
+    registry.write_textfile(textfile)
+    return registry
+
+
+def _write_atomic(filename, content):
+    try:
+        statefile.write_atomic(filename, content)
+    except OSError as e:
+        logger.warning("Cannot write metrics: %s", e)
+
+
+def parse_address(address):
+    """
+    Parse the 'HOST:PORT' address of the metrics endpoint
+
+    :returns: tuple of the host and the port
+    :raises: ValueError if the address is invalid
+    """
+    host, _sep, port = address.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+async def serve_http(registry, host, port):
+    """
+    Serve the metrics at /metrics over HTTP
+
+    :param registry: MetricsRegistry instance
+    :returns: asyncio Server instance
+    """
+    import asyncio
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+            # the headers of the request are not needed
+            while (await reader.readline()).strip():
+                pass
+
+            parts = request_line.decode(errors='replace').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and \
+                    parts[1].split('?')[0] == '/metrics':
+                status, content_type = '200 OK', CONTENT_TYPE
+                body = registry.render().encode()
+            else:
+                status, content_type = '404 Not Found', 'text/plain'
+                body = b'Not Found\n'
+
+            writer.write(
+                'HTTP/1.0 {}\r\nContent-Type: {}\r\n'
+                'Content-Length: {}\r\n\r\n'.format(
+                    status, content_type, len(body)).encode() + body)
+            await writer.drain()
+        except ConnectionError as e:
+            logger.debug("Metrics client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,158 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+pytest plugin profiling the tests module by module
+
+The plugin is copied into the container and loaded by `ipa-run-tests -p
+ipadocker_profile` when the tests are run with `--profile` (see
+`ipadocker.profiling`), so it must not import anything from ipadocker. The
+tests of every module run under cProfile while a sampling thread records the
+stacks of the test run. The following files are written into the directory
+given by `--ipadocker-profile-dir`:
+
+* `<module>.prof`: pstats of the module, e.g. `test_xmlrpc.test_user_plugin`
+* `<module>.collapsed`: sampled stacks of the module in the collapsed format
+  of flamegraph.pl (one `frame;frame;... count` line per stack)
+* `durations.txt`: durations of the setup, call and teardown of all tests,
+  slowest first
+"""
+
+import collections
+import cProfile
+import os
+import sys
+import threading
+
+import pytest
+
+# interval between the stack samples in seconds
+SAMPLE_INTERVAL = 0.01
+
+
+def module_name(nodeid):
+    """
+    Return the dotted name of the test module from the ID of the test
+    """
+    path = nodeid.split('::')[0]
+    if path.endswith('.py'):
+        path = path[:-len('.py')]
+
+    return path.replace('/', '.')
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(
+        code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class StackSampler:
+    """
+    Thread periodically sampling the stack of the thread running the tests
+
+    :param thread_id: identifier of the sampled thread
+    :param interval: interval between the samples in seconds
+    """
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        # module whose tests are running, nothing is sampled if None
+        self.module = None
+        # sample counts of the stacks keyed by module
+        self.stacks = collections.defaultdict(collections.Counter)
+
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            module = self.module
+            frame = sys._current_frames().get(self.thread_id)
+            if module is None or frame is None:
+                continue
+
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+
+            self.stacks[module][';'.join(reversed(stack))] += 1
+
+
+class ModuleProfiler:
+    """
+    Profiler of the test modules
+
+    :param output_dir: directory to write the results into
+    """
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.profiles = collections.OrderedDict()
+        self.durations = []
+        self.sampler = StackSampler(threading.current_thread().ident)
+
+    def pytest_sessionstart(self, session):
+        self.sampler.start()
+
+    @pytest.hookimpl(hookwrapper=True)
+    def pytest_runtest_protocol(self, item, nextitem):
+        module = module_name(item.nodeid)
+        profile = self.profiles.get(module)
+        if profile is None:
+            profile = self.profiles[module] = cProfile.Profile()
+
+        self.sampler.module = module
+        profile.enable()
+        yield
+        profile.disable()
+        self.sampler.module = None
+
+    def pytest_runtest_logreport(self, report):
+        self.durations.append((report.duration, report.when, report.nodeid))
+
+    def pytest_sessionfinish(self, session):
+        self.sampler.stop()
+
+        if not os.path.isdir(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        for module, profile in self.profiles.items():
+            profile.dump_stats(
+                os.path.join(self.output_dir, '{}.prof'.format(module)))
+
+            with open(os.path.join(self.output_dir,
+                                   '{}.collapsed'.format(module)),
+                      'w') as collapsed:
+                for stack, count in sorted(
+                        self.sampler.stacks[module].items()):
+                    collapsed.write('{} {}\n'.format(stack, count))
+
+        with open(os.path.join(self.output_dir, 'durations.txt'),
+                  'w') as durations:
+            for duration, when, nodeid in sorted(self.durations,
+                                                 reverse=True):
+                durations.write('{:10.3f}s {:<8} {}\n'.format(
+                    duration, when, nodeid))
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        '--ipadocker-profile-dir',
+        default=None,
+        help="profile the test modules and write the results into the "
+             "directory")
+
+
+def pytest_configure(config):
+    output_dir = config.getoption('ipadocker_profile_dir')
+    if output_dir:
+        config.pluginmanager.register(
+            ModuleProfiler(output_dir), 'ipadocker_module_profiler')
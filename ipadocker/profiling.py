@@ -0,0 +1,98 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Profiling of the test run in the container
+
+The pytest plugin from `ipadocker.profile_plugin` is copied into the
+container before the `profile_tests` step, which runs `ipa-run-tests` with
+it, and the profiles it writes are copied back to the host afterwards. Both
+copies use the archive API of Docker so nothing needs to be set up in the
+image.
+"""
+
+import io
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# directory in the container holding the plugin and the results. It must not
+# be on tmpfs, the archive API does not see into the tmpfs mounts
+PROFILE_DIR = os.path.join('/', 'var', 'tmp', 'ipadocker-profile')
+
+PLUGIN_MODULE = 'ipadocker_profile'
+
+RESULTS_DIR = os.path.join(PROFILE_DIR, 'results')
+
+
+def plugin_archive():
+    """
+    Return the tar archive of the profile directory with the plugin
+    """
+    import tarfile
+
+    plugin_file = os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'profile_plugin.py')
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        tar.add(plugin_file, arcname=os.path.join(
+            os.path.basename(PROFILE_DIR), '{}.py'.format(PLUGIN_MODULE)))
+
+    return archive.getvalue()
+
+
+async def install_plugin(ipacontainer):
+    """
+    Copy the plugin into the container
+    """
+    await ipacontainer.async_client.put_archive(
+        ipacontainer.container_id, os.path.dirname(PROFILE_DIR),
+        plugin_archive())
+
+
+def extract_results(archive, output_dir):
+    """
+    Extract the archive of the results directory into the output directory
+
+    :returns: list of the extracted files
+    """
+    import tarfile
+
+    extracted = []
+    prefix = os.path.basename(RESULTS_DIR) + '/'
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        for member in tar.getmembers():
+            name = os.path.basename(member.name)
+            if (not member.isfile() or not member.name.startswith(prefix) or
+                    name in ('', '.', '..')):
+                continue
+
+            filename = os.path.join(output_dir, name)
+            with open(filename, 'wb') as output_file:
+                output_file.write(tar.extractfile(member).read())
+            extracted.append(filename)
+
+    return extracted
+
+
+async def export_results(ipacontainer, output_dir):
+    """
+    Copy the profiling results from the container into the output directory.
+    Failures are logged, they do not fail the run
+
+    :returns: list of the exported files
+    """
+    try:
+        archive = await ipacontainer.get_archive_async(RESULTS_DIR)
+        os.makedirs(output_dir, exist_ok=True)
+        exported = extract_results(archive, output_dir)
+    except Exception as e:
+        logger.warning("Cannot export profiling results: %s", e)
+        return []
+
+    logger.info("Profiling results of %d test modules exported to %s",
+                len([name for name in exported if name.endswith('.prof')]),
+                output_dir)
+    return exported
@@ -0,0 +1,264 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Recording and replaying of Docker API sessions
+
+The recording is a gzip-compressed file of JSON lines. The first line is a
+header, every other line describes a single Docker API call: the method name,
+its arguments, the returned value (or raised exception), the time the call
+took and, for streamed exec output, the individual chunks along with the delay
+before each of them
+"""
+
+import collections
+import gzip
+import json
+import logging
+import threading
+import time
+
+from ipadocker import command
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+class ReplayError(Exception):
+    """
+    Raised when the replayed session does not match the calls made by the
+    runner
+    """
+
+
+class ReplayedAPIError(Exception):
+    """
+    Raised during replay in place of an exception raised by the original
+    Docker API call
+
+    :param error_class: name of the class of the original exception
+    :param message: message of the original exception
+    """
+    def __init__(self, error_class, message):
+        self.error_class = error_class
+        super(ReplayedAPIError, self).__init__(
+            "{}: {}".format(error_class, message))
+
+
+def _encode_value(value):
+    """
+    Make the return value of an API call JSON-serializable. Bytes are
+    preserved byte by byte using surrogate escapes
+    """
+    if isinstance(value, bytes):
+        return {'__bytes__': value.decode('utf-8', 'surrogateescape')}
+    elif isinstance(value, dict):
+        return {k: _encode_value(v) for k, v in value.items()}
+    elif isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+
+    return value
+
+
+def _decode_value(value):
+    """
+    Reverse the transformation done by `_encode_value`
+    """
+    if isinstance(value, dict):
+        if list(value) == ['__bytes__']:
+            return value['__bytes__'].encode('utf-8', 'surrogateescape')
+
+        return {k: _decode_value(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return [_decode_value(v) for v in value]
+
+    return value
+
+
+# calls which are not recorded since they are not made during the replay
+# (waiting for the container to stop, see `IPAContainer.watch`)
+UNRECORDED_METHODS = frozenset(['wait'])
+
+
+def _is_stream(method_name, kwargs):
+    return method_name == 'exec_start' and kwargs.get('stream', False)
+
+
+class RecordingClient:
+    """
+    A proxy around Docker client which records all API calls into a session
+    file
+
+    :param docker_client: Docker Client API instance to proxy the calls to
+    :param filename: name of the file to record the session into
+    """
+    def __init__(self, docker_client, filename):
+        self.docker_client = docker_client
+        self.filename = filename
+        self._output = gzip.open(filename, 'wt', encoding='utf-8')
+        # the calls are recorded from several threads at once
+        self._lock = threading.Lock()
+        self._write({
+            'version': FORMAT_VERSION,
+            'created': time.time(),
+            'base_url': getattr(docker_client, 'base_url', None)
+        })
+
+    def _write(self, record):
+        line = json.dumps(record, default=repr, separators=(',', ':'))
+
+        with self._lock:
+            if self._output.closed:
+                logger.debug("Recording closed, dropping record: %s", record)
+                return
+
+            self._output.write(line)
+            self._output.write('\n')
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        attr = getattr(self.docker_client, name)
+        if not callable(attr) or name in UNRECORDED_METHODS:
+            return attr
+
+        def record_call(*args, **kwargs):
+            record = {'method': name, 'args': args, 'kwargs': kwargs}
+            start = time.perf_counter()
+            try:
+                result = attr(*args, **kwargs)
+            except Exception as e:
+                record['elapsed'] = time.perf_counter() - start
+                record['error'] = [e.__class__.__name__, str(e)]
+                self._write(record)
+                raise
+
+            record['elapsed'] = time.perf_counter() - start
+
+            if _is_stream(name, kwargs):
+                return self._record_stream(record, result)
+
+            record['result'] = _encode_value(result)
+            self._write(record)
+            return result
+
+        return record_call
+
+    def _record_stream(self, record, stream):
+        chunks = record['chunks'] = []
+        last = time.perf_counter()
+
+        try:
+            for chunk in stream:
+                now = time.perf_counter()
+                chunks.append([now - last, _encode_value(chunk)])
+                last = now
+                yield chunk
+        finally:
+            self._write(record)
+
+    def close(self):
+        """
+        Finish the recording and close the underlying client
+        """
+        with self._lock:
+            closed = self._output.closed
+            self._output.close()
+
+        if not closed:
+            logger.info("Docker API session recorded to %s", self.filename)
+
+        close = getattr(self.docker_client, 'close', None)
+        if close is not None:
+            close()
+
+
+class ReplayClient:
+    """
+    A stand-in for Docker client which replays the API calls from a recorded
+    session. The calls are matched to the recorded ones by method name in the
+    order in which they were recorded
+
+    :param filename: name of the recorded session file
+    :param speed: replay speed relative to the recording, e.g. 2 replays
+        twice as fast. 0 replays without any delays
+    """
+    # the containers are not watched for their death during the replay
+    watch_containers = False
+
+    def __init__(self, filename, speed=1.0):
+        self.filename = filename
+        self.speed = speed
+        self._calls = collections.defaultdict(collections.deque)
+
+        with gzip.open(filename, 'rt', encoding='utf-8') as session:
+            header = json.loads(next(session))
+            if header.get('version') != FORMAT_VERSION:
+                raise ReplayError(
+                    "Unsupported session format version: {}".format(
+                        header.get('version')))
+
+            self.base_url = header.get('base_url')
+
+            for line in session:
+                record = json.loads(line)
+                self._calls[record['method']].append(record)
+
+        logger.info("Replaying Docker API session from %s", filename)
+
+    def _sleep(self, delay):
+        if self.speed and delay > 0:
+            time.sleep(delay / self.speed)
+
+    def _next_record(self, name, kwargs):
+        try:
+            record = self._calls[name].popleft()
+        except IndexError:
+            raise ReplayError(
+                "Unexpected Docker API call {}() not found in the "
+                "recorded session".format(name))
+
+        if name == 'exec_create':
+            recorded_cmd = record['kwargs'].get('cmd')
+            # the commands with timeout differ in the names of the pidfiles
+            if (command.normalize_command(kwargs.get('cmd')) !=
+                    command.normalize_command(recorded_cmd)):
+                logger.warning(
+                    "Replayed command differs from the recorded one: "
+                    "%s != %s", kwargs.get('cmd'), recorded_cmd)
+
+        return record
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def replay_call(*args, **kwargs):
+            record = self._next_record(name, kwargs)
+            self._sleep(record['elapsed'])
+
+            if 'error' in record:
+                raise ReplayedAPIError(*record['error'])
+
+            if 'chunks' in record:
+                return self._replay_stream(record['chunks'])
+
+            return _decode_value(record['result'])
+
+        return replay_call
+
+    def _replay_stream(self, chunks):
+        for delay, chunk in chunks:
+            self._sleep(delay)
+            yield _decode_value(chunk)
+
+    def close(self):
+        """
+        Finish the replay and report any calls which were not replayed
+        """
+        remaining = sum(len(calls) for calls in self._calls.values())
+        if remaining:
+            logger.warning(
+                "%d recorded Docker API calls were not replayed", remaining)
@@ -0,0 +1,351 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Run reports and the history of step durations collected from past runs
+"""
+
+import json
+import logging
+import os
+import statistics
+import time
+
+from ipadocker import constants, statefile
+
+logger = logging.getLogger(__name__)
+
+# number of most recent durations of each step that are kept in the history
+HISTORY_SIZE = 10
+
+
+def format_duration(seconds):
+    """
+    Format duration in seconds as a human readable string, e.g. '1h 02m 05s'
+    """
+    if seconds is None:
+        return '?'
+
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+
+    if hours:
+        return '{}h {:02d}m {:02d}s'.format(hours, minutes, seconds)
+    elif minutes:
+        return '{}m {:02d}s'.format(minutes, seconds)
+
+    return '{}s'.format(seconds)
+
+
+class RunReport:
+    """
+    Collects information about a single run of the runner, such as the
+    durations of the executed steps
+
+    :param image: name of the image the container was created from
+    """
+    def __init__(self, image=None):
+        self.image = image
+        self.steps = []
+        # seconds between the start of the container and its readiness
+        self.boot_time = None
+        # seconds the pull of the image took
+        self.pull_time = None
+        # durations of the executed commands and the round-trip latencies of
+        # the Docker API calls creating and inspecting their execs
+        self.commands = []
+        # summary of the server logs written during the tests, see
+        # `ipadocker.latency`
+        self.server_latency = None
+        # start and end times of the stages of the container startup, some of
+        # which run concurrently
+        self.startup_stages = []
+
+    def add_step(self, step_name, duration, success=True, **details):
+        """
+        Record an executed step
+
+        :param step_name: name of the step
+        :param duration: the wall-clock time the step took, in seconds
+        :param success: whether the step succeeded
+        :param details: additional information about the step, e.g. the time
+            it waited for admission
+        """
+        step = {
+            'name': step_name,
+            'duration': duration,
+            'success': success
+        }
+        step.update(details)
+        self.steps.append(step)
+
+    def add_command(self, duration, latency):
+        """
+        Record an executed command
+
+        :param duration: the wall-clock time the command took, in seconds
+        :param latency: time spent in the exec API calls, in seconds
+        """
+        self.commands.append({'duration': duration, 'latency': latency})
+
+    def add_startup_stage(self, stage_name, started, finished=None):
+        """
+        Record a stage of the startup, e.g. the image pull or the boot
+
+        :param stage_name: name of the stage
+        :param started: time when the stage started
+        :param finished: time when the stage finished. Defaults to now
+        """
+        self.startup_stages.append({
+            'name': stage_name,
+            'started': started,
+            'finished': finished if finished is not None else time.time()
+        })
+
+    @property
+    def startup_time(self):
+        """
+        The wall-clock time between the start of the first startup stage and
+        the end of the last one, None if no stage was recorded
+        """
+        if not self.startup_stages:
+            return None
+
+        return (max(stage['finished'] for stage in self.startup_stages) -
+                min(stage['started'] for stage in self.startup_stages))
+
+    @property
+    def startup_saved(self):
+        """
+        The time saved by running the startup stages concurrently instead of
+        one after another
+        """
+        if not self.startup_stages:
+            return None
+
+        total = sum(stage['finished'] - stage['started']
+                    for stage in self.startup_stages)
+        return max(total - self.startup_time, 0.0)
+
+    def to_dict(self):
+        result = {
+            'image': self.image,
+            'boot_time': self.boot_time,
+            'pull_time': self.pull_time,
+            'steps': self.steps,
+            'commands': self.commands
+        }
+        if self.server_latency is not None:
+            result['server_latency'] = self.server_latency
+
+        if self.startup_stages:
+            result['startup'] = {
+                'time': self.startup_time,
+                'saved': self.startup_saved,
+                'stages': [
+                    {'name': stage['name'],
+                     'duration': stage['finished'] - stage['started']}
+                    for stage in self.startup_stages
+                ]
+            }
+
+        return result
+
+    def log_summary(self):
+        """
+        Log the durations of the executed steps
+        """
+        if self.boot_time is not None:
+            logger.info(
+                "Container booted in %s", format_duration(self.boot_time))
+
+        if self.startup_stages:
+            logger.info(
+                "Startup took %s, %s saved by overlapping its stages",
+                format_duration(self.startup_time),
+                format_duration(self.startup_saved))
+
+        for step in self.steps:
+            if step.get('resumed') or step.get('reused'):
+                logger.info(
+                    "Step %-16s %-8s", step['name'],
+                    'RESUMED' if step.get('resumed') else 'REUSED')
+                continue
+
+            retries = step.get('retries')
+            logger.info(
+                "Step %-16s %-8s %s%s", step['name'],
+                'OK' if step['success'] else 'FAILED',
+                format_duration(step['duration']),
+                ' ({} retries)'.format(retries) if retries else '')
+
+    def write(self, output_file):
+        """
+        Dump the report as JSON
+
+        :param output_file: file-like object open for writing
+        """
+        json.dump(self.to_dict(), output_file, indent=2, sort_keys=True)
+
+
+class MatrixReport:
+    """
+    Combined results of the runs of one action with several images
+
+    :param action_name: name of the action
+    """
+    def __init__(self, action_name):
+        self.action_name = action_name
+        self.runs = []
+
+    def add_run(self, run_report, exit_code, duration):
+        """
+        Record the result of a run
+
+        :param run_report: RunReport instance of the run
+        :param exit_code: exit code of the run, 0 on success
+        :param duration: the wall-clock time the run took, in seconds
+        """
+        self.runs.append({
+            'report': run_report,
+            'exit_code': exit_code,
+            'duration': duration
+        })
+
+    @property
+    def exit_code(self):
+        """
+        Exit code of the first failed run or 0 if all runs succeeded
+        """
+        for run in self.runs:
+            if run['exit_code']:
+                return run['exit_code']
+
+        return 0
+
+    def format_table(self):
+        """
+        Format the results of the runs as a table
+
+        :returns: list of lines
+        """
+        width = max([len('IMAGE')] +
+                    [len(run['report'].image) for run in self.runs])
+        row = '  {:<' + str(width) + '}  {:<12} {:>12}  {}'
+
+        lines = [
+            "Results of '{}':".format(self.action_name),
+            row.format('IMAGE', 'RESULT', 'DURATION', 'FAILED STEP')
+        ]
+        for run in self.runs:
+            failed_steps = [step['name'] for step in run['report'].steps
+                            if not step['success']]
+
+            lines.append(row.format(
+                run['report'].image,
+                'OK' if not run['exit_code'] else
+                'FAILED ({})'.format(run['exit_code']),
+                format_duration(run['duration']),
+                ', '.join(failed_steps) or '-'))
+
+        return lines
+
+    def to_dict(self):
+        return {
+            'action': self.action_name,
+            'runs': [
+                dict(run['report'].to_dict(),
+                     exit_code=run['exit_code'],
+                     duration=run['duration'])
+                for run in self.runs
+            ]
+        }
+
+    def write(self, output_file):
+        """
+        Dump the report as JSON
+
+        :param output_file: file-like object open for writing
+        """
+        json.dump(self.to_dict(), output_file, indent=2, sort_keys=True)
+
+
+def default_history_file():
+    return os.path.join(constants.CACHE_DIR, 'step-durations.json')
+
+
+class StepHistory:
+    """
+    Durations of the steps executed in the past runs, grouped by container
+    image. Only the most recent `HISTORY_SIZE` durations of each step are
+    kept
+
+    :param filename: name of the file holding the history (default:
+        `step-durations.json` in the cache directory)
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or default_history_file()
+        self.durations = self._load()
+        # durations recorded since the history was loaded
+        self._recorded = []
+
+    def _load(self):
+        try:
+            with open(self.filename, 'r') as history_file:
+                return json.load(history_file)
+        except (OSError, ValueError) as e:
+            logger.debug("Cannot load step history: %s", e)
+            return {}
+
+    def _add(self, image, step_name, duration):
+        step_durations = self.durations.setdefault(
+            image, {}).setdefault(step_name, [])
+        step_durations.append(duration)
+        del step_durations[:-HISTORY_SIZE]
+
+    def record(self, image, step_name, duration):
+        self._add(image, step_name, duration)
+        self._recorded.append((image, step_name, duration))
+
+    def record_report(self, run_report):
+        """
+        Record the durations of all successful steps in the run report. Steps
+        skipped by a resumed run or done by a previous run in the same
+        container are left out
+        """
+        for step in run_report.steps:
+            if (step['success'] and not step.get('resumed') and
+                    not step.get('reused')):
+                self.record(run_report.image, step['name'], step['duration'])
+
+    def estimate(self, image, step_name):
+        """
+        Estimate the duration of the step as a median of its past durations
+
+        :returns: estimated duration in seconds or None if the step was not
+            run with this image yet
+        """
+        step_durations = self.durations.get(image, {}).get(step_name)
+        if not step_durations:
+            return None
+
+        return statistics.median(step_durations)
+
+    def save(self):
+        """
+        Add the recorded durations to the history saved by the other runs
+        meanwhile and save it
+        """
+        try:
+            with statefile.locked(self.filename):
+                self.durations = self._load()
+                for image, step_name, duration in self._recorded:
+                    self._add(image, step_name, duration)
+
+                statefile.write_atomic(
+                    self.filename, json.dumps(self.durations))
+        except OSError as e:
+            logger.warning("Cannot save step history: %s", e)
+            return
+
+        self._recorded = []
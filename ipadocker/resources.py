@@ -0,0 +1,116 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+CPU and memory limits of the containers and the number of parallel jobs
+derived from them
+"""
+
+import math
+import os
+import re
+
+# resource limits in the 'host' config section. They are passed to Docker
+# only when set
+LIMIT_OPTIONS = ('cpuset_cpus', 'cpu_quota', 'cpu_period', 'mem_limit')
+
+# CFS period used by Docker when 'cpu_period' is not set, in microseconds
+DEFAULT_CPU_PERIOD = 100000
+
+# memory needed by a single build job (compiler or pylint process)
+MEMORY_PER_JOB = 1024 ** 3
+
+_UNITS = {
+    'b': 1,
+    'k': 1024,
+    'm': 1024 ** 2,
+    'g': 1024 ** 3,
+}
+
+
+def host_config_options(host_config):
+    """
+    Return the options for `create_host_config` with unset resource limits
+    left out
+    """
+    return {
+        key: value for key, value in host_config.items()
+        if value or key not in LIMIT_OPTIONS
+    }
+
+
+def parse_bytes(value):
+    """
+    Parse memory size in the format accepted by Docker, e.g. '512m' or '4g'
+
+    :raises: ValueError if the size is invalid
+    """
+    if isinstance(value, int):
+        return value
+
+    match = re.match(r'^\s*(\d+)\s*([bkmg]?)b?\s*$', value, re.IGNORECASE)
+    if match is None:
+        raise ValueError("Invalid memory size: {}".format(value))
+
+    number, unit = match.groups()
+    return int(number) * _UNITS[unit.lower() or 'b']
+
+
+def parse_cpuset(cpuset):
+    """
+    Return the number of CPUs in a cpuset specification, e.g. '0-3,8'
+
+    :raises: ValueError if the specification is invalid
+    """
+    count = 0
+    for cpu_range in cpuset.split(','):
+        first, _sep, last = cpu_range.strip().partition('-')
+        try:
+            count += int(last or first) - int(first) + 1
+        except ValueError:
+            raise ValueError("Invalid cpuset: {}".format(cpuset))
+
+    return count
+
+
+def effective_cpus(host_config, host_cpus):
+    """
+    Return the number of CPUs the container can actually use
+
+    :param host_config: the 'host' config section
+    :param host_cpus: number of CPUs of the Docker host
+    """
+    cpus = host_cpus
+
+    if host_config.get('cpuset_cpus'):
+        cpus = min(cpus, parse_cpuset(host_config['cpuset_cpus']))
+
+    cpu_quota = host_config.get('cpu_quota')
+    if cpu_quota and cpu_quota > 0:
+        cpu_period = host_config.get('cpu_period') or DEFAULT_CPU_PERIOD
+        cpus = min(cpus, math.ceil(cpu_quota / cpu_period))
+
+    return max(cpus, 1)
+
+
+def parallel_jobs(host_config, host_cpus=None, host_memory=None):
+    """
+    Return the number of parallel build jobs which fit into the limits of the
+    container
+
+    :param host_config: the 'host' config section
+    :param host_cpus: number of CPUs of the Docker host. Defaults to the CPUs
+        of the local machine
+    :param host_memory: memory of the Docker host in bytes, if known
+    """
+    jobs = effective_cpus(host_config, host_cpus or os.cpu_count() or 1)
+
+    memory = host_memory
+    if host_config.get('mem_limit'):
+        mem_limit = parse_bytes(host_config['mem_limit'])
+        memory = min(memory, mem_limit) if memory else mem_limit
+
+    if memory:
+        jobs = min(jobs, memory // MEMORY_PER_JOB)
+
+    return max(jobs, 1)
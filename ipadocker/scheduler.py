@@ -0,0 +1,318 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Placement of containers on a pool of Docker hosts
+"""
+
+import logging
+import time
+
+from ipadocker import aio, container
+
+logger = logging.getLogger(__name__)
+
+
+class NoHostAvailable(Exception):
+    """
+    Raised when the container could not be created on any of the hosts
+
+    :param errors: list of (base_url, exception) tuples
+    """
+    def __init__(self, errors):
+        self.errors = errors
+        msg = "Failed to create container on any host: {}".format(
+            '; '.join('{}: {}'.format(url, e) for url, e in errors))
+        super(NoHostAvailable, self).__init__(msg)
+
+
+def is_local(base_url):
+    """
+    Whether the Docker daemon runs on this machine
+    """
+    from urllib.parse import urlparse
+
+    parsed = urlparse(base_url)
+    if parsed.scheme in ('unix', 'http+unix', 'npipe'):
+        return True
+
+    return parsed.hostname in ('localhost', '127.0.0.1', '::1')
+
+
+class DockerHost:
+    """
+    A Docker daemon from the host inventory along with its current load
+
+    :param index: position of the host in the inventory
+    :param base_url: URL of the Docker daemon
+    :param slots: number of containers which the host can run at once
+    :param shared_sources: whether the git repo is available on the host at
+        the same path as locally (e.g. on a shared filesystem), so that it can
+        be bind-mounted into the containers. Defaults to True for the local
+        daemon only
+    """
+    def __init__(self, index, base_url, slots=1, shared_sources=None):
+        if slots < 1:
+            raise ValueError(
+                "Host {} must have at least one slot".format(base_url))
+
+        self.index = index
+        self.base_url = base_url
+        self.slots = slots
+        if shared_sources is None:
+            shared_sources = is_local(base_url)
+        self.shared_sources = shared_sources
+        self.used = 0
+        self.failures = 0
+        # images known to be present on the host (pulled or committed)
+        self.images = set()
+        self.docker_client = None
+
+    @property
+    def load(self):
+        return self.used / self.slots
+
+    @property
+    def has_free_slot(self):
+        return self.used < self.slots
+
+    def __repr__(self):
+        return '<DockerHost {} ({}/{})>'.format(
+            self.base_url, self.used, self.slots)
+
+
+def hosts_from_config(hosts_config):
+    """
+    Create the host inventory from the 'hosts' section of the config
+
+    :param hosts_config: list of mappings with 'base_url' and optional
+        'slots' and 'shared_sources' keys
+    :raises: ValueError if the inventory is invalid
+    """
+    if not hosts_config:
+        raise ValueError("At least one Docker host must be configured")
+
+    hosts = []
+    for index, host_config in enumerate(hosts_config):
+        try:
+            base_url = host_config['base_url']
+        except (KeyError, TypeError):
+            raise ValueError(
+                "Invalid host entry {}: 'base_url' is missing".format(
+                    host_config))
+
+        shared_sources = host_config.get('shared_sources')
+        hosts.append(
+            DockerHost(index, base_url, int(host_config.get('slots', 1)),
+                       shared_sources=(bool(shared_sources)
+                                       if shared_sources is not None
+                                       else None)))
+
+    return hosts
+
+
+class HostScheduler:
+    """
+    Places containers on the least loaded Docker host with a free slot.
+    Hosts which already hold the image are preferred among equally loaded
+    ones. If the container creation fails on a host, the next best host is
+    tried. When all slots are taken, the placement waits until some container
+    is released
+
+    :param hosts: list of DockerHost instances
+    :param client_factory: function which creates a Docker client for the
+        DockerHost instance passed in
+    """
+    def __init__(self, hosts, client_factory):
+        self.hosts = hosts
+        self.client_factory = client_factory
+        self._slot_released = None
+
+    def _condition(self):
+        import asyncio
+
+        if self._slot_released is None:
+            self._slot_released = asyncio.Condition()
+
+        return self._slot_released
+
+    def candidates(self, image):
+        """
+        Return the hosts with a free slot ordered by placement preference
+        """
+        return sorted(
+            (host for host in self.hosts if host.has_free_slot),
+            key=lambda host: (host.load, image not in host.images,
+                              host.failures, host.index))
+
+    async def get_client(self, host):
+        """
+        Return the Docker client of the host, creating it on first use
+        """
+        if host.docker_client is None:
+            host.docker_client = await aio.run_blocking(
+                self.client_factory, host)
+
+        return host.docker_client
+
+    async def _reserve_slot(self, image, tried):
+        """
+        Wait for a free slot on a host which was not tried yet and take it
+
+        :returns: DockerHost instance or None if all hosts were tried
+        """
+        def untried():
+            return [host for host in self.hosts if host not in tried]
+
+        async with self._condition():
+            await self._condition().wait_for(
+                lambda: (not untried() or
+                         any(host.has_free_slot for host in untried())))
+
+            candidates = [
+                host for host in self.candidates(image) if host not in tried]
+            if not candidates:
+                return None
+
+            host = candidates[0]
+            host.used += 1
+            return host
+
+    def _unshared_hosts(self, config):
+        """
+        Return the hosts which cannot bind-mount the git repo from the local
+        path along with the errors recorded for them
+        """
+        unshared = {host for host in self.hosts if not host.shared_sources}
+        errors = [
+            (host.base_url, ValueError(
+                "the git repo is not shared with the remote host, set "
+                "'shared_sources' if it is available there at {}".format(
+                    config['git_repo'])))
+            for host in self.hosts if host in unshared
+        ]
+        return unshared, errors
+
+    async def _place_on(self, config, run_report, operation, host=None):
+        """
+        Run `operation(host, docker_client)` on the best host, trying the
+        next best one when it fails. The slot on the host is kept taken only
+        when the operation succeeds
+
+        :param host: DockerHost instance with a slot already taken, tried
+            first
+        :returns: tuple of the DockerHost instance and the operation result
+        :raises: NoHostAvailable when the operation failed on all hosts
+        """
+        import asyncio
+
+        image = config['container']['image']
+        tried, errors = self._unshared_hosts(config)
+
+        while True:
+            started = time.time()
+            placed = host is not None
+            if not placed:
+                host = await self._reserve_slot(image, tried)
+                if host is None:
+                    raise NoHostAvailable(errors)
+
+            tried.add(host)
+            if errors:
+                logger.info("Retrying placement on %s", host.base_url)
+
+            try:
+                docker_client = await self.get_client(host)
+                # the placement by `place` was recorded already
+                if run_report is not None and not placed:
+                    run_report.add_startup_stage('placement', started)
+
+                result = await operation(host, docker_client)
+            except asyncio.CancelledError:
+                await self._release_slot(host)
+                raise
+            except Exception as e:
+                logger.warning(
+                    "Cannot create container on %s: %s", host.base_url, e)
+                host.failures += 1
+                errors.append((host.base_url, e))
+                await self._release_slot(host)
+                host = None
+                continue
+
+            host.images.add(image)
+            return host, result
+
+    async def place(self, config, run_report=None):
+        """
+        Take a slot on the best host and pull the image there, without
+        creating the container. This can run while the git repo to
+        bind-mount is being prepared
+
+        :param config: IPADockerConfig instance
+        :param run_report: RunReport instance recording the pull
+        :returns: DockerHost instance, pass it to `create_container` or to
+            `release_host`
+        :raises: NoHostAvailable when the pull failed on all hosts
+        """
+        async def pull(host, docker_client):
+            await container.pull_image_async(
+                docker_client, config, logger, run_report=run_report,
+                known_images=host.images)
+
+        host, _result = await self._place_on(config, run_report, pull)
+        return host
+
+    async def create_container(self, config, run_report=None, host=None):
+        """
+        Create and start the container on the best host
+
+        :param config: IPADockerConfig instance
+        :param run_report: RunReport instance passed to the container
+        :param host: DockerHost instance returned by `place`. The container
+            is created there unless it fails
+        :returns: IPAContainer instance with `host` attribute set to the
+            DockerHost it runs on. Pass it to `release` when done
+        :raises: NoHostAvailable when the creation failed on all hosts
+        """
+        async def create(host, docker_client):
+            return await container.IPAContainer.create(
+                docker_client, config, run_report=run_report, host=host)
+
+        host, ipacontainer = await self._place_on(
+            config, run_report, create, host=host)
+        logger.info("Container placed on %s", host.base_url)
+        return ipacontainer
+
+    async def _release_slot(self, host):
+        async with self._condition():
+            host.used -= 1
+            self._condition().notify_all()
+
+    async def release(self, ipacontainer):
+        """
+        Return the slot taken by the container to its host
+        """
+        host = getattr(ipacontainer, 'host', None)
+        if host is not None:
+            await self._release_slot(host)
+
+    async def release_host(self, host):
+        """
+        Return the slot taken by `place` when no container was created
+        """
+        await self._release_slot(host)
+
+    def close(self):
+        """
+        Close the Docker clients of all hosts
+        """
+        for host in self.hosts:
+            close = getattr(host.docker_client, 'close', None)
+            if close is not None:
+                try:
+                    close()
+                except Exception as e:
+                    logger.warning(
+                        "Cannot close Docker client of %s: %s",
+                        host.base_url, e)
@@ -0,0 +1,586 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Long-running queue service batching many runs
+
+The service listens on a Unix socket for jobs, each of them a commit and the
+command line of a runner invocation (e.g. `run-tests test_xmlrpc`). Jobs for
+the same commit with the same options are coalesced into a batch sharing one
+warm container: the commit is checked out once, the container is created
+once and the steps preparing it (build, server install etc.) are done by the
+first job only. At most `parallel` batches run at once, further limited by
+the slots of the Docker hosts.
+
+The protocol is line-delimited JSON. The client sends the job:
+
+    {"commit": "<commit ID>", "argv": ["run-tests", "test_xmlrpc"]}
+
+along with the contents of its config file (`--config`) in "config", if any,
+since the path may not be valid for the service. It receives the events of
+the job until it finishes:
+
+    {"event": "queued", "job": 1, "batch": 1}
+    {"event": "log", "message": "..."}
+    {"event": "finished", "exit_code": 0}
+
+The output of the job is dropped while the client does not keep reading it,
+rather than buffered without bounds.
+"""
+
+import collections
+import itertools
+import json
+import logging
+import os
+
+from ipadocker import (
+    aio, cli, command, config, constants, metrics, report, snapshot)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PARALLEL = 2
+
+# maximum size in bytes of the events buffered for a client, the further
+# output of the job is dropped until the client catches up
+MAX_CLIENT_BUFFER = 4 * 1024 * 1024
+
+# actions which can be submitted as jobs
+QUEUED_ACTIONS = ('build', 'install-server', 'lint', 'tox', 'webui-unit',
+                  'run-tests', 'unit-tests')
+
+
+def default_socket_path():
+    return os.path.join(constants.CACHE_DIR, 'queue.sock')
+
+
+class JobError(Exception):
+    """
+    Raised when the job can not be accepted
+    """
+
+
+class Job:
+    """
+    A runner invocation submitted to the service
+
+    :param job_id: ID of the job
+    :param commit: ID of the commit to test
+    :param argv: command line of the job
+    :param args: parsed command line of the job
+    :param writer: StreamWriter of the client connection
+    :param config_overrides: contents of the config file given by the job
+    """
+    def __init__(self, job_id, commit, argv, args, writer,
+                 config_overrides=None):
+        self.job_id = job_id
+        self.commit = commit
+        self.argv = argv
+        self.args = args
+        self.writer = writer
+        self.config_overrides = config_overrides or {}
+        self.done = None
+        # number of the log events dropped since the client fell behind
+        self.dropped = 0
+
+    @property
+    def key(self):
+        """
+        Jobs with the same key can share a container
+        """
+        return json.dumps([
+            self.commit, self.args.cli_overrides or {}, self.config_overrides,
+            self.args.developer_mode
+        ], sort_keys=True)
+
+    def send(self, event, **data):
+        """
+        Send the event to the client. The log events are dropped while the
+        client falls behind, the others are always sent
+        """
+        if self.writer is None or self.writer.transport.is_closing():
+            return
+
+        if event == 'log':
+            if (self.writer.transport.get_write_buffer_size() >
+                    MAX_CLIENT_BUFFER):
+                self.dropped += 1
+                return
+
+            if self.dropped:
+                self._write({
+                    'event': 'log',
+                    'message': "{} lines of output dropped, the client does "
+                               "not keep up".format(self.dropped)})
+                self.dropped = 0
+
+        data['event'] = event
+        self._write(data)
+
+    def _write(self, data):
+        self.writer.write(json.dumps(data).encode() + b'\n')
+
+
+class Batch:
+    """
+    Jobs sharing a container
+
+    :param batch_id: ID of the batch
+    :param key: key of the jobs in the batch
+    """
+    def __init__(self, batch_id, key):
+        self.batch_id = batch_id
+        self.key = key
+        self.jobs = collections.deque()
+        # no more jobs are accepted once the batch starts to tear down
+        self.closed = False
+
+
+class JobLogHandler(logging.Handler):
+    """
+    Forward the log records of the containers to the clients of the jobs
+    running in them
+
+    :param running: mapping of the container IDs to the running jobs
+    """
+    def __init__(self, running):
+        super(JobLogHandler, self).__init__()
+        self.running = running
+
+    def emit(self, record):
+        job = self.running.get(getattr(record, 'container_id', None))
+        if job is None:
+            return
+
+        try:
+            job.send('log', message=self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class QueueService:
+    """
+    Queue of the jobs coalesced into batches
+
+    :param ipaconfig: IPADockerConfig instance of the service
+    :param args: parsed command line of the service, used for the options
+        which are not part of the jobs (`--no-cleanup`, `--record` etc.)
+    :param parallel: maximum number of batches running at once
+    """
+    def __init__(self, ipaconfig, args, parallel=DEFAULT_PARALLEL):
+        self.ipaconfig = ipaconfig
+        self.args = args
+        self.parallel = parallel
+        self.batches = {}
+        # jobs currently running keyed by the ID of their container
+        self.running = {}
+
+        self._job_ids = itertools.count(1)
+        self._batch_ids = itertools.count(1)
+        self._semaphore = None
+        self._host_scheduler = None
+        self._tasks = {}
+        # metrics of the jobs, served over HTTP if enabled
+        self.metrics = metrics.MetricsRegistry.load()
+
+    def parse_job(self, request, writer=None):
+        """
+        Create the job from the client request
+
+        :raises: JobError if the request is invalid
+        """
+        try:
+            commit = snapshot.rev_parse(
+                self.ipaconfig['git_repo'], request['commit'])
+            argv = [str(arg) for arg in request['argv']]
+        except (KeyError, TypeError) as e:
+            raise JobError("Invalid job: {}".format(e))
+        except snapshot.SnapshotError as e:
+            raise JobError("Unknown commit: {}".format(e))
+
+        parser = cli.make_parser()
+
+        # argparse exits on errors, report them to the client instead
+        def error(message):
+            raise JobError(message)
+
+        parser.error = error
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            raise JobError("Invalid command line: {}".format(' '.join(argv)))
+
+        if args.action_name not in QUEUED_ACTIONS:
+            raise JobError(
+                "Action {} can not be queued".format(args.action_name))
+
+        # the config file of the client is sent along with the job, its
+        # path may be relative to the directory of the client
+        config_overrides = request.get('config')
+        if config_overrides is not None:
+            try:
+                if not isinstance(config_overrides, dict):
+                    raise ValueError(
+                        "not a mapping: {}".format(config_overrides))
+                config.validate_config(
+                    config_overrides, constants.DEFAULT_CONFIG)
+            except (ValueError, config.ConfigValidationError) as e:
+                raise JobError("Invalid config: {}".format(e))
+        elif args.config is not None:
+            try:
+                with open(args.config, 'r') as config_file:
+                    config_overrides = config.load_config_from_file(
+                        config_file)
+            except (OSError, ValueError, config.ConfigValidationError) as e:
+                raise JobError("Cannot load config file: {}".format(e))
+
+        # options of the service apply to all jobs
+        for option in ('no_cleanup', 'record', 'replay', 'replay_speed'):
+            setattr(args, option, getattr(self.args, option))
+        args.report = None
+
+        job = Job(next(self._job_ids), commit, argv, args, writer,
+                  config_overrides=config_overrides)
+        try:
+            cli.fast_lane(
+                self._config(job), args, cli.get_action(args.action_name))
+        except ValueError as e:
+            raise JobError(str(e))
+
+        return job
+
+    def submit(self, job):
+        """
+        Add the job to a batch of its commit, starting a new batch if there
+        is none accepting jobs
+
+        :returns: future resolved with the exit code of the job
+        """
+        import asyncio
+
+        job.done = asyncio.get_event_loop().create_future()
+
+        batch = self.batches.get(job.key)
+        if batch is None or batch.closed:
+            batch = Batch(next(self._batch_ids), job.key)
+            self.batches[job.key] = batch
+            task = asyncio.ensure_future(self.run_batch(batch, job.commit))
+            self._tasks[task] = batch
+            task.add_done_callback(self._tasks.pop)
+
+        batch.jobs.append(job)
+        job.send('queued', job=job.job_id, batch=batch.batch_id)
+        logger.info("Job %d queued in batch %d", job.job_id, batch.batch_id)
+
+        return job.done
+
+    def _config(self, job):
+        ipaconfig = self.ipaconfig
+        if job.config_overrides:
+            ipaconfig = ipaconfig.override(job.config_overrides)
+
+        return ipaconfig.override(
+            config.deepen_mapping(job.args.cli_overrides or {}))
+
+    async def run_batch(self, batch, commit):
+        """
+        Run the jobs of the batch one after another in a single container
+        """
+        import asyncio
+
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(max(self.parallel, 1))
+
+        ipacontainer = None
+        job = None
+        source_snapshot = snapshot.SourceSnapshot(self.ipaconfig['git_repo'])
+        source_snapshot.commit = commit
+        checkout = None
+
+        async def checkout_sources():
+            # done once, the containers replacing a dead one reuse it
+            nonlocal checkout
+
+            if checkout is None:
+                checkout = await source_snapshot.checkout_async(
+                    'queue-{}'.format(batch.batch_id))
+
+            return checkout
+
+        try:
+            async with self._semaphore:
+                while batch.jobs:
+                    job = batch.jobs.popleft()
+
+                    if ipacontainer is None:
+                        ipacontainer = await self._create_container(
+                            job, checkout_sources)
+                        if ipacontainer is None:
+                            continue
+
+                        ipacontainer.completed_steps = {}
+
+                    exit_code = await self.run_job(job, ipacontainer)
+                    job.done.set_result(exit_code)
+
+                    if ipacontainer.death is not None:
+                        # the next job gets a new container
+                        await self._remove_container(ipacontainer)
+                        ipacontainer = None
+        except Exception as e:
+            logger.error("Batch %d failed: %s", batch.batch_id, e)
+            logger.debug(e, exc_info=e)
+        finally:
+            batch.closed = True
+            if self.batches.get(batch.key) is batch:
+                del self.batches[batch.key]
+
+            # jobs which did not finish
+            if job is not None and not job.done.done():
+                job.done.set_result(2)
+
+            while batch.jobs:
+                job = batch.jobs.popleft()
+                job.send('log', message="Batch failed")
+                job.done.set_result(2)
+
+            if ipacontainer is not None:
+                await self._remove_container(ipacontainer)
+
+            if not self.args.no_cleanup:
+                source_snapshot.remove()
+
+    async def _create_container(self, job, checkout):
+        """
+        Create the container of the batch. The image is pulled while the
+        sources are checked out
+
+        :param checkout: coroutine function returning the path to the
+            checkout of the batch
+        :returns: IPAContainer instance or None if the creation failed, in
+            which case the job is finished
+        """
+        if self._host_scheduler is None:
+            self._host_scheduler = cli.create_scheduler(
+                self.ipaconfig, self.args)
+
+        ipaconfig = self._config(job)
+        try:
+            return await cli.create_container(
+                ipaconfig, self._host_scheduler,
+                run_report=report.RunReport(
+                    image=ipaconfig['container']['image']),
+                checkout=checkout)
+        except Exception as e:
+            job.send('log', message="Cannot create container: {}".format(e))
+            job.done.set_result(2)
+            return None
+
+    async def _remove_container(self, ipacontainer):
+        if self.args.no_cleanup:
+            ipacontainer.unwatch()
+            logger.info("Container %s is left running",
+                        ipacontainer.container_id)
+        else:
+            await cli.stop_and_remove_container(ipacontainer)
+
+        await self._host_scheduler.release(ipacontainer)
+
+    async def run_job(self, job, ipacontainer):
+        """
+        Run the action of the job in the container of its batch
+
+        :returns: exit code of the job
+        """
+        action = cli.fast_lane(
+            ipacontainer.config, job.args,
+            cli.get_action(job.args.action_name))
+
+        try:
+            await cli.plan_action_async(ipacontainer.config, job.args, action)
+        except RuntimeError as e:
+            job.send('log', message="Invalid execution plan: {}".format(e))
+            return 2
+
+        previous_report = ipacontainer.report
+        ipacontainer.report = report.RunReport(
+            image=ipacontainer.config['container']['image'])
+        if not previous_report.steps:
+            # the start of the container is accounted to the first job
+            ipacontainer.report.pull_time = previous_report.pull_time
+            ipacontainer.report.boot_time = previous_report.boot_time
+            ipacontainer.report.startup_stages = (
+                previous_report.startup_stages)
+
+        self.running[ipacontainer.container_id] = job
+        job.send('log', message="Running job {} ({}) on commit {}".format(
+            job.job_id, ' '.join(job.argv), job.commit))
+
+        exit_code = 0
+        try:
+            await action(ipacontainer, job.args)
+        except command.ContainerExecError as e:
+            job.send('log', message=str(e))
+            exit_code = e.exit_code
+        except Exception as e:
+            job.send('log', message="An exception has occured: {}".format(e))
+            exit_code = 2
+        finally:
+            try:
+                await cli.cleanup(ipacontainer)
+            except command.ContainerExecError as e:
+                logger.error("An exception has occured during cleanup: %s", e)
+
+            del self.running[ipacontainer.container_id]
+            cli.record_step_history(ipacontainer.report)
+            await self.record_metrics(ipacontainer.report, action.__name__,
+                                      exit_code)
+            job.send('report', report=ipacontainer.report.to_dict())
+
+        logger.info("Job %d finished with exit code %d", job.job_id,
+                    exit_code)
+        return exit_code
+
+    async def record_metrics(self, run_report, action_name, exit_code):
+        """
+        Add the results of the job to the metrics and re-write the metrics
+        textfile, if configured. The job is merged into the metrics
+        accumulated by all runners, which are then served over HTTP
+        """
+        textfile = self.ipaconfig['metrics']['textfile']
+        if not textfile:
+            self.metrics.record_run(run_report, action_name, exit_code)
+            return
+
+        # waiting for the lock must not block the other jobs
+        accumulated = await aio.run_blocking(
+            metrics.record_run, run_report, action_name, exit_code, textfile)
+        if accumulated is None:
+            self.metrics.record_run(run_report, action_name, exit_code)
+            return
+
+        for metric, accumulated_metric in zip(self.metrics.metrics,
+                                              accumulated.metrics):
+            metric.values = accumulated_metric.values
+
+    async def handle_client(self, reader, writer):
+        """
+        Read the job from the client and stream its events back
+        """
+        try:
+            line = await reader.readline()
+            try:
+                job = self.parse_job(json.loads(line.decode()), writer)
+            except (ValueError, JobError) as e:
+                Job(None, None, None, None, writer).send(
+                    'finished', exit_code=2, error=str(e))
+                return
+
+            exit_code = await self.submit(job)
+            job.send('finished', exit_code=exit_code)
+            await writer.drain()
+        except ConnectionError as e:
+            logger.debug("Client disconnected: %s", e)
+        finally:
+            writer.close()
+
+    async def serve(self, socket_path, metrics_address=None):
+        """
+        Serve the clients on the Unix socket until cancelled
+
+        :param metrics_address: tuple of the host and the port to serve the
+            metrics on over HTTP, if any
+        """
+        import asyncio
+
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+        handler = JobLogHandler(self.running)
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        loggers = [logging.getLogger(command.__name__)]
+        exec_logger = logging.getLogger('.'.join([command.__name__, 'exec']))
+        if not exec_logger.propagate:
+            loggers.append(exec_logger)
+        for job_logger in loggers:
+            job_logger.addHandler(handler)
+
+        server = await asyncio.start_unix_server(
+            self.handle_client, path=socket_path)
+        logger.info("Listening on %s", socket_path)
+
+        metrics_server = None
+        try:
+            if metrics_address is not None:
+                metrics_server = await metrics.serve_http(
+                    self.metrics, *metrics_address)
+                logger.info("Serving metrics on http://%s:%d/metrics",
+                            *metrics_address)
+
+            await asyncio.Event().wait()
+        finally:
+            server.close()
+            await server.wait_closed()
+            if metrics_server is not None:
+                metrics_server.close()
+                await metrics_server.wait_closed()
+
+            # interrupt the running jobs, let the batches remove their
+            # containers
+            for task, batch in list(self._tasks.items()):
+                if not batch.closed:
+                    task.cancel()
+
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+            for job_logger in loggers:
+                job_logger.removeHandler(handler)
+
+            if self._host_scheduler is not None:
+                self._host_scheduler.close()
+
+
+async def submit_async(socket_path, commit, argv, on_event,
+                       config_overrides=None):
+    """
+    Submit the job to the service and wait until it finishes
+
+    :param socket_path: path to the Unix socket of the service
+    :param commit: commit to test
+    :param argv: command line of the job
+    :param on_event: function called with every event of the job
+    :param config_overrides: contents of the config file of the job, if any
+    :returns: exit code of the job
+    """
+    import asyncio
+
+    request = {'commit': commit, 'argv': list(argv)}
+    if config_overrides is not None:
+        request['config'] = config_overrides
+
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    try:
+        writer.write(json.dumps(request).encode() + b'\n')
+        await writer.drain()
+
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("Service closed the connection")
+
+            event = json.loads(line.decode())
+            on_event(event)
+            if event['event'] == 'finished':
+                return event['exit_code']
+    finally:
+        writer.close()
+
+
+def print_event(event):
+    if event['event'] == 'log':
+        print(event['message'], flush=True)
+    elif event['event'] == 'queued':
+        print("Job {} queued in batch {}".format(
+            event['job'], event['batch']), flush=True)
+    elif event['event'] == 'finished' and event.get('error'):
+        print("Job rejected: {}".format(event['error']), flush=True)
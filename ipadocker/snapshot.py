@@ -0,0 +1,176 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Snapshots of the FreeIPA sources shared by several concurrent runs
+
+The snapshot is a commit capturing the current state of the git repo,
+including uncommitted changes to tracked files (see `git stash create`). Every
+run gets its own checkout of the snapshot, which is a local clone sharing the
+objects with the original repo by hardlinks. The runs thus test exactly the
+same sources without stepping on each other's build artifacts, and the
+developer can continue working in the repo meanwhile
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+
+from ipadocker import aio, constants
+
+logger = logging.getLogger(__name__)
+
+
+class SnapshotError(Exception):
+    """
+    Raised when a git command fails
+    """
+
+
+def _git_output(repo, *args):
+    """
+    Run the git command in the repo
+
+    :returns: raw output of the command
+    """
+    cmd = ['git', '-C', repo] + list(args)
+    try:
+        return subprocess.check_output(cmd, stderr=subprocess.PIPE)
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, 'stderr', None) or b''
+        raise SnapshotError(
+            "'{}' failed: {}".format(
+                ' '.join(cmd), stderr.decode(errors='replace').strip() or e))
+
+
+def _git(repo, *args):
+    return _git_output(repo, *args).decode().strip()
+
+
+def rev_parse(git_repo, revision):
+    """
+    Return the ID of the commit the revision points to
+
+    :raises: SnapshotError if the revision is unknown
+    """
+    return _git(git_repo, 'rev-parse', '--verify',
+                '{}^{{commit}}'.format(revision))
+
+
+def describe_commit(git_repo, commit):
+    """
+    Return the abbreviated ID and the subject of the commit
+    """
+    return _git(git_repo, 'log', '-1', '--format=%h %s', commit)
+
+
+def source_hash(git_repo):
+    """
+    Hash the current state of the sources in the git repo, i.e. the HEAD
+    commit along with the uncommitted changes and the untracked files which
+    are not ignored. Unlike the commit created by `git stash create`, the hash
+    does not change unless the sources do
+
+    :raises: SnapshotError if the state can not be read
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    digest.update(_git_output(git_repo, 'rev-parse', 'HEAD').strip())
+    digest.update(b'\0')
+    digest.update(_git_output(git_repo, 'diff', '--binary', 'HEAD'))
+
+    untracked = _git_output(
+        git_repo, 'ls-files', '-z', '--others', '--exclude-standard')
+    for path in sorted(untracked.split(b'\0')):
+        if not path:
+            continue
+
+        full_path = os.path.join(os.fsencode(git_repo), path)
+        try:
+            if os.path.islink(full_path):
+                content = os.readlink(full_path)
+            else:
+                with open(full_path, 'rb') as untracked_file:
+                    content = untracked_file.read()
+        except OSError as e:
+            raise SnapshotError(
+                "Cannot read untracked file {}: {}".format(
+                    os.fsdecode(path), e))
+
+        digest.update(b'\0' + path + b'\0')
+        digest.update(hashlib.sha256(content).digest())
+
+    return digest.hexdigest()
+
+
+class SourceSnapshot:
+    """
+    Snapshot of the git repo with separate checkouts for the runs
+
+    :param git_repo: path to the git repo
+    :param root: directory holding the checkouts. Defaults to the cache
+        directory
+    """
+    def __init__(self, git_repo, root=None):
+        self.git_repo = git_repo
+        self.root = root or os.path.join(constants.CACHE_DIR, 'snapshots')
+        self.commit = None
+        self.checkouts = []
+
+    def create(self):
+        """
+        Record the current state of the repo
+
+        :returns: ID of the snapshot commit
+        """
+        # 'stash create' prints nothing when there are no local changes
+        self.commit = (_git(self.git_repo, 'stash', 'create') or
+                       _git(self.git_repo, 'rev-parse', 'HEAD'))
+
+        logger.info("Created snapshot %s of %s", self.commit, self.git_repo)
+        return self.commit
+
+    def checkout(self, name):
+        """
+        Create a separate checkout of the snapshot
+
+        :param name: name of the checkout, e.g. the image using it
+        :returns: path to the checkout
+        """
+        if self.commit is None:
+            raise SnapshotError("Snapshot was not created yet")
+
+        path = os.path.join(
+            self.root, self.commit[:12],
+            re.sub(r'[^A-Za-z0-9_.-]+', '_', name))
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # local clone hardlinks the object store including the unreferenced
+        # commit created by 'stash create'
+        _git(self.git_repo, 'clone', '--quiet', '--local', '--no-checkout',
+             '.', path)
+        _git(path, 'checkout', '--quiet', '--detach', self.commit)
+        self.checkouts.append(path)
+
+        return path
+
+    async def checkout_async(self, name):
+        """
+        Coroutine variant of `checkout`
+        """
+        return await aio.run_blocking(self.checkout, name)
+
+    def remove(self):
+        """
+        Remove all checkouts of the snapshot
+        """
+        for path in self.checkouts:
+            shutil.rmtree(path, ignore_errors=True)
+
+        self.checkouts = []
@@ -0,0 +1,58 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+State files in the cache directory shared by simultaneous runner invocations
+
+The files are updated under a `flock` of a lock file next to them, so that
+the read-modify-write of one process does not lose the updates of another.
+The new content is written to a temporary file with a unique name and
+renamed over the old one, so that the readers never see a partial file.
+"""
+
+import contextlib
+import fcntl
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def locked(filename):
+    """
+    Hold the lock of the state file, the lock file is next to it
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    fd = os.open('{}.lock'.format(filename), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def write_atomic(filename, content):
+    """
+    Replace the content of the file
+
+    :raises: OSError if the file can not be written
+    """
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=directory or '.', prefix='.{}.'.format(os.path.basename(filename)),
+        suffix='.tmp')
+    try:
+        # mkstemp creates the file readable by the owner only
+        os.fchmod(fd, 0o644)
+        with os.fdopen(fd, 'w') as output_file:
+            output_file.write(content)
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmp_filename)
+        raise
@@ -0,0 +1,73 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Shared pytest fixtures and hooks
+"""
+
+import subprocess
+
+import pytest
+
+from ipadocker import constants
+
+BENCHMARK_RESULTS = []
+
+
+def git(repo, *args):
+    """
+    Run git in the repo as a test user
+    """
+    subprocess.check_call(
+        ['git', '-C', str(repo), '-c', 'user.name=Test',
+         '-c', 'user.email=test@ipa.test'] + list(args),
+        stdout=subprocess.DEVNULL)
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(monkeypatch, tmpdir):
+    """
+    Keep the state stored by the runner (step history etc.) out of the user's
+    cache directory
+    """
+    cache_dir = str(tmpdir.join('cache'))
+    monkeypatch.setattr(constants, 'CACHE_DIR', cache_dir)
+    return cache_dir
+
+
+@pytest.fixture()
+def git_repo(tmpdir):
+    """
+    Git repo with the spec file committed
+    """
+    repo = tmpdir.mkdir('freeipa')
+    git(repo, 'init', '--quiet')
+    repo.join('freeipa.spec.in').write('Version: 1\n')
+    git(repo, 'add', 'freeipa.spec.in')
+    git(repo, 'commit', '--quiet', '-m', 'initial')
+    return repo
+
+
+@pytest.fixture()
+def bench_report():
+    """
+    Return a function which records a benchmark result. Recorded results are
+    printed in the terminal summary
+    """
+    def report(name, value, unit):
+        BENCHMARK_RESULTS.append((name, value, unit))
+
+    return report
+
+
+def pytest_terminal_summary(terminalreporter):
+    """
+    Print the throughput measured by the benchmark suite
+    """
+    if not BENCHMARK_RESULTS:
+        return
+
+    terminalreporter.section('benchmark results')
+    for name, value, unit in BENCHMARK_RESULTS:
+        terminalreporter.write_line(
+            '{:<45} {:>14,.1f} {}'.format(name, value, unit))
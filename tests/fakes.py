@@ -0,0 +1,324 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+In-process fake of the Docker API client used by tests and benchmarks
+"""
+
+import io
+import itertools
+import os
+import tarfile
+import threading
+import time
+
+import docker
+
+
+def generate_output(lines=100, line_length=80, lines_per_chunk=1):
+    """
+    Generate a synthetic exec output stream
+
+    :param lines: total number of lines to produce
+    :param line_length: length of each line (without the newline)
+    :param lines_per_chunk: how many lines are packed into a single chunk
+
+    :returns: list of byte chunks as yielded by `exec_start(stream=True)`
+    """
+    line = b'x' * line_length + b'\n'
+    chunks = []
+    for start in range(0, lines, lines_per_chunk):
+        count = min(lines_per_chunk, lines - start)
+        chunks.append(line * count)
+
+    return chunks
+
+
+class FakeDockerClient:
+    """
+    A stand-in for `docker.Client` which implements the subset of the API used
+    by the runner. Exec output streams are replayed from a list of chunks so
+    no Docker daemon nor network is needed
+
+    :param exec_output: list of byte chunks to replay for every exec. If
+        `None`, an empty stream is produced
+    :param chunk_latency: delay in seconds before each chunk is yielded
+    :param exec_latency: delay in seconds of every exec round-trip (applied
+        to `exec_create` and `exec_inspect`)
+    :param exit_codes: a mapping of command substrings to exit codes. The
+        first matching substring determines the exit code of the exec,
+        commands that do not match succeed
+    :param base_url: URL of the fake daemon
+    :param transient_failures: a mapping of command substrings to tuples of
+        exit code and number of times the matching commands fail before they
+        start to succeed
+    :param system_states: states reported by the successive readiness probes
+        (`systemctl is-system-running`), the last one is repeated
+    :param ncpu: number of CPUs reported by the fake daemon
+    :param mem_total: memory in bytes reported by the fake daemon
+    :param command_outputs: a mapping of command substrings to the outputs
+        of the matching commands when they are not streamed (e.g. probes), or
+        to functions returning the output of the command passed in. The other
+        commands produce `exec_output`
+    :param registry: images which can be pulled. If `None`, all images except
+        those built or committed by the fake daemon can be pulled
+    """
+    def __init__(self, exec_output=None, chunk_latency=0.0, exec_latency=0.0,
+                 exit_codes=None, base_url='unix://fake.sock',
+                 transient_failures=None, system_states=('running',), ncpu=4,
+                 mem_total=8 * 1024 ** 3, command_outputs=None, registry=None,
+                 **kwargs):
+        self.base_url = base_url
+        self.system_states = list(system_states)
+        self.ncpu = ncpu
+        self.mem_total = mem_total
+        self.exec_output = exec_output or []
+        self.chunk_latency = chunk_latency
+        self.exec_latency = exec_latency
+        self.exit_codes = exit_codes or {}
+        self.command_outputs = command_outputs or {}
+        self.transient_failures = {
+            substring: list(failure)
+            for substring, failure in (transient_failures or {}).items()
+        }
+
+        self.calls = []
+        self.commands = []
+        self.containers = {}
+        self.images = set()
+        self.registry = set(registry) if registry is not None else None
+        # images built or committed by the fake daemon, not in any registry
+        self.local_images = set()
+        # contents of the custom build contexts keyed by the image tag
+        self.build_contexts = {}
+        # tags of the images whose build fails
+        self.failing_builds = set()
+        # contents of the files in the containers keyed by their path, copied
+        # by the archive API
+        self.files = {}
+
+        self._ids = itertools.count(1)
+        self._execs = {}
+        # notified when a container stops or is removed
+        self._state_changed = threading.Condition()
+
+    def _record(self, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+
+    def _new_id(self, prefix):
+        return '{}{:060d}'.format(prefix, next(self._ids))
+
+    def _sleep(self, delay):
+        if delay:
+            time.sleep(delay)
+
+    def info(self):
+        self._record('info')
+        return {'NCPU': self.ncpu, 'MemTotal': self.mem_total}
+
+    def _not_found(self, message):
+        return docker.errors.NotFound(
+            "404 Client Error: Not Found", None, explanation=message)
+
+    def pull(self, repository, **kwargs):
+        self._record('pull', repository, **kwargs)
+
+        if (repository in self.local_images or
+                (self.registry is not None and
+                 repository not in self.registry)):
+            raise self._not_found(
+                "repository {} not found: does not exist or no pull "
+                "access".format(repository))
+
+        self.images.add(repository)
+        return '{{"status": "Downloaded newer image for {}"}}'.format(
+            repository)
+
+    def build(self, tag=None, fileobj=None, stream=False, decode=False,
+              **kwargs):
+        self._record('build', tag=tag, **kwargs)
+
+        if fileobj is not None:
+            with tarfile.open(fileobj=io.BytesIO(fileobj.read())) as tar:
+                self.build_contexts[tag] = {
+                    member.name: tar.extractfile(member).read()
+                    for member in tar.getmembers()
+                }
+
+        if tag in self.failing_builds:
+            yield {'error': 'The command returned a non-zero code: 1\n'}
+            return
+
+        self.images.add(tag)
+        self.local_images.add(tag)
+        yield {'stream': 'Step 1/1 : FROM base\n'}
+        yield {'stream': 'Successfully built {}\n'.format(self._new_id('i'))}
+
+    def commit(self, container, repository=None, tag=None, **kwargs):
+        self._record('commit', container, repository=repository, tag=tag)
+        image = '{}:{}'.format(repository, tag)
+        self.images.add(image)
+        self.local_images.add(image)
+        return {'Id': self._new_id('i')}
+
+    def inspect_image(self, image):
+        self._record('inspect_image', image)
+        if image not in self.images:
+            raise self._not_found("No such image: {}".format(image))
+
+        return {'Id': self._new_id('i'), 'RepoTags': [image]}
+
+    def create_host_config(self, **kwargs):
+        self._record('create_host_config', **kwargs)
+        return dict(kwargs)
+
+    def create_container(self, image, host_config=None, **kwargs):
+        self._record('create_container', image, **kwargs)
+        container_id = self._new_id('c')
+        self.containers[container_id] = {
+            'Image': image,
+            'HostConfig': host_config,
+            'Config': kwargs,
+            'State': {'Status': 'created', 'ExitCode': 0, 'OOMKilled': False}
+        }
+        return {'Id': container_id, 'Warnings': None}
+
+    def start(self, container=None, **kwargs):
+        self._record('start', container)
+        self.containers[container]['State']['Status'] = 'running'
+
+    def stop(self, container, **kwargs):
+        self._record('stop', container)
+        with self._state_changed:
+            self.containers[container]['State']['Status'] = 'exited'
+            self._state_changed.notify_all()
+
+    def remove_container(self, container, **kwargs):
+        self._record('remove_container', container)
+        with self._state_changed:
+            del self.containers[container]
+            self._state_changed.notify_all()
+
+    def die(self, container, exit_code=137, oom_killed=True, error=''):
+        """
+        Make the container die as if it was killed, by default by the OOM
+        killer. Not part of the Docker API
+        """
+        with self._state_changed:
+            self.containers[container]['State'].update(
+                Status='exited', ExitCode=exit_code, OOMKilled=oom_killed,
+                Error=error)
+            self._state_changed.notify_all()
+
+    def wait(self, container, timeout=None):
+        self._record('wait', container)
+
+        def stopped():
+            return (container not in self.containers or
+                    self.containers[container]['State']['Status'] !=
+                    'running')
+
+        with self._state_changed:
+            self._state_changed.wait_for(stopped)
+            if container not in self.containers:
+                raise RuntimeError("No such container: {}".format(container))
+
+            return self.containers[container]['State']['ExitCode']
+
+    def inspect_container(self, container):
+        self._record('inspect_container', container)
+        return self.containers[container]
+
+    def put_archive(self, container, path, data):
+        self._record('put_archive', container, path)
+
+        with tarfile.open(fileobj=io.BytesIO(data)) as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    self.files[os.path.join(path, member.name)] = \
+                        tar.extractfile(member).read()
+
+        return True
+
+    def get_archive(self, container, path):
+        self._record('get_archive', container, path)
+
+        names = [name for name in self.files
+                 if name == path or name.startswith(path.rstrip('/') + '/')]
+        if not names:
+            raise RuntimeError("No such file: {}".format(path))
+
+        archive = io.BytesIO()
+        with tarfile.open(fileobj=archive, mode='w') as tar:
+            for name in names:
+                info = tarfile.TarInfo(os.path.normpath(os.path.join(
+                    os.path.basename(path),
+                    os.path.relpath(name, path))))
+                info.size = len(self.files[name])
+                tar.addfile(info, io.BytesIO(self.files[name]))
+
+        archive.seek(0)
+        return archive, {'name': os.path.basename(path)}
+
+    def exec_create(self, container, cmd, **kwargs):
+        self._record('exec_create', container, cmd)
+        self._sleep(self.exec_latency)
+
+        if container not in self.containers:
+            raise RuntimeError("No such container: {}".format(container))
+
+        if self.containers[container]['State']['Status'] == 'exited':
+            raise RuntimeError("Container {} is not running".format(container))
+
+        exit_code = 0
+        for substring, code in self.exit_codes.items():
+            if substring in cmd:
+                exit_code = code
+                break
+
+        for substring, failure in self.transient_failures.items():
+            if substring in cmd and failure[1] > 0:
+                exit_code = failure[0]
+                failure[1] -= 1
+                break
+
+        exec_id = self._new_id('e')
+        self._execs[exec_id] = {
+            'ExitCode': exit_code, 'Running': False, 'Cmd': cmd}
+        self.commands.append(cmd)
+        return {'Id': exec_id}
+
+    def exec_start(self, exec_id, stream=False, **kwargs):
+        self._record('exec_start', exec_id)
+
+        if not stream:
+            exec_id = exec_id['Id'] if isinstance(exec_id, dict) else exec_id
+            cmd = self._execs[exec_id]['Cmd']
+            if 'is-system-running' in cmd:
+                return self._system_state().encode()
+
+            for substring, output in self.command_outputs.items():
+                if substring in cmd:
+                    return output(cmd) if callable(output) else output
+
+            return b''.join(self.exec_output)
+
+        return self._stream()
+
+    def _system_state(self):
+        state = self.system_states[0]
+        if len(self.system_states) > 1:
+            self.system_states.pop(0)
+
+        return state + '\n'
+
+    def _stream(self):
+        for chunk in self.exec_output:
+            self._sleep(self.chunk_latency)
+            yield chunk
+
+    def exec_inspect(self, exec_id):
+        self._record('exec_inspect', exec_id)
+        self._sleep(self.exec_latency)
+        exec_id = exec_id['Id'] if isinstance(exec_id, dict) else exec_id
+        return self._execs[exec_id]
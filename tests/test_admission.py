@@ -0,0 +1,128 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the admission control of resource-heavy steps
+"""
+
+import asyncio
+import subprocess
+import sys
+import time
+
+import pytest
+
+from ipadocker import admission, aio, cli, config, constants, container
+from tests import fakes
+
+
+@pytest.fixture()
+def admission_control(tmpdir):
+    return admission.AdmissionControl(
+        {'build': 2, 'server_install': 1}, lock_dir=str(tmpdir.join('slots')))
+
+
+def test_slot_limit(admission_control):
+    first = admission_control.try_acquire('build')
+    second = admission_control.try_acquire('build')
+
+    assert first is not None and second is not None
+    assert first.path != second.path
+    assert admission_control.try_acquire('build') is None
+
+    first.release()
+    third = admission_control.try_acquire('build')
+    assert third is not None
+    assert third.path == first.path
+
+
+def test_slots_per_host(admission_control):
+    local = admission_control.try_acquire('server_install')
+    remote = admission_control.try_acquire(
+        'server_install', host='tcp://builder2.ipa.test:2375')
+
+    assert local is not None and remote is not None
+    assert admission_control.try_acquire('server_install') is None
+
+
+def test_unlimited_step(admission_control):
+    assert aio.run(admission_control.acquire('prepare_tests')) is None
+
+    admission_control.slots['build'] = 0
+    assert aio.run(admission_control.acquire('build')) is None
+
+
+def test_acquire_waits(admission_control, monkeypatch):
+    monkeypatch.setattr(admission, 'POLL_INTERVAL_MIN', 0.01)
+    holder = admission_control.try_acquire('server_install')
+
+    async def release_later():
+        await asyncio.sleep(0.05)
+        holder.release()
+
+    async def acquire():
+        slot, _ = await asyncio.gather(
+            admission_control.acquire('install_server'), release_later())
+        return slot
+
+    start = time.time()
+    slot = aio.run(acquire())
+
+    assert slot is not None
+    assert time.time() - start >= 0.05
+
+
+def test_slot_held_by_other_process(admission_control):
+    """
+    The slots are shared with other runner processes and freed when the
+    holding process exits
+    """
+    lock_dir = admission_control.lock_dir
+    holder = subprocess.Popen(
+        [sys.executable, '-c',
+         'import sys; from ipadocker import admission; '
+         'a = admission.AdmissionControl({{"server_install": 1}}, {!r}); '
+         'a.try_acquire("server_install"); print("locked", flush=True); '
+         'sys.stdin.read()'.format(lock_dir)],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        assert holder.stdout.readline() == b'locked\n'
+        assert admission_control.try_acquire('server_install') is None
+    finally:
+        holder.communicate()
+
+    assert admission_control.try_acquire('server_install') is not None
+
+
+def test_parallel_steps_limited():
+    """
+    The steps running parallel jobs are subject to the admission control
+    """
+    parallel_steps = [
+        step_name for step_name, commands in
+        constants.DEFAULT_STEP_CONFIG.items()
+        if any('${jobs}' in cmd for cmd in commands)]
+
+    assert 'bisect_update' in parallel_steps
+    assert set(parallel_steps) <= set(admission.STEP_RESOURCE_CLASSES)
+
+
+def test_run_step_admission():
+    ipaconfig = config.IPADockerConfig(
+        {'admission': {'server_install': 1}})
+
+    fake_client = fakes.FakeDockerClient()
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    aio.run(cli.run_step(ipacontainer, 'install_server'))
+
+    step = ipacontainer.report.steps[-1]
+    assert step['name'] == 'install_server'
+    assert step['queued'] >= 0
+
+    # the slot is released after the step
+    control = admission.AdmissionControl.from_config(ipaconfig)
+    slot = control.try_acquire(
+        'server_install', host=constants.DEFAULT_DOCKER_URL)
+    assert slot is not None
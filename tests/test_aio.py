@@ -0,0 +1,147 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the asyncio execution engine
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from ipadocker import aio, command, config, container
+from tests import fakes
+
+
+def test_consume_order():
+    items = list(range(aio.STREAM_BUFFER * 4))
+    consumed = []
+
+    aio.run(aio.consume(iter(items), consumed.append))
+
+    assert consumed == items
+
+
+def test_consume_callback_error():
+    def callback(item):
+        if item == 10:
+            raise ValueError(item)
+
+    with pytest.raises(ValueError):
+        aio.run(aio.consume(range(aio.STREAM_BUFFER * 4), callback))
+
+
+def test_consume_iterable_error():
+    def failing_stream():
+        yield b'output'
+        raise RuntimeError("connection reset")
+
+    consumed = []
+    with pytest.raises(RuntimeError):
+        aio.run(aio.consume(failing_stream(), consumed.append))
+
+    assert consumed == [b'output']
+
+
+def test_consume_many_streams():
+    """
+    Open streams do not take up the executor running the other API calls
+    """
+    import threading
+
+    released = threading.Event()
+
+    def stream():
+        yield b'started'
+        released.wait(10)
+        yield b'finished'
+
+    async def consume_streams():
+        consumed = []
+        streams = [
+            asyncio.ensure_future(aio.consume(stream(), consumed.append))
+            for _index in range(aio.MAX_WORKERS * 2)]
+
+        while consumed.count(b'started') < len(streams):
+            await asyncio.sleep(0.01)
+
+        # all streams are open, the executor still runs the API calls
+        await asyncio.wait_for(aio.run_blocking(lambda: None), 5)
+        released.set()
+        await asyncio.gather(*streams)
+        return consumed
+
+    consumed = aio.run(consume_streams())
+
+    assert consumed.count(b'finished') == aio.MAX_WORKERS * 2
+
+
+def test_async_client():
+    fake_client = fakes.FakeDockerClient()
+    async_client = aio.async_client(fake_client)
+
+    assert aio.async_client(async_client) is async_client
+    assert async_client.base_url == fake_client.base_url
+
+    result = aio.run(async_client.create_container('image'))
+    assert result['Id'] in fake_client.containers
+
+
+def test_concurrent_containers():
+    """
+    Several containers are driven concurrently from a single event loop
+    """
+    containers = 4
+    chunks = 10
+    chunk_latency = 0.01
+
+    fake_client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=chunks),
+        chunk_latency=chunk_latency)
+    ipaconfig = config.IPADockerConfig()
+
+    async def run_container():
+        ipacontainer = await container.IPAContainer.create(
+            fake_client, ipaconfig)
+        step = command.ExecutionStep(['make'], {})
+        await step.run(ipacontainer)
+        await ipacontainer.stop_and_remove_async()
+
+    async def run_all():
+        await asyncio.gather(*[run_container() for _i in range(containers)])
+
+    start = time.perf_counter()
+    aio.run(run_all())
+    elapsed = time.perf_counter() - start
+
+    assert fake_client.commands.count("bash -c 'make'") == containers
+    assert not fake_client.containers
+    assert elapsed < containers * chunks * chunk_latency
+
+
+def test_gather_all():
+    cancelled = []
+
+    async def slow():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append('slow')
+            raise
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise ValueError("failed")
+
+    async def value(result):
+        return result
+
+    assert aio.run(aio.gather_all(value(1), value(2))) == [1, 2]
+
+    start = time.perf_counter()
+    with pytest.raises(ValueError):
+        aio.run(aio.gather_all(slow(), failing()))
+
+    assert cancelled == ['slow']
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,281 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Benchmarks of the runner's own overhead
+
+The Docker API is replaced by an in-process fake (see `tests.fakes`) so the
+suite runs without Docker daemon and network. Each benchmark records its
+throughput (see the 'benchmark results' section of the pytest summary) and
+fails if it drops below a floor. The floors are deliberately conservative and
+can be scaled by setting IPADOCKER_BENCH_SCALE environment variable (set it to
+0 to only report the numbers)
+"""
+
+import io
+import logging
+import os
+import time
+
+import docker
+import pytest
+
+from ipadocker import cli, command, config, constants, events
+from tests import fakes
+
+BENCH_SCALE = float(os.environ.get('IPADOCKER_BENCH_SCALE', '1.0'))
+
+# minimal acceptable throughput of individual benchmarks
+FLOORS = {
+    'config_merge': 200,
+    'template_render': 2000,
+    'resolved_lookup': 5000,
+    'exec_roundtrip': 500,
+    'output_streaming': 5000,
+    'orchestration': 50,
+}
+
+MIN_DURATION = 0.2
+
+
+def measure(func, min_duration=MIN_DURATION):
+    """
+    Call `func` repeatedly for at least `min_duration` seconds
+
+    :returns: tuple of (number of calls, elapsed time)
+    """
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_duration:
+            return calls, elapsed
+
+
+def check_floor(name, rate):
+    assert rate >= FLOORS[name] * BENCH_SCALE, (
+        "{} throughput regressed: {:.1f}/s".format(name, rate))
+
+
+@pytest.fixture(autouse=True)
+def no_default_config_file(monkeypatch, tmpdir):
+    """
+    Make sure that the user's config file does not skew the results
+    """
+    monkeypatch.setattr(
+        constants, 'DEFAULT_CONFIG_FILE', str(tmpdir.join('missing.yaml')))
+
+
+@pytest.yield_fixture()
+def exec_log():
+    """
+    Route the exec logger into an in-memory stream so that the formatting and
+    handling cost of every output line is included in the measurement
+    """
+    exec_logger = logging.getLogger('.'.join([command.__name__, 'exec']))
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter())
+
+    old_level, old_propagate = exec_logger.level, exec_logger.propagate
+    exec_logger.setLevel(logging.INFO)
+    exec_logger.propagate = False
+    exec_logger.addHandler(handler)
+    try:
+        yield stream
+    finally:
+        exec_logger.removeHandler(handler)
+        exec_logger.setLevel(old_level)
+        exec_logger.propagate = old_propagate
+
+
+@pytest.yield_fixture()
+def quiet_loggers():
+    """
+    Silence the informational messages of the runner itself
+    """
+    loggers = [logging.getLogger(name) for name in ('ipadocker',
+                                                    'IPAContainer')]
+    old_levels = [logger.level for logger in loggers]
+    for logger in loggers:
+        logger.setLevel(logging.WARNING)
+    try:
+        yield
+    finally:
+        for logger, level in zip(loggers, old_levels):
+            logger.setLevel(level)
+
+
+CONFIG_OVERRIDES = [
+    {'git_repo': '/test/repo.git'},
+    {'container': {'image': 'custom-image'}, 'host': {'privileged': True}},
+    {'server': {'domain': 'example.test', 'realm': 'EXAMPLE.TEST'}},
+]
+
+
+def test_config_merge(bench_report):
+    def merge():
+        ipaconfig = config.IPADockerConfig(*CONFIG_OVERRIDES)
+        ipaconfig.flatten()
+
+    calls, elapsed = measure(merge)
+    rate = calls / elapsed
+
+    bench_report('config merge + flatten', rate, 'configs/s')
+    check_floor('config_merge', rate)
+
+
+def test_template_render(bench_report):
+    ipaconfig = config.IPADockerConfig(*CONFIG_OVERRIDES)
+    flat_config = ipaconfig.flatten()
+    steps = ipaconfig['steps']
+
+    def render():
+        for step_name in steps:
+            command.ExecutionStep(
+                steps[step_name], flat_config, **TEMPLATE_VARS)
+
+    calls, elapsed = measure(render)
+    rate = calls * len(steps) / elapsed
+
+    bench_report('template rendering', rate, 'steps/s')
+    check_floor('template_render', rate)
+
+
+TEMPLATE_VARS = dict(
+    builddep_opts='', jobs=4, make_target='rpms', path='', tests_ignore='',
+    tests_verbose='', uid=1000, gid=1000,
+    source_dir=constants.FREEIPA_MNT_POINT,
+    profile_dir='/var/tmp/ipadocker-profile',
+    profile_plugin='ipadocker_profile')
+
+
+@pytest.mark.parametrize('layers', [1, 16, 64])
+def test_chained_lookup(bench_report, layers):
+    """
+    Render a step template from the chained config. This is what every step
+    execution used to do
+    """
+    ipaconfig = config.IPADockerConfig(
+        *[{'server': {'domain': 'layer{}.test'.format(i)}}
+          for i in range(layers)])
+
+    def render():
+        command.ExecutionStep(
+            ipaconfig['steps']['install_server'], ipaconfig.flatten())
+
+    calls, elapsed = measure(render)
+    bench_report(
+        'chained config lookup ({} layers)'.format(layers),
+        calls / elapsed, 'steps/s')
+
+
+@pytest.mark.parametrize('layers', [1, 16, 64])
+def test_resolved_lookup(bench_report, layers):
+    """
+    Render a step template from the resolved config. The cost must not depend
+    on the number of override layers
+    """
+    def make_config(layers):
+        return config.IPADockerConfig(
+            *[{'server': {'domain': 'layer{}.test'.format(i)}}
+              for i in range(layers)])
+
+    def rate(ipaconfig):
+        def render():
+            resolved = ipaconfig.resolve()
+            command.ExecutionStep(
+                resolved.templates['install_server'], resolved.flat)
+
+        calls, elapsed = measure(render)
+        return calls / elapsed
+
+    single_layer_rate = rate(make_config(1))
+    layered_rate = rate(make_config(layers))
+
+    bench_report(
+        'resolved config lookup ({} layers)'.format(layers),
+        layered_rate, 'steps/s')
+    check_floor('resolved_lookup', layered_rate)
+    assert layered_rate > 0.5 * single_layer_rate
+
+
+def test_exec_roundtrip(bench_report):
+    client = fakes.FakeDockerClient()
+    container_id = client.create_container('image')['Id']
+
+    calls, elapsed = measure(
+        lambda: command.exec_command(client, container_id, 'true'))
+    rate = calls / elapsed
+
+    bench_report('exec round-trip', rate, 'execs/s')
+    check_floor('exec_roundtrip', rate)
+
+
+@pytest.mark.parametrize('lines_per_chunk', [1, 64])
+def test_output_streaming(bench_report, exec_log, lines_per_chunk):
+    lines = 10000
+    client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(
+            lines=lines, line_length=120, lines_per_chunk=lines_per_chunk))
+    container_id = client.create_container('image')['Id']
+
+    calls, elapsed = measure(
+        lambda: command.exec_command(client, container_id, 'make rpms'))
+    rate = calls * lines / elapsed
+
+    assert exec_log.getvalue()
+    bench_report(
+        'output streaming ({} lines/chunk)'.format(lines_per_chunk),
+        rate, 'lines/s')
+    check_floor('output_streaming', rate)
+
+
+def test_output_streaming_events(bench_report, exec_log, tmpdir):
+    """
+    The event stream with the default byte counts must stay cheap under heavy
+    output
+    """
+    lines = 10000
+    client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(
+            lines=lines, line_length=120, lines_per_chunk=1))
+    container_id = client.create_container('image')['Id']
+
+    events.open_stream(str(tmpdir.join('events.ndjson')))
+    try:
+        calls, elapsed = measure(
+            lambda: command.exec_command(client, container_id, 'make rpms'))
+    finally:
+        events.close_stream()
+    rate = calls * lines / elapsed
+
+    bench_report('output streaming with events', rate, 'lines/s')
+    check_floor('output_streaming', rate)
+
+
+def test_orchestration(bench_report, exec_log, quiet_loggers, monkeypatch):
+    run_step = cli.run_step
+    steps = []
+
+    async def counting_run_step(docker_container, step_name, **kwargs):
+        steps.append(step_name)
+        await run_step(docker_container, step_name, **kwargs)
+
+    monkeypatch.setattr(cli, 'run_step', counting_run_step)
+    monkeypatch.setattr(
+        docker, 'Client',
+        lambda *args, **kwargs: fakes.FakeDockerClient(
+            exec_output=fakes.generate_output(lines=10)))
+
+    args = cli.make_parser().parse_args(['run-tests'])
+    ipaconfig = config.IPADockerConfig()
+
+    calls, elapsed = measure(
+        lambda: cli.run_action(ipaconfig, args, cli.run_tests))
+    rate = len(steps) / elapsed
+
+    bench_report('orchestration (run-tests chain)', rate, 'steps/s')
+    check_floor('orchestration', rate)
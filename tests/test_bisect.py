@@ -0,0 +1,139 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the bisection of the commits breaking or slowing down the tests
+"""
+
+import logging
+import subprocess
+import time
+
+import docker
+import pytest
+
+from ipadocker import cli, config
+from tests import fakes
+from tests.conftest import git
+
+
+def commit(repo, state, message):
+    repo.join('state').write(state)
+    git(repo, 'add', 'state')
+    git(repo, 'commit', '--quiet', '--allow-empty', '-m', message)
+
+
+@pytest.fixture()
+def git_repo(git_repo):
+    """
+    Repo with 8 more commits, the tests get slow in the 4th one and fail from
+    the 6th one on
+    """
+    repo = git_repo
+    for index in range(8):
+        if index >= 5:
+            state = 'broken'
+        elif index >= 3:
+            state = 'slow'
+        else:
+            state = 'ok'
+
+        commit(repo, state, 'commit {}'.format(index))
+
+    git(repo, 'tag', 'good', 'HEAD~7')
+    return repo
+
+
+class BisectDockerClient(fakes.FakeDockerClient):
+    """
+    Fake Docker daemon on which the tests behave according to the 'state'
+    file of the bind-mounted git repo
+    """
+    def __init__(self, **kwargs):
+        super(BisectDockerClient, self).__init__(
+            exit_codes={'# broken': 1}, **kwargs)
+
+    def exec_create(self, container, cmd, **kwargs):
+        if 'ipa-run-tests' in cmd:
+            git_repo = self.containers[container]['HostConfig'][
+                'binds'][-1].split(':')[0]
+            with open('{}/state'.format(git_repo)) as state_file:
+                state = state_file.read()
+
+            if state == 'slow':
+                time.sleep(0.2)
+            elif state == 'broken':
+                cmd = '{} # broken'.format(cmd)
+
+        return super(BisectDockerClient, self).exec_create(
+            container, cmd, **kwargs)
+
+
+@pytest.fixture()
+def daemon(monkeypatch):
+    daemon = BisectDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    return daemon
+
+
+def run_bisect(git_repo, *argv):
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    args = cli.make_parser().parse_args(['bisect'] + list(argv))
+    return cli.bisect(ipaconfig, args)
+
+
+def subject(git_repo, revision):
+    return subprocess.check_output(
+        ['git', '-C', str(git_repo), 'log', '-1', '--format=%h %s', revision]
+    ).decode().strip()
+
+
+def test_bisect_failure(git_repo, daemon, capsys):
+    assert run_bisect(git_repo, 'good', 'HEAD', '--',
+                      'test_xmlrpc/test_user_plugin.py') == 0
+
+    output = capsys.readouterr()[0]
+    assert 'First bad commit: {}'.format(
+        subject(git_repo, 'HEAD~2')) in output
+
+    # the server is installed once and then only upgraded
+    assert len([c for c in daemon.commands if 'ipa-server-install' in c]) == 1
+    upgrades = [c for c in daemon.commands if 'ipa-server-upgrade' in c]
+    tests = [c for c in daemon.commands if 'ipa-run-tests' in c]
+    assert len(upgrades) == len(tests) - 1
+    assert all('test_user_plugin.py' in c for c in tests)
+
+    # the repo of the user is left intact
+    assert git_repo.join('state').read() == 'broken'
+    assert not daemon.containers
+
+
+def test_bisect_duration(git_repo, daemon, capsys):
+    assert run_bisect(git_repo, '--max-duration', '0.1', 'good', 'HEAD~3') == 0
+
+    output = capsys.readouterr()[0]
+    assert 'First bad commit: {}'.format(
+        subject(git_repo, 'HEAD~4')) in output
+
+
+def test_bisect_skip(git_repo, daemon, capsys):
+    daemon.exit_codes['make'] = 2
+
+    assert run_bisect(git_repo, 'good', 'HEAD') == 1
+    assert 'could be any of' in capsys.readouterr()[0]
+
+
+def test_bisect_unknown_commit(git_repo, daemon):
+    assert run_bisect(git_repo, 'v1.0', 'master') == 2
+
+
+def test_bisect_container_failure(git_repo, daemon, monkeypatch, caplog):
+    def create_container(*args, **kwargs):
+        raise RuntimeError("no space left on device")
+
+    monkeypatch.setattr(daemon, 'create_container', create_container)
+
+    assert run_bisect(git_repo, 'good', 'HEAD') == 2
+    assert [record for record in caplog.records
+            if record.levelno == logging.ERROR and
+            'no space left on device' in record.getMessage()]
@@ -0,0 +1,212 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for checkpoints of the container and resumed runs
+"""
+
+import time
+
+import docker
+import pytest
+
+from ipadocker import (
+    aio, checkpoint, cli, command, config, report, snapshot)
+from tests import fakes
+from tests.conftest import git
+
+
+@pytest.fixture()
+def daemon(monkeypatch):
+    daemon = fakes.FakeDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    return daemon
+
+
+def run(ipaconfig, *argv):
+    args = cli.make_parser().parse_args(list(argv))
+    aio.run(cli.run_action_async(
+        ipaconfig, args, cli.get_action(args.action_name)))
+
+
+def test_source_hash(git_repo):
+    digest = snapshot.source_hash(str(git_repo))
+    assert snapshot.source_hash(str(git_repo)) == digest
+
+    git_repo.join('freeipa.spec.in').write('Version: 2\n')
+    assert snapshot.source_hash(str(git_repo)) != digest
+
+    # binary changes
+    git_repo.join('freeipa.spec.in').write_binary(b'\xff\xfe\0')
+    binary_digest = snapshot.source_hash(str(git_repo))
+    assert binary_digest != digest
+
+    # untracked files are part of the sources unless they are ignored
+    git_repo.join('freeipa.spec.in').write('Version: 1\n')
+    assert snapshot.source_hash(str(git_repo)) == digest
+    git_repo.join('freeipa.spec').write('Version: 1\n')
+    untracked_digest = snapshot.source_hash(str(git_repo))
+    assert untracked_digest != digest
+
+    git_repo.join('freeipa.spec').write('Version: 2\n')
+    assert snapshot.source_hash(str(git_repo)) != untracked_digest
+
+    git_repo.join('.gitignore').write('freeipa.spec\n')
+    git(git_repo, 'add', '.gitignore')
+    git(git_repo, 'commit', '--quiet', '-m', 'ignore')
+    ignored_digest = snapshot.source_hash(str(git_repo))
+    git_repo.join('freeipa.spec').write('Version: 3\n')
+    assert snapshot.source_hash(str(git_repo)) == ignored_digest
+
+
+def test_resume(git_repo, daemon):
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+
+    daemon.exit_codes = {'ipa-server-install': 1}
+    with pytest.raises(command.ContainerExecError):
+        run(ipaconfig, '--checkpoint', 'install-server')
+
+    commits = [kwargs['tag'] for method, _args, kwargs in daemon.calls
+               if method == 'commit']
+    assert [tag.split('-')[-1] for tag in commits] == [
+        'builddep', 'build', 'install_packages']
+
+    # the failed step is fixed, the run continues after the last checkpoint
+    daemon.exit_codes = {}
+    daemon.commands = []
+    run(ipaconfig, '--resume', 'install-server')
+
+    created = [args[0] for method, args, _kwargs in daemon.calls
+               if method == 'create_container']
+    assert created[-1] == 'ipa-docker-test-runner:{}'.format(commits[-1])
+    assert not [cmd for cmd in daemon.commands if 'make' in cmd]
+    assert [cmd for cmd in daemon.commands if 'ipa-server-install' in cmd]
+
+
+def test_resume_does_not_pull_checkpoint(git_repo, monkeypatch):
+    """
+    The checkpoint image is only on the Docker host which committed it
+    """
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    daemon = fakes.FakeDockerClient(
+        registry=[ipaconfig['container']['image']],
+        exit_codes={'ipa-server-install': 1})
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+
+    with pytest.raises(command.ContainerExecError):
+        run(ipaconfig, '--checkpoint', 'install-server')
+
+    daemon.exit_codes = {}
+    daemon.calls = []
+    run(ipaconfig, '--resume', 'install-server')
+
+    created = [args[0] for method, args, _kwargs in daemon.calls
+               if method == 'create_container']
+    assert created[0] in daemon.local_images
+    assert not [args for method, args, _kwargs in daemon.calls
+                if method == 'pull']
+
+
+def test_resume_changed_sources(git_repo, daemon):
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    run(ipaconfig, '--checkpoint', 'build')
+
+    git_repo.join('freeipa.spec.in').write('Version: 2\n')
+    daemon.commands = []
+    run(ipaconfig, '--resume', 'build')
+
+    assert [cmd for cmd in daemon.commands if 'dnf builddep' in cmd]
+
+
+def test_resume_different_commands(git_repo):
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    args = cli.make_parser().parse_args(['build'])
+    plan = cli.plan_action(ipaconfig, args, cli.build)
+
+    recorded = checkpoint.Checkpoint(ipaconfig, 'digest', plan.steps)
+    for step_name, _step in plan.steps:
+        recorded.record_step(step_name, image='image-{}'.format(step_name))
+
+    args = cli.make_parser().parse_args(['build', '--make-target', 'all'])
+    plan = cli.plan_action(ipaconfig, args, cli.build)
+
+    resumed = checkpoint.Checkpoint(ipaconfig, 'digest', plan.steps)
+    assert resumed.resume() == 'image-lint'
+    assert resumed.pending == ['builddep', 'configure', 'lint']
+
+    assert resumed.skip('builddep')
+    assert not resumed.skip('lint')
+    assert not resumed.skip('configure')
+
+
+def test_checkpoint_overlaps_startup(git_repo, daemon, monkeypatch):
+    """
+    The sources are hashed while the container starts
+    """
+    source_hash = snapshot.source_hash
+
+    def slow_source_hash(repo):
+        time.sleep(0.2)
+        return source_hash(repo)
+
+    monkeypatch.setattr(snapshot, 'source_hash', slow_source_hash)
+    daemon.exec_latency = 0.02
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    run_report = report.RunReport()
+
+    args = cli.make_parser().parse_args(['--checkpoint', 'build'])
+    aio.run(cli.run_action_async(
+        ipaconfig, args, cli.build, run_report=run_report))
+
+    stages = {stage['name']: stage for stage in run_report.startup_stages}
+    assert stages['checkpoint']['started'] < stages['pull']['finished']
+    assert run_report.startup_saved > 0
+    assert [method for method, _args, _kwargs in daemon.calls
+            if method == 'commit']
+
+
+def test_checkpoint_failure_removes_container(git_repo, daemon, monkeypatch):
+    def fail(*args):
+        time.sleep(0.1)
+        raise RuntimeError("cannot hash")
+
+    monkeypatch.setattr(cli, 'create_checkpoint', fail)
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+
+    with pytest.raises(RuntimeError):
+        run(ipaconfig, '--checkpoint', 'build')
+
+    # the container started meanwhile is removed
+    assert 'remove_container' in [method for method, _args, _kwargs
+                                  in daemon.calls]
+    assert not daemon.containers
+    assert not [cmd for cmd in daemon.commands if 'dnf' in cmd]
+
+
+def test_resume_after_container_died(git_repo, daemon, monkeypatch):
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    exec_start = daemon.exec_start
+
+    def oom_kill(exec_id, **kwargs):
+        if 'make' in daemon._execs[exec_id['Id']]['Cmd']:
+            daemon.die(next(iter(daemon.containers)))
+
+        return exec_start(exec_id, **kwargs)
+
+    monkeypatch.setattr(daemon, 'exec_start', oom_kill)
+    daemon.exit_codes = {'make': 137}
+
+    with pytest.raises(command.ContainerDied):
+        run(ipaconfig, '--checkpoint', 'build')
+
+    # the dead container is removed without the cleanup
+    assert not daemon.containers
+    assert not [cmd for cmd in daemon.commands if 'chown' in cmd]
+
+    monkeypatch.setattr(daemon, 'exec_start', exec_start)
+    daemon.exit_codes = {}
+    daemon.commands = []
+    run(ipaconfig, '--resume', 'build')
+
+    assert not [cmd for cmd in daemon.commands if 'builddep' in cmd]
+    assert [cmd for cmd in daemon.commands if 'make' in cmd]
@@ -6,12 +6,14 @@ Tests for CLI frontend
 """
 
 import os
+import subprocess
+import sys
 import tempfile
 
 import pytest
 import yaml
 
-from ipadocker import cli, constants
+from ipadocker import cli, command, config, constants, report
 
 
 def root_function(stack, args):
@@ -259,3 +261,212 @@ def test_cli_args(parser, cli_args):
 
     for item, value in cli_args[1]['args'].items():
         assert getattr(parsed_args, item) == value
+
+
+# maximum time in milliseconds that the import of the CLI module may take
+IMPORT_TIME_BUDGET = 150
+
+HEAVY_MODULES = ('docker', 'requests', 'urllib3', 'yaml')
+
+
+def _import_times(statement):
+    """
+    Execute the python statement under `python -X importtime` and return a
+    mapping of imported module names to the cumulative import time in
+    microseconds
+    """
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    times = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        _self_time, cumulative, module = line.split(':', 1)[1].split('|')
+        times[module.strip()] = int(cumulative)
+
+    return times
+
+
+@pytest.mark.parametrize('statement', [
+    'import ipadocker.cli',
+    'from ipadocker import cli; cli.make_parser().parse_args(["build"])',
+])
+def test_lazy_imports(statement):
+    """
+    Heavy modules must not be imported on the fast paths of the CLI
+    """
+    imported = _import_times(statement)
+
+    for module in HEAVY_MODULES:
+        assert module not in imported
+
+
+def test_import_time_budget():
+    """
+    Import of the CLI module must fit into the time budget
+    """
+    imported = _import_times('import ipadocker.cli')
+
+    assert imported['ipadocker.cli'] < IMPORT_TIME_BUDGET * 1000
+
+
+def test_plan_action(parser):
+    """
+    The plan must contain all steps of the action and its prerequisites
+    """
+    args = parser.parse_args(['run-tests', 'test_xmlrpc'])
+    plan = cli.plan_action(config.IPADockerConfig(), args, cli.run_tests)
+
+    assert [step_name for step_name, _step in plan.steps] == [
+        'builddep', 'configure', 'lint', 'build', 'install_packages',
+        'install_server', 'prepare_tests', 'run_tests', 'cleanup']
+
+    run_tests_step = dict(plan.steps)['run_tests']
+    assert run_tests_step.commands[0].endswith('test_xmlrpc')
+
+
+def test_plan_unit_tests(parser):
+    """
+    Server-independent tests need neither the packages nor the server
+    """
+    args = parser.parse_args(['unit-tests'])
+    plan = cli.plan_action(config.IPADockerConfig(), args, cli.unit_tests)
+
+    assert [step_name for step_name, _step in plan.steps] == [
+        'builddep', 'configure', 'unit_tests', 'cleanup']
+
+    unit_tests_step = dict(plan.steps)['unit_tests']
+    assert '--skip-ipaapi' in unit_tests_step.commands[-1]
+    assert unit_tests_step.commands[-1].endswith(
+        ' '.join(constants.DEFAULT_UNIT_TESTS_CONFIG['paths']))
+
+
+def test_plan_build_in_tmpfs(parser):
+    """
+    The sources are copied into the tmpfs before the build and the packages
+    are copied back after it
+    """
+    args = parser.parse_args(['install-server'])
+    ipaconfig = config.IPADockerConfig({'build_dir': {'tmpfs_size': '4g'}})
+    plan = cli.plan_action(ipaconfig, args, cli.install_server)
+
+    assert [step_name for step_name, _step in plan.steps] == [
+        'sync_sources', 'builddep', 'configure', 'lint', 'build',
+        'export_artifacts', 'install_packages', 'install_server', 'cleanup']
+
+    steps = dict(plan.steps)
+    assert steps['sync_sources'].commands == [
+        'cp -a /freeipa-source/. /freeipa/']
+    assert steps['cleanup'].commands[0].endswith(' /freeipa-source')
+
+
+@pytest.mark.parametrize('paths,action', [
+    (['test_ipalib/test_frontend.py', 'ipatests/test_ipapython'],
+     cli.unit_tests),
+    (['test_ipapython/test_dn.py::TestDN'], cli.unit_tests),
+    (['test_ipalib', 'test_xmlrpc/test_user_plugin.py'], cli.run_tests),
+    (['test_ipalibx'], cli.run_tests),
+    ([], cli.run_tests),
+])
+def test_fast_lane(parser, paths, action):
+    args = parser.parse_args(['run-tests'] + paths)
+    assert cli.fast_lane(
+        config.IPADockerConfig(), args, cli.run_tests) is action
+
+
+def test_unit_tests_server_paths(parser, monkeypatch, capsys):
+    """
+    'unit-tests' with only paths needing a server fails before any container
+    is created
+    """
+    args = parser.parse_args(['unit-tests', 'test_xmlrpc'])
+    with pytest.raises(ValueError):
+        cli.fast_lane(config.IPADockerConfig(), args, cli.unit_tests)
+
+    def fail(*args, **kwargs):
+        raise AssertionError("container must not be created")
+
+    monkeypatch.setattr(cli, 'create_container', fail)
+    monkeypatch.setattr(
+        sys, 'argv', ['ipa-docker-test-runner', 'unit-tests', 'test_xmlrpc'])
+
+    with pytest.raises(SystemExit) as e:
+        cli.main()
+
+    assert e.value.code == 2
+    assert "use 'run-tests'" in capsys.readouterr()[1]
+
+
+def test_unit_tests_split(parser):
+    args = parser.parse_args(
+        ['unit-tests', 'test_ipalib', 'test_xmlrpc/test_user_plugin.py'])
+    plan = cli.plan_action(config.IPADockerConfig(), args, cli.unit_tests)
+
+    assert dict(plan.steps)['unit_tests'].commands[-1].endswith(
+        '--verbose test_ipalib')
+
+
+def test_plan_invalid_template(parser, monkeypatch):
+    """
+    Invalid step template must be reported before the container is created
+    """
+    def fail(*args, **kwargs):
+        raise AssertionError("container must not be created")
+
+    monkeypatch.setattr(cli, 'create_container', fail)
+
+    args = parser.parse_args(['build'])
+    ipaconfig = config.IPADockerConfig(
+        {'steps': {'build': ['make ${make_targte}']}})
+
+    with pytest.raises(RuntimeError):
+        cli.run_action(ipaconfig, args, cli.build)
+
+
+def test_dry_run(parser, capsys):
+    args = parser.parse_args(['--dry-run', 'build'])
+    history = report.StepHistory()
+    history.record(constants.DEFAULT_IMAGE, 'build', 65)
+
+    plan = cli.plan_action(config.IPADockerConfig(), args, cli.build)
+    cli.print_plan(plan, args, history)
+
+    output = capsys.readouterr()[0]
+    assert 'make -j{} rpms'.format(plan.jobs) in output
+    assert '1m 05s' in output
+
+
+@pytest.mark.parametrize('version,jobs,expected', [
+    ('3.7.0', 4, '-p 4'),
+    ('4.11.3', 4, '-p 4'),
+    ('3.6.1', 4, ''),
+    ('2.9.1', 4, ''),
+    ('3.7.0', 1, ''),
+])
+def test_tox_parallel(tmpdir, version, jobs, expected):
+    """
+    Parallel mode is used only with tox supporting it
+    """
+    tox = tmpdir.join('tox')
+    tox.write(
+        '#!/bin/sh\n'
+        'if [ "$1" = --version ]; then\n'
+        '    echo "{} imported from /usr/lib/python3/tox"\n'
+        'else\n'
+        '    echo "$@"\n'
+        'fi\n'.format(version))
+    tox.chmod(0o755)
+
+    resolved_cfg = config.IPADockerConfig().resolve()
+    [tox_command] = command.ExecutionStep(
+        resolved_cfg.templates['tox'], resolved_cfg.flat, jobs=jobs).commands
+
+    output = subprocess.check_output(
+        ['bash', '-c', tox_command],
+        env=dict(os.environ, PATH='{}:{}'.format(tmpdir, os.environ['PATH'])))
+    assert output.decode().strip() == expected
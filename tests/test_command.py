@@ -5,9 +5,15 @@
 Tests for command execution logic
 """
 
+import asyncio
+import re
+import threading
+import time
+
 import pytest
 
-from ipadocker import cli, command, config, constants
+from ipadocker import aio, cli, command, config, constants, container
+from tests import fakes
 
 
 @pytest.fixture
@@ -24,7 +30,7 @@ def flattened_config(request, ipaconfig):
 
 
 DEFAULT_BUILDS_SUBSTITUTED = {
-    'build': ['make {c.DEFAULT_MAKE_TARGET}'.format(c=cli)],
+    'build': ['make -j4 {c.DEFAULT_MAKE_TARGET}'.format(c=cli)],
     'install_server': [
         ('ipa-server-install -U --domain ipa.test '
          '--realm IPA.TEST -p Secret123 -a Secret123 '
@@ -47,7 +53,7 @@ def default_namespace(request, substituted_commands):
     parser = cli.make_parser()
     subcommand_name = substituted_commands[0].replace('_', '-')
     args = parser.parse_args([subcommand_name])
-    return vars(args)
+    return dict(vars(args), jobs=4)
 
 
 def test_execution_step_instantiation(ipaconfig, flattened_config,
@@ -64,3 +70,169 @@ def test_execution_step_instantiation(ipaconfig, flattened_config,
 def test_invalid_template_string(flattened_config):
     with pytest.raises(KeyError):
         command.ExecutionStep(['make ${invalid_var}'], flattened_config)
+
+
+def test_command_timeout():
+    fake_client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=100), chunk_latency=0.01)
+    ipacontainer = aio.run(container.IPAContainer.create(
+        fake_client, config.IPADockerConfig()))
+
+    step = command.ExecutionStep(['npm install'], {})
+    with pytest.raises(command.ContainerExecTimeout) as excinfo:
+        aio.run(step.run(ipacontainer, command_timeout=0.05))
+
+    assert excinfo.value.exit_code == 124
+    assert excinfo.value.diagnostics
+
+    # the command runs in its own session which is killed on timeout
+    run_cmd, kill_cmd = fake_client.commands[-2:]
+    pidfile = re.search(r'echo \$\$ > (\S+);', run_cmd).group(1)
+    assert run_cmd.startswith('setsid --wait')
+    assert 'pkill -KILL -s $sid' in kill_cmd
+    assert pidfile in kill_cmd
+
+
+def test_step_timeout():
+    """
+    The step timeout covers all commands of the step
+    """
+    fake_client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=5), chunk_latency=0.01)
+    ipaconfig = config.IPADockerConfig({
+        'steps': {'build': ['make one', 'make two']},
+        'execution': {'step_timeouts': {'build': 0.08}}
+    })
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    with pytest.raises(command.ContainerExecTimeout):
+        aio.run(cli.run_step(ipacontainer, 'build'))
+
+    step = ipacontainer.report.steps[-1]
+    assert step['name'] == 'build'
+    assert not step['success']
+    assert 0 < step['timeout'] <= 0.08
+    assert fake_client.commands[-2].endswith("make two'")
+
+
+@pytest.mark.parametrize('retry_config,success,retries', [
+    ({'attempts': 3, 'backoff': 0}, True, 2),
+    ({'attempts': 2, 'backoff': 0}, False, 1),
+    ({'attempts': 3, 'backoff': 0, 'exit_codes': [7]}, False, 0),
+])
+def test_step_retries(retry_config, success, retries):
+    fake_client = fakes.FakeDockerClient(
+        transient_failures={'npm install': (1, 2)})
+    ipaconfig = config.IPADockerConfig({
+        'steps': {'webui_unit': ['make', 'npm install']},
+        'execution': {'retries': {'webui_unit': retry_config}}
+    })
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    try:
+        aio.run(cli.run_step(ipacontainer, 'webui_unit'))
+    except command.ContainerExecError:
+        pass
+
+    # only the failed command is retried
+    assert len([c for c in fake_client.commands if 'make' in c]) == 1
+    assert len([c for c in fake_client.commands if 'npm' in c]) == (
+        retries + 1)
+
+    step = ipacontainer.report.steps[-1]
+    assert step['success'] == success
+    assert step.get('retries', 0) == retries
+
+
+def test_retry_backoff(monkeypatch):
+    delays = []
+
+    async def sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(asyncio, 'sleep', sleep)
+
+    async def fail():
+        raise ConnectionError("connection reset by peer")
+
+    retry_policy = command.RetryPolicy(attempts=4, backoff=5)
+    with pytest.raises(ConnectionError):
+        aio.run(retry_policy.run(fail))
+
+    assert delays == [5, 10, 20]
+    assert retry_policy.retries == 3
+
+
+def test_container_died():
+    """
+    The command is aborted as soon as the container dies even if its output
+    stream hangs, the step is not retried
+    """
+    fake_client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=100), chunk_latency=0.05)
+    ipaconfig = config.IPADockerConfig({
+        'steps': {'build': ['make']},
+        'execution': {'retries': {'build': {'attempts': 3, 'backoff': 0}}}
+    })
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    threading.Timer(
+        0.1, fake_client.die, [ipacontainer.container_id]).start()
+
+    start = time.perf_counter()
+    with pytest.raises(command.ContainerDied) as excinfo:
+        aio.run(cli.run_step(ipacontainer, 'build'))
+
+    assert time.perf_counter() - start < 1
+    assert excinfo.value.oom_killed
+    assert excinfo.value.exit_code == 137
+    assert 'OOM killed' in str(excinfo.value)
+    assert ipacontainer.death['OOMKilled']
+    assert len([c for c in fake_client.commands if 'make' in c]) == 1
+
+    step = ipacontainer.report.steps[-1]
+    assert not step['success']
+    assert step['container_died'] == 137
+    assert step['oom_killed']
+
+
+def test_container_died_stream_closed(monkeypatch):
+    """
+    The output stream of the command ends when the container dies, the
+    failure is reported as the death of the container
+    """
+    fake_client = fakes.FakeDockerClient(exit_codes={'make': 137})
+    ipacontainer = aio.run(container.IPAContainer.create(
+        fake_client, config.IPADockerConfig()))
+
+    exec_inspect = fake_client.exec_inspect
+
+    def die_and_inspect(exec_id):
+        fake_client.die(
+            ipacontainer.container_id, exit_code=255, oom_killed=False,
+            error='systemd crashed')
+        return exec_inspect(exec_id)
+
+    monkeypatch.setattr(fake_client, 'exec_inspect', die_and_inspect)
+
+    step = command.ExecutionStep(['make'], {})
+    with pytest.raises(command.ContainerDied) as excinfo:
+        aio.run(step.run(ipacontainer))
+
+    assert excinfo.value.exit_code == 255
+    assert not excinfo.value.oom_killed
+    assert 'systemd crashed' in str(excinfo.value)
+
+
+def test_container_stopped_on_purpose():
+    fake_client = fakes.FakeDockerClient()
+    ipacontainer = aio.run(container.IPAContainer.create(
+        fake_client, config.IPADockerConfig()))
+
+    aio.run(ipacontainer.stop_and_remove_async())
+
+    assert ipacontainer.watcher.cancelled()
+    assert ipacontainer.death is None
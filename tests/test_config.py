@@ -157,6 +157,21 @@ def test_write_config(ipaconfig):
         pass
 
 
+def test_write_config_without_aliases(ipaconfig):
+    """
+    The retry policies of the steps do not share their values, the written
+    config has no YAML aliases
+    """
+    import io
+
+    output = io.StringIO()
+    ipaconfig.write_config(output)
+    assert '&id' not in output.getvalue()
+
+    retries = constants.DEFAULT_RETRIES_CONFIG
+    assert retries['build']['exit_codes'] is not retries['lint']['exit_codes']
+
+
 NESTED_MAPPING = {
     'key1': 'value1',
     'key2': {
@@ -199,3 +214,40 @@ def test_deepened_mapping():
                                            reference=NESTED_MAPPING)
 
     assert nested_mapping == NESTED_MAPPING
+
+
+def test_resolved_config(ipaconfig):
+    """
+    Test that the resolved view matches the merged config and is read-only
+    """
+    resolved = ipaconfig.resolve()
+
+    assert resolved is ipaconfig.resolve()
+    assert dict(resolved.flat) == {
+        key: tuple(value) if isinstance(value, list) else value
+        for key, value in ipaconfig.flatten().items()
+    }
+    assert resolved['container']['image'] == (
+        ipaconfig['container']['image'])
+
+    for step_name, commands in ipaconfig['steps'].items():
+        templates = resolved.templates[step_name]
+        assert [t.template for t in templates] == commands
+
+    with pytest.raises(TypeError):
+        resolved['container']['image'] = 'another-image'
+
+    with pytest.raises(AttributeError):
+        resolved['host']['binds'].append('/src:/dest')
+
+
+def test_resolved_config_copy(ipaconfig):
+    """
+    Modified copies of the config must not share the resolved view
+    """
+    ipaconfig.resolve()
+    config_copy = deepcopy(ipaconfig)
+    config_copy['host']['binds'].append('/src:/dest')
+
+    assert '/src:/dest' in config_copy.resolve()['host']['binds']
+    assert '/src:/dest' not in ipaconfig.resolve()['host']['binds']
@@ -6,10 +6,16 @@ Test suite for IPAContainer() initialization
 """
 
 
+import time
+
 import docker
 import pytest
 
-from ipadocker import config, container
+from ipadocker import aio, cli, config, container
+
+# number of source files of the synthetic build in the build directory
+# benchmark
+BENCH_SOURCE_FILES = 2000
 
 
 @pytest.fixture()
@@ -43,3 +49,70 @@ def test_container_init(ipacontainer):
     Initialize the container and check that it has 'running' status
     """
     assert ipacontainer.status == u'running'
+
+
+@pytest.fixture()
+def docker_daemon():
+    """
+    Docker API client, the test is skipped when the daemon is not running
+    """
+    try:
+        return docker.Client(
+            base_url='unix://var/run/docker.sock', version='auto')
+    except Exception as e:
+        pytest.skip("Docker daemon is not available: {}".format(e))
+
+
+@pytest.fixture()
+def source_tree(tmpdir):
+    """
+    Git repo stand-in with many small Python modules
+    """
+    repo = tmpdir.mkdir('freeipa')
+    package = repo.mkdir('ipalib')
+    for index in range(BENCH_SOURCE_FILES):
+        package.join('module{}.py'.format(index)).write(
+            'def function{0}():\n    return {0}\n'.format(index) * 20)
+
+    return repo
+
+
+@pytest.mark.parametrize('tmpfs_size', ['', '1g'])
+def test_build_dir_benchmark(docker_daemon, source_tree, bench_report,
+                             tmpfs_size):
+    """
+    Compare a small-file build workload (byte-compiling the sources and
+    packing the result into dist/) in the bind-mounted git repo and in the
+    tmpfs build directory, including the copying of the sources and of the
+    artifacts
+    """
+    ipaconfig = config.IPADockerConfig({
+        'git_repo': str(source_tree),
+        'build_dir': {'tmpfs_size': tmpfs_size},
+        'steps': {
+            'build': [
+                'python3 -m compileall -q -j ${jobs} ipalib',
+                'mkdir -p dist && tar czf dist/ipalib.tar.gz ipalib'
+            ]
+        }
+    })
+    ipacontainer = container.IPAContainer(docker_daemon, ipaconfig)
+
+    async def build():
+        await cli.sources(ipacontainer, None)
+        await cli.run_step(ipacontainer, 'build')
+        if tmpfs_size:
+            await cli.run_step(ipacontainer, 'export_artifacts')
+
+    try:
+        start = time.perf_counter()
+        aio.run(build())
+        elapsed = time.perf_counter() - start
+        aio.run(cli.cleanup(ipacontainer))
+    finally:
+        ipacontainer.stop_and_remove()
+
+    assert source_tree.join('dist', 'ipalib.tar.gz').check()
+    bench_report(
+        'build in {}'.format('tmpfs' if tmpfs_size else 'bind mount'),
+        elapsed, 's')
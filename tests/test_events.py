@@ -0,0 +1,101 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the machine-readable event stream
+"""
+
+import json
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, command, config, container, events
+from tests import fakes
+
+
+@pytest.yield_fixture()
+def event_file(tmpdir):
+    filename = tmpdir.join('events.ndjson')
+    yield filename
+    events.close_stream()
+
+
+def read_events(event_file):
+    events.close_stream()
+    return [json.loads(line) for line in event_file.readlines()]
+
+
+def test_run_events(event_file, monkeypatch):
+    daemon = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=10),
+        exit_codes={'make': 2})
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    events.open_stream(str(event_file))
+
+    args = cli.make_parser().parse_args(['build'])
+    with pytest.raises(command.ContainerExecError):
+        cli.run_action(config.IPADockerConfig(), args, cli.build)
+
+    run_events = read_events(event_file)
+    names = [event['event'] for event in run_events]
+    assert names[0] == 'run_start'
+    assert names[-1] == 'run_end'
+    assert names.index('container_create') < names.index('container_ready')
+    assert names.index('container_ready') < names.index('step_start')
+    assert 'container_remove' in names
+
+    steps = [(event['step'], event['success']) for event in run_events
+             if event['event'] == 'step_end']
+    assert steps == [('builddep', True), ('configure', True),
+                     ('lint', False), ('cleanup', True)]
+
+    failed = [event for event in run_events
+              if event['event'] == 'command_end' and event['exit_code']]
+    assert len(failed) == 1
+    assert failed[0]['bytes'] == 10 * 81
+
+    assert run_events[-1]['exit_code'] == 2
+    assert all(event['time'] for event in run_events)
+
+
+@pytest.mark.parametrize('output_text', [False, True])
+def test_output_events(event_file, output_text):
+    client = fakes.FakeDockerClient(
+        exec_output=fakes.generate_output(lines=100, lines_per_chunk=10))
+    container_id = client.create_container('image')['Id']
+    events.open_stream(str(event_file), output_text=output_text)
+
+    command.exec_command(client, container_id, 'make rpms')
+
+    output_events = [event for event in read_events(event_file)
+                     if event['event'] == 'output']
+    assert sum(event['bytes'] for event in output_events) == 100 * 81
+    assert sum(event['chunks'] for event in output_events) == 10
+
+    if output_text:
+        assert len(output_events) == 10
+        assert output_events[0]['text'] == ('x' * 80 + '\n') * 10
+    else:
+        assert len(output_events) == 1
+        assert 'text' not in output_events[0]
+
+
+def test_cache_hit(event_file):
+    ipacontainer = aio.run(container.IPAContainer.create(
+        fakes.FakeDockerClient(), config.IPADockerConfig()))
+    ipacontainer.completed_steps = {}
+    events.open_stream(str(event_file))
+
+    aio.run(cli.configure(ipacontainer, None))
+    aio.run(cli.configure(ipacontainer, None))
+
+    hits = [(event['step'], event['cache'])
+            for event in read_events(event_file)
+            if event['event'] == 'cache_hit']
+    assert hits == [('builddep', 'container'), ('configure', 'container')]
+
+
+def test_disabled():
+    assert not events.enabled()
+    events.emit('step_start', step='build')
@@ -0,0 +1,192 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for building of the test runner images
+"""
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, config, constants, images
+from tests import fakes
+
+BUILDDEP_OPTS = ' '.join(cli.DEFAULT_BUILD_OPTS)
+
+
+@pytest.fixture()
+def git_repo(tmpdir):
+    repo = tmpdir.mkdir('freeipa')
+    repo.join(images.SPEC_FILE).write('BuildRequires: gcc\n')
+    return repo
+
+
+@pytest.fixture()
+def ipaconfig(git_repo):
+    return config.IPADockerConfig({'git_repo': str(git_repo)})
+
+
+def test_find_variants():
+    variants = images.find_variants(constants.DEFAULT_DOCKERFILE_DIR)
+
+    assert {'fedora', 'fedora27', 'fedora29', 'fedora30',
+            'rawhide'} <= set(variants)
+    assert variants['fedora'].dockerfile == 'Dockerfile'
+    assert variants['rawhide'].dockerfile == 'Dockerfile.rawhide'
+    assert variants['rawhide'].base_image == (
+        'freeipa/freeipa-builder:master-rawhide')
+
+
+def test_build_variants(ipaconfig):
+    variants = images.find_variants(constants.DEFAULT_DOCKERFILE_DIR)
+    fake_client = fakes.FakeDockerClient()
+
+    tags = aio.run(images.build_variants(
+        fake_client, ipaconfig, list(variants.values()), pull=True))
+
+    pulls = [args[0] for method, args, _ in fake_client.calls
+             if method == 'pull']
+    assert sorted(pulls) == sorted(
+        {variant.base_image for variant in variants.values()})
+
+    assert 'ipa-docker-test-runner:rawhide' in tags
+    assert set(tags) <= fake_client.images
+
+
+def test_build_error(ipaconfig):
+    variants = images.find_variants(constants.DEFAULT_DOCKERFILE_DIR)
+    fake_client = fakes.FakeDockerClient()
+    fake_client.failing_builds.add('ipa-docker-test-runner:rawhide')
+
+    with pytest.raises(images.ImageBuildError):
+        aio.run(images.build_variants(
+            fake_client, ipaconfig, [variants['rawhide']]))
+
+
+def test_build_builddep_image(ipaconfig, git_repo):
+    fake_client = fakes.FakeDockerClient()
+
+    tag = aio.run(images.build_builddep_image(
+        fake_client, ipaconfig, BUILDDEP_OPTS))
+
+    assert tag.startswith('ipa-docker-test-runner:builddep-')
+    context = fake_client.build_contexts[tag]
+    assert context[images.SPEC_FILE] == b'BuildRequires: gcc\n'
+
+    dockerfile = context['Dockerfile'].decode()
+    assert dockerfile.startswith(
+        'FROM {}\n'.format(constants.DEFAULT_IMAGE))
+    assert 'dnf builddep' in dockerfile
+
+    # the image is tagged by the contents of the spec file
+    git_repo.join(images.SPEC_FILE).write('BuildRequires: clang\n')
+    assert images.builddep_tag(
+        ipaconfig, images.spec_hash(ipaconfig, BUILDDEP_OPTS)) != tag
+
+
+def test_use_builddep_image(ipaconfig, git_repo):
+    assert images.use_builddep_image(ipaconfig, BUILDDEP_OPTS) is ipaconfig
+
+    enabled = ipaconfig.override({'images': {'builddep': True}})
+    expected_tag = images.builddep_tag(
+        enabled, images.spec_hash(enabled, BUILDDEP_OPTS))
+
+    used = images.use_builddep_image(enabled, BUILDDEP_OPTS)
+    assert used['container']['image'] == expected_tag
+    assert used['images']['builddep']
+
+    # builddep step is skipped in the image with the dependencies
+    args = cli.make_parser().parse_args(['build'])
+    plan = cli.plan_action(used, args, cli.build)
+    assert 'builddep' not in dict(plan.steps)
+
+    git_repo.join(images.SPEC_FILE).remove()
+    fallback = images.use_builddep_image(enabled, BUILDDEP_OPTS)
+    assert fallback['container']['image'] == constants.DEFAULT_IMAGE
+    assert not fallback['images']['builddep']
+
+
+def test_missing_builddep_image(ipaconfig, monkeypatch):
+    """
+    The base image is used until the builddep image is built on the Docker
+    host
+    """
+    fake_client = fakes.FakeDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: fake_client)
+
+    enabled = ipaconfig.override({'images': {'builddep': True}})
+    args = cli.make_parser().parse_args(['build'])
+
+    lookup_client = cli.builddep_lookup_client(enabled, args)
+    assert lookup_client is fake_client
+
+    fallback = cli.builddep_config(enabled, args, lookup_client)
+    assert fallback['container']['image'] == constants.DEFAULT_IMAGE
+    assert not fallback['images']['builddep']
+    assert 'builddep' in dict(cli.plan_action(fallback, args, cli.build).steps)
+
+    builddep_image = aio.run(images.build_builddep_image(
+        fake_client, enabled, BUILDDEP_OPTS))
+    used = cli.builddep_config(enabled, args, lookup_client)
+    assert used['container']['image'] == builddep_image
+
+    # dry runs do not talk to Docker
+    dry_run_args = cli.make_parser().parse_args(['--dry-run', 'build'])
+    assert cli.builddep_lookup_client(enabled, dry_run_args) is None
+
+
+def test_run_in_local_images(ipaconfig, monkeypatch):
+    """
+    The builddep and variant images are not in the registry, they are used
+    from the Docker host which built them
+    """
+    fake_client = fakes.FakeDockerClient(registry=[constants.DEFAULT_IMAGE])
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: fake_client)
+
+    enabled = ipaconfig.override({'images': {'builddep': True}})
+    builddep_image = aio.run(images.build_builddep_image(
+        fake_client, enabled, BUILDDEP_OPTS))
+    variant = images.find_variants(constants.DEFAULT_DOCKERFILE_DIR)['fedora']
+    variant_image, = aio.run(images.build_variants(
+        fake_client, ipaconfig, [variant]))
+
+    args = cli.make_parser().parse_args(['build'])
+    cli.run_action(
+        images.use_builddep_image(enabled, BUILDDEP_OPTS), args, cli.build)
+    cli.run_action(
+        ipaconfig.override({'container': {'image': variant_image}}), args,
+        cli.build)
+
+    created = [args[0] for method, args, _kwargs in fake_client.calls
+               if method == 'create_container']
+    assert created == [builddep_image, variant_image]
+    assert not [args for method, args, _kwargs in fake_client.calls
+                if method == 'pull']
+
+
+def test_cli_build_image(ipaconfig, monkeypatch):
+    daemons = {}
+
+    def make_client(base_url, **kwargs):
+        daemons[base_url] = fakes.FakeDockerClient(base_url=base_url)
+        return daemons[base_url]
+
+    monkeypatch.setattr(docker, 'Client', make_client)
+
+    ipaconfig = ipaconfig.override({
+        'hosts': [
+            {'base_url': 'tcp://builder1:2375', 'slots': 1},
+            {'base_url': 'tcp://builder2:2375', 'slots': 1},
+        ]
+    })
+    parser = cli.make_parser()
+
+    args = parser.parse_args(['build-image', '--builddep', 'fedora30'])
+    assert cli.build_image(ipaconfig, args) == 0
+
+    for fake_client in daemons.values():
+        assert 'ipa-docker-test-runner:fedora30' in fake_client.images
+        assert len(fake_client.build_contexts) == 1
+
+    args = parser.parse_args(['build-image', 'fedora42'])
+    assert cli.build_image(ipaconfig, args) == 1
@@ -0,0 +1,183 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the server-side latency report
+"""
+
+import json
+import re
+
+import docker
+
+from ipadocker import aio, cli, config, container, latency
+from tests import fakes
+
+IPA_LOG_LINES = [
+    ('[Tue Mar 07 10:00:00.000000 2017] [wsgi:error] [pid 100] ipa: INFO: '
+     '[jsonserver_session] admin@IPA.TEST: user_add/1(u\'tuser1\', '
+     'givenname=u\'Test\', version=u\'2.220\'): SUCCESS etime=250000000'),
+    ('[Tue Mar 07 10:00:01.000000 2017] [wsgi:error] [pid 100] ipa: INFO: '
+     '[jsonserver_session] admin@IPA.TEST: user_add/1(u\'tuser2\'): '
+     'SUCCESS etime=150000000'),
+    ('[Tue Mar 07 10:00:02.000000 2017] [wsgi:error] [pid 100] ipa: INFO: '
+     '[jsonserver_kerb] admin@IPA.TEST: ping/1(): SUCCESS'),
+    ('[Tue Mar 07 10:00:03.000000 2017] [wsgi:error] [pid 100] ipa: INFO: '
+     '[jsonserver_session] admin@IPA.TEST: user_del/1(u\'nobody\'): '
+     'NotFound etime=50000000'),
+    ('[Tue Mar 07 10:00:04.000000 2017] [wsgi:error] [pid 100] ipa: DEBUG: '
+     'WSGI wsgi_execute PublicError: Traceback'),
+]
+
+HTTPD_LOG_LINES = [
+    '10.0.0.1 [07/Mar/2017:10:00:00 +0000] "POST /ipa/session/json HTTP/1.1" '
+    '200 250123',
+    '10.0.0.1 [07/Mar/2017:10:00:01 +0000] "POST /ipa/session/json HTTP/1.1" '
+    '200 150000',
+    '10.0.0.1 [07/Mar/2017:10:00:02 +0000] "GET /ipa/config/ca.crt?x=1 '
+    'HTTP/1.1" 200 1000',
+]
+
+DIRSRV_LOG_LINES = [
+    '[07/Mar/2017:10:00:00.1 +0000] conn=5 op=2 RESULT err=0 tag=101 '
+    'nentries=1 etime=0.000100',
+    ('[07/Mar/2017:10:00:00.2 +0000] conn=7 op=1 SRCH base="cn=users,'
+     'cn=accounts,dc=ipa,dc=test" scope=2 filter="(uid=tuser1)" attrs=ALL'),
+    ('[07/Mar/2017:10:00:00.3 +0000] conn=7 op=2 ADD '
+     'dn="uid=tuser1,cn=users,cn=accounts,dc=ipa,dc=test"'),
+    ('[07/Mar/2017:10:00:00.4 +0000] conn=7 op=1 RESULT err=0 tag=101 '
+     'nentries=0 etime=0.002000'),
+    ('[07/Mar/2017:10:00:00.5 +0000] conn=7 op=2 RESULT err=0 tag=105 '
+     'nentries=0 etime=0.150000'),
+    ('[07/Mar/2017:10:00:00.6 +0000] conn=8 op=0 BIND dn="" method=sasl '
+     'version=3 mech=GSSAPI'),
+    ('[07/Mar/2017:10:00:00.7 +0000] conn=8 op=0 RESULT err=14 tag=97 '
+     'nentries=0 etime=0.010000, SASL bind in progress'),
+]
+
+
+def test_percentile():
+    values = list(range(1, 101))
+
+    assert latency.percentile(values, 0.5) == 50
+    assert latency.percentile(values, 0.99) == 99
+    assert latency.percentile(values, 1.0) == 100
+    assert latency.percentile([7], 0.9) == 7
+
+
+def test_parse_ipa_log():
+    rows = latency.parse_ipa_log(IPA_LOG_LINES).summary()
+
+    assert [(row['name'], row['count']) for row in rows] == [
+        ('user_add', 2), ('user_del', 1), ('ping', 1)]
+    assert rows[0]['total'] == 0.4
+    assert rows[0]['p50'] == 0.15
+    assert rows[0]['max'] == 0.25
+    # the server does not log the duration of the command
+    assert 'total' not in rows[2]
+
+
+def test_parse_httpd_log():
+    rows = latency.parse_httpd_log(HTTPD_LOG_LINES).summary()
+
+    assert [(row['name'], row['count']) for row in rows] == [
+        ('POST /ipa/session/json', 2), ('GET /ipa/config/ca.crt', 1)]
+    assert rows[0]['max'] == 0.250123
+
+
+def test_parse_dirsrv_log():
+    stats, slowest = latency.parse_dirsrv_log(DIRSRV_LOG_LINES)
+    rows = stats.summary()
+
+    # the result of conn=5 op=2 belongs to an operation started before
+    assert [(row['name'], row['count']) for row in rows] == [
+        ('ADD', 1), ('BIND', 1), ('SRCH', 1)]
+    assert [operation['duration'] for operation in slowest] == [
+        0.15, 0.01, 0.002]
+    assert slowest[0]['detail'] == (
+        'dn="uid=tuser1,cn=users,cn=accounts,dc=ipa,dc=test"')
+
+
+def read_file(daemon):
+    """
+    Fake the reading of the end of the file in the container
+    """
+    def read(cmd):
+        match = re.search(r'tail -c \+(\d+) (\S+)', cmd)
+        content = daemon.files.get(match.group(2))
+        if content is None:
+            return b''
+
+        return '{}\n'.format(len(content)).encode() + content[
+            int(match.group(1)) - 1:]
+
+    return read
+
+
+def test_latency_run(tmpdir, monkeypatch):
+    dirsrv_log = '/var/log/dirsrv/slapd-IPA-TEST/access'
+    old_lines = b'written before the tests\n'
+
+    daemon = fakes.FakeDockerClient()
+    daemon.command_outputs = {
+        'tail -c': read_file(daemon),
+        'stat -c "%s %n"': '{} {}\n{} {}\n'.format(
+            len(old_lines), latency.IPA_LOG, len(old_lines),
+            dirsrv_log).encode(),
+        'ls -1': '{}\n'.format(dirsrv_log).encode()}
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    daemon.files[latency.IPA_LOG] = old_lines + '\n'.join(
+        IPA_LOG_LINES).encode()
+    daemon.files[latency.HTTPD_LOG] = '\n'.join(HTTPD_LOG_LINES).encode()
+    daemon.files[dirsrv_log] = old_lines + '\n'.join(
+        DIRSRV_LOG_LINES).encode()
+
+    report_file = tmpdir.join('report.json')
+    args = cli.make_parser().parse_args(
+        ['--report', str(report_file), 'run-tests', '--server-latency',
+         'test_xmlrpc/test_user_plugin.py'])
+    cli.run_action(config.IPADockerConfig(), args, cli.run_tests)
+
+    commands = [cmd for cmd in daemon.commands if 'bash -c' in cmd]
+    setup_index = next(index for index, cmd in enumerate(commands)
+                       if 'nsslapd-accesslog-logbuffering' in cmd)
+    tests_index = next(index for index, cmd in enumerate(commands)
+                       if 'ipa-run-tests' in cmd)
+    assert setup_index < tests_index
+
+    summary = json.loads(report_file.read())['server_latency']
+    assert summary['ipa_commands'][0]['name'] == 'user_add'
+    assert summary['http_requests'][0]['count'] == 2
+    assert len(summary['ldap_operations']) == 3
+    assert summary['slowest_ldap_operations'][0]['name'] == 'ADD'
+
+    # only the end of the logs is read
+    assert not [call for call in daemon.calls if call[0] == 'get_archive']
+
+
+def test_read_rotated_log(caplog):
+    daemon = fakes.FakeDockerClient()
+    daemon.command_outputs = {'tail -c': read_file(daemon)}
+    ipacontainer = container.IPAContainer(daemon, config.IPADockerConfig())
+    daemon.files[latency.IPA_LOG] = '\n'.join(IPA_LOG_LINES[:2]).encode()
+
+    lines = aio.run(latency.read_log(
+        ipacontainer, latency.IPA_LOG, offset=4096))
+
+    assert lines == IPA_LOG_LINES[:2]
+    assert 'rotated' in caplog.text
+    assert aio.run(latency.read_log(ipacontainer, '/no/such/log')) == []
+
+
+def test_latency_plan():
+    """
+    Runs with the latency report are not moved to the fast lane
+    """
+    args = cli.make_parser().parse_args(
+        ['run-tests', '--server-latency', 'test_ipalib'])
+    ipaconfig = config.IPADockerConfig()
+    action = cli.fast_lane(ipaconfig, args, cli.run_tests)
+    plan = cli.plan_action(ipaconfig, args, action)
+
+    step_names = [step_name for step_name, _step in plan.steps]
+    assert step_names[-3:-1] == ['latency_setup', 'run_tests']
@@ -0,0 +1,185 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the OpenMetrics export of the runner metrics
+"""
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, config, metrics, report, service
+from tests import fakes
+
+
+def run_report():
+    run_report = report.RunReport(image='fedora:"30"')
+    run_report.pull_time = 12.5
+    run_report.boot_time = 3.0
+    run_report.add_step('builddep', 0.0, resumed=True)
+    run_report.add_step('build', 90.0)
+    run_report.add_step('install_packages', 20.0, success=False)
+    run_report.add_command(90.0, 0.002)
+    run_report.add_command(20.0, 0.2)
+    return run_report
+
+
+def test_render():
+    registry = metrics.MetricsRegistry()
+    registry.record_run(run_report(), 'build', exit_code=1)
+
+    lines = registry.render().splitlines()
+    labels = 'action="build",image="fedora:\\"30\\""'
+
+    assert lines[-1] == '# EOF'
+    assert '# TYPE ipadocker_step_duration_seconds histogram' in lines
+    assert '# UNIT ipadocker_step_duration_seconds seconds' in lines
+    assert 'ipadocker_runs_total{{{},result="failure"}} 1'.format(
+        labels) in lines
+    assert 'ipadocker_steps_total{{{},result="resumed",step="builddep"}} ' \
+        '1'.format(labels) in lines
+
+    build_step = [line for line in lines
+                  if line.startswith('ipadocker_step_duration_seconds') and
+                  'step="build"' in line]
+    assert build_step[:3] == [
+        'ipadocker_step_duration_seconds_bucket{{{},step="build",le="1.0"}} '
+        '0'.format(labels),
+        'ipadocker_step_duration_seconds_bucket{{{},step="build",le="5.0"}} '
+        '0'.format(labels),
+        'ipadocker_step_duration_seconds_bucket{{{},step="build",le="15.0"}} '
+        '0'.format(labels),
+    ]
+    assert 'ipadocker_step_duration_seconds_bucket{{{},step="build",' \
+        'le="120.0"}} 1'.format(labels) in build_step
+    assert build_step[-2:] == [
+        'ipadocker_step_duration_seconds_count{{{},step="build"}} '
+        '1'.format(labels),
+        'ipadocker_step_duration_seconds_sum{{{},step="build"}} '
+        '90.0'.format(labels),
+    ]
+
+    # skipped steps have no duration
+    assert not [line for line in lines if 'step="builddep"' in line and
+                line.startswith('ipadocker_step_duration_seconds')]
+
+    assert 'ipadocker_exec_latency_seconds_count{{{}}} 2'.format(
+        labels) in lines
+    assert 'ipadocker_image_pull_duration_seconds_sum{{{}}} 12.5'.format(
+        labels) in lines
+
+
+def test_state(tmpdir):
+    state_file = str(tmpdir.join('metrics.json'))
+    registry = metrics.MetricsRegistry()
+    registry.record_run(run_report(), 'build')
+    registry.save(state_file)
+
+    loaded = metrics.MetricsRegistry.load(state_file)
+    assert loaded.render() == registry.render()
+
+    loaded.record_run(run_report(), 'build')
+    assert loaded.boot_duration.values == {
+        (('action', 'build'), ('image', 'fedora:"30"')): {
+            'buckets': [0, 2] + [0] * 11, 'sum': 6.0, 'count': 2}}
+
+
+def runs_total(registry, action='build'):
+    return sum(value for labels, value in registry.runs.values.items()
+               if ('action', action) in labels)
+
+
+def test_concurrent_updates(tmpdir):
+    import concurrent.futures
+
+    textfile = str(tmpdir.join('ipadocker.prom'))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(
+            lambda _index: metrics.record_run(
+                run_report(), 'build', 0, textfile),
+            range(50)))
+
+    assert runs_total(metrics.MetricsRegistry.load()) == 50
+
+
+def test_service_merges_metrics(tmpdir):
+    """
+    The service does not overwrite the runs recorded by other runners
+    """
+    textfile = str(tmpdir.join('ipadocker.prom'))
+    ipaconfig = config.IPADockerConfig({'metrics': {'textfile': textfile}})
+    args = cli.make_parser().parse_args(['serve'])
+
+    metrics.record_run(run_report(), 'build', 0, textfile)
+    queue = service.QueueService(ipaconfig, args)
+    metrics.record_run(run_report(), 'build', 0, textfile)
+
+    aio.run(queue.record_metrics(run_report(), 'run_tests', 0))
+
+    accumulated = metrics.MetricsRegistry.load()
+    assert runs_total(accumulated) == 2
+    assert runs_total(accumulated, 'run_tests') == 1
+    assert runs_total(queue.metrics) == 2
+
+
+def test_textfile(tmpdir, monkeypatch):
+    daemon = fakes.FakeDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    textfile = tmpdir.join('textfile', 'ipadocker.prom')
+    ipaconfig = config.IPADockerConfig(
+        {'metrics': {'textfile': str(textfile)}})
+    args = cli.make_parser().parse_args(['build'])
+
+    for _run in range(2):
+        cli.run_action(ipaconfig, args, cli.build)
+
+    lines = textfile.read().splitlines()
+    labels = 'action="build",image="{}"'.format(
+        ipaconfig['container']['image'])
+    assert 'ipadocker_runs_total{{{},result="success"}} 2'.format(
+        labels) in lines
+    assert 'ipadocker_step_duration_seconds_count{{{},step="build"}} ' \
+        '2'.format(labels) in lines
+    assert 'ipadocker_container_boot_duration_seconds_count{{{}}} ' \
+        '2'.format(labels) in lines
+    assert [line for line in lines if line.startswith(
+        'ipadocker_command_duration_seconds_count')]
+
+
+@pytest.mark.parametrize('path,status', [
+    ('/metrics', b'200 OK'),
+    ('/', b'404 Not Found'),
+])
+def test_serve_http(path, status):
+    registry = metrics.MetricsRegistry()
+    registry.record_run(run_report(), 'build')
+
+    async def get():
+        import asyncio
+
+        server = await metrics.serve_http(registry, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write('GET {} HTTP/1.0\r\n\r\n'.format(path).encode())
+            response = await reader.read()
+            writer.close()
+            return response
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = aio.run(get())
+    headers, _sep, body = response.partition(b'\r\n\r\n')
+
+    assert status in headers.splitlines()[0]
+    if status == b'200 OK':
+        assert metrics.CONTENT_TYPE.encode() in headers
+        assert body.decode() == registry.render()
+
+
+def test_parse_address():
+    assert metrics.parse_address('9464') == ('127.0.0.1', 9464)
+    assert metrics.parse_address('0.0.0.0:9464') == ('0.0.0.0', 9464)
+    with pytest.raises(ValueError):
+        metrics.parse_address('localhost:')
@@ -0,0 +1,125 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the profiling of the test run
+"""
+
+import os
+import pstats
+import subprocess
+import sys
+
+import docker
+
+from ipadocker import cli, config, profiling
+from tests import fakes
+
+TEST_MODULE = """
+import time
+
+
+def test_fast():
+    pass
+
+
+def test_slow():
+    time.sleep(0.2)
+"""
+
+
+def test_plugin(tmpdir):
+    """
+    Run pytest with the plugin the same way `ipa-run-tests` does in the
+    container
+    """
+    tests_dir = tmpdir.mkdir('ipatests').mkdir('test_sample')
+    tests_dir.join('test_module.py').write(TEST_MODULE)
+    output_dir = tmpdir.join('results')
+
+    plugin_dir = os.path.dirname(os.path.abspath(profiling.__file__))
+    subprocess.check_call(
+        [sys.executable, '-m', 'pytest', '-q', '-p', 'profile_plugin',
+         '-p', 'no:cacheprovider',
+         '--ipadocker-profile-dir={}'.format(output_dir), 'test_sample'],
+        cwd=str(tmpdir.join('ipatests')),
+        env=dict(os.environ, PYTHONPATH=plugin_dir),
+        stdout=subprocess.DEVNULL)
+
+    stats = pstats.Stats(str(output_dir.join('test_sample.test_module.prof')))
+    assert [func for func in stats.stats if func[2] == 'test_slow']
+
+    stacks = output_dir.join('test_sample.test_module.collapsed').readlines()
+    assert stacks
+    assert [stack for stack in stacks if 'test_slow' in stack]
+    stack, count = stacks[0].rsplit(' ', 1)
+    assert int(count) > 0
+
+    durations = output_dir.join('durations.txt').readlines()
+    assert len(durations) == 6
+    assert durations[0].split()[1:] == [
+        'call', 'test_sample/test_module.py::test_slow']
+
+
+def test_profile_run(tmpdir, monkeypatch):
+    daemon = fakes.FakeDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    # results written by the plugin in the container
+    results = os.path.join(profiling.RESULTS_DIR, 'test_xmlrpc.test_ping.{}')
+    daemon.files[results.format('prof')] = b'pstats'
+    daemon.files[results.format('collapsed')] = b'main;test_ping 1\n'
+
+    profile_dir = tmpdir.join('profile')
+    args = cli.make_parser().parse_args(
+        ['run-tests', '--profile', '--profile-dir', str(profile_dir),
+         'test_xmlrpc/test_ping.py'])
+    cli.run_action(config.IPADockerConfig(), args, cli.run_tests)
+
+    assert daemon.files[os.path.join(
+        profiling.PROFILE_DIR, 'ipadocker_profile.py')].startswith(b'#')
+
+    [profile_cmd] = [cmd for cmd in daemon.commands if 'ipa-run-tests' in cmd]
+    assert '-p ipadocker_profile' in profile_cmd
+    assert '--durations' in profile_cmd
+
+    assert sorted(profile_dir.listdir()) == [
+        profile_dir.join('test_xmlrpc.test_ping.collapsed'),
+        profile_dir.join('test_xmlrpc.test_ping.prof')]
+    assert profile_dir.join('test_xmlrpc.test_ping.prof').read() == 'pstats'
+
+
+def test_profile_plan():
+    """
+    Profiled tests are not moved to the fast lane
+    """
+    args = cli.make_parser().parse_args(
+        ['run-tests', '--profile', 'test_ipalib'])
+    ipaconfig = config.IPADockerConfig()
+    action = cli.fast_lane(ipaconfig, args, cli.run_tests)
+    plan = cli.plan_action(ipaconfig, args, action)
+
+    step_names = [step_name for step_name, _step in plan.steps]
+    assert 'install_server' in step_names
+    assert step_names[-2] == 'profile_tests'
+
+
+def test_extract_results_outside(tmpdir):
+    """
+    Only regular files of the results directory are extracted
+    """
+    import io
+    import tarfile
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        for name in ('results/../../evil.prof', 'other/module.prof',
+                     'results/module.prof'):
+            info = tarfile.TarInfo(name)
+            info.size = 1
+            tar.addfile(info, io.BytesIO(b'x'))
+
+    extracted = profiling.extract_results(archive.getvalue(), str(tmpdir))
+
+    assert extracted == [str(tmpdir.join('evil.prof')),
+                         str(tmpdir.join('module.prof'))]
+    assert not tmpdir.join('..', 'evil.prof').check()
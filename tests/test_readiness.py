@@ -0,0 +1,158 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the readiness probe of started containers
+"""
+
+import time
+
+import pytest
+
+from ipadocker import aio, config, container, scheduler
+from tests import fakes
+
+
+@pytest.fixture(autouse=True)
+def fast_probes(monkeypatch):
+    monkeypatch.setattr(container, 'PROBE_INTERVAL_MIN', 0.001)
+    monkeypatch.setattr(container, 'PROBE_INTERVAL_MAX', 0.001)
+
+
+def create_container(fake_client, **readiness):
+    ipaconfig = config.IPADockerConfig({'readiness': readiness})
+    return aio.run(container.IPAContainer.create(fake_client, ipaconfig))
+
+
+def probes(fake_client):
+    return [cmd for cmd in fake_client.commands if 'is-system-running' in cmd]
+
+
+def test_wait_until_ready():
+    fake_client = fakes.FakeDockerClient(
+        system_states=['', 'initializing', 'starting', 'degraded'])
+
+    ipacontainer = create_container(fake_client)
+
+    assert len(probes(fake_client)) == 4
+    assert ipacontainer.report.boot_time is not None
+    assert ipacontainer.report.to_dict()['boot_time'] >= 0
+
+
+def test_probe_exit_code():
+    """
+    Custom probe without ready states succeeds by its exit code
+    """
+    fake_client = fakes.FakeDockerClient(exit_codes={'ipactl': 1})
+
+    with pytest.raises(container.ContainerNotReady):
+        create_container(
+            fake_client, command='ipactl status', ready_states=[], timeout=0)
+
+    ipacontainer = create_container(
+        fake_client, command='test -e /run/ready', ready_states=[])
+    assert ipacontainer.report.boot_time is not None
+
+
+def test_disabled_probe():
+    fake_client = fakes.FakeDockerClient()
+
+    ipacontainer = create_container(fake_client, command='')
+
+    assert not fake_client.commands
+    assert ipacontainer.report.boot_time is None
+
+
+@pytest.mark.parametrize('system_states,readiness', [
+    (['starting', 'maintenance'], {}),
+    (['starting'], {'timeout': 0}),
+])
+def test_not_ready(system_states, readiness):
+    fake_client = fakes.FakeDockerClient(system_states=system_states)
+
+    with pytest.raises(container.ContainerNotReady):
+        create_container(fake_client, **readiness)
+
+    # the container which failed to boot is removed
+    assert not fake_client.containers
+
+
+def test_container_exited(monkeypatch):
+    fake_client = fakes.FakeDockerClient(system_states=['starting'])
+
+    def start(container=None, **kwargs):
+        fake_client.containers[container]['State'].update(
+            Status='exited', ExitCode=255)
+
+    monkeypatch.setattr(fake_client, 'start', start)
+
+    with pytest.raises(container.ContainerNotReady) as excinfo:
+        create_container(fake_client)
+
+    assert 'exited with exit code 255' in str(excinfo.value)
+
+
+def test_retry_on_other_host():
+    clients = [
+        fakes.FakeDockerClient(system_states=['maintenance']),
+        fakes.FakeDockerClient(system_states=['running']),
+    ]
+    hosts = [scheduler.DockerHost(i, 'tcp://host{}:2375'.format(i),
+                                  shared_sources=True)
+             for i in range(len(clients))]
+    host_scheduler = scheduler.HostScheduler(
+        hosts, lambda host: clients[host.index])
+
+    ipacontainer = aio.run(
+        host_scheduler.create_container(config.IPADockerConfig()))
+
+    assert ipacontainer.host is hosts[1]
+    assert hosts[0].failures == 1
+    assert not clients[0].containers
+
+
+def test_overlapped_startup(monkeypatch):
+    """
+    The Docker host resources are queried while the container boots
+    """
+    fake_client = fakes.FakeDockerClient(
+        system_states=['starting', 'starting', 'running'], exec_latency=0.05)
+    info = fake_client.info
+
+    def slow_info():
+        time.sleep(0.2)
+        return info()
+
+    monkeypatch.setattr(fake_client, 'info', slow_info)
+
+    ipacontainer = create_container(fake_client)
+    startup = ipacontainer.report.to_dict()['startup']
+
+    assert sorted(stage['name'] for stage in startup['stages']) == [
+        'boot', 'create', 'pull', 'resources', 'start']
+    assert startup['saved'] >= 0.15
+    assert startup['time'] < sum(
+        stage['duration'] for stage in startup['stages'])
+
+
+def test_sequential_startup(monkeypatch):
+    """
+    No time is saved when the startup stages run one after another
+    """
+    async def gather_sequentially(*aws):
+        return [await aw for aw in aws]
+
+    fake_client = fakes.FakeDockerClient(
+        system_states=['starting', 'running'], exec_latency=0.01)
+    start = fake_client.start
+
+    def slow_start(*args, **kwargs):
+        time.sleep(0.1)
+        return start(*args, **kwargs)
+
+    monkeypatch.setattr(fake_client, 'start', slow_start)
+    monkeypatch.setattr(aio, 'gather_all', gather_sequentially)
+
+    ipacontainer = create_container(fake_client)
+
+    assert ipacontainer.report.startup_saved == 0
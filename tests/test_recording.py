@@ -0,0 +1,138 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for recording and replaying Docker API sessions
+"""
+
+import time
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, command, config, container, recording
+from tests import fakes
+
+OUTPUT = (fakes.generate_output(lines=20, line_length=10) +
+          [u'\u017e\n'.encode()])
+
+
+@pytest.fixture()
+def session_file(tmpdir):
+    return str(tmpdir.join('session.jsonl.gz'))
+
+
+@pytest.fixture()
+def fake_client():
+    return fakes.FakeDockerClient(
+        exec_output=OUTPUT, chunk_latency=0.002, exit_codes={'false': 3})
+
+
+def run_session(docker_client):
+    """
+    Create container, run a successful and a failing command and return the
+    collected output and exit code
+    """
+    ipacontainer = container.IPAContainer(
+        docker_client, config.IPADockerConfig())
+    stream = docker_client.exec_start(
+        docker_client.exec_create(ipacontainer.container_id, cmd='true'),
+        stream=True)
+    output = list(stream)
+
+    with pytest.raises(command.ContainerExecError) as e:
+        command.exec_command(
+            docker_client, ipacontainer.container_id, 'false')
+
+    ipacontainer.stop_and_remove()
+    return output, e.value.exit_code
+
+
+def test_record_and_replay(session_file, fake_client):
+    recorder = recording.RecordingClient(fake_client, session_file)
+    recorded_output, recorded_exit_code = run_session(recorder)
+    recorder.close()
+
+    assert recorded_output == OUTPUT
+
+    replay_client = recording.ReplayClient(session_file, speed=0)
+    replayed_output, replayed_exit_code = run_session(replay_client)
+    replay_client.close()
+
+    assert replayed_output == recorded_output
+    assert replayed_exit_code == recorded_exit_code
+    assert not any(replay_client._calls.values())
+
+
+def test_record_concurrent_calls(session_file, fake_client):
+    import concurrent.futures
+
+    recorder = recording.RecordingClient(fake_client, session_file)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(lambda _index: recorder.info(), range(500)))
+    recorder.close()
+
+    replay_client = recording.ReplayClient(session_file, speed=0)
+    assert len(replay_client._calls['info']) == 500
+
+
+def test_replay_speed(session_file, fake_client):
+    recorder = recording.RecordingClient(fake_client, session_file)
+    run_session(recorder)
+    recorder.close()
+
+    start = time.perf_counter()
+    run_session(recording.ReplayClient(session_file, speed=1))
+    real_speed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    run_session(recording.ReplayClient(session_file, speed=0))
+    no_delay = time.perf_counter() - start
+
+    assert real_speed >= 2 * len(OUTPUT) * fake_client.chunk_latency
+    assert no_delay < real_speed
+
+
+def test_replay_command_with_timeout(session_file, fake_client, caplog):
+    def run_with_timeout(docker_client):
+        ipacontainer = container.IPAContainer(
+            docker_client, config.IPADockerConfig())
+        aio.run(command.exec_command_async(
+            docker_client, ipacontainer.container_id, 'make', timeout=60))
+        ipacontainer.stop_and_remove()
+
+    recorder = recording.RecordingClient(fake_client, session_file)
+    run_with_timeout(recorder)
+    recorder.close()
+
+    run_with_timeout(recording.ReplayClient(session_file, speed=0))
+
+    # the names of the pidfiles of the timeouts are random
+    assert 'differs from the recorded one' not in caplog.text
+
+
+def test_replay_unexpected_call(session_file, fake_client):
+    recorder = recording.RecordingClient(fake_client, session_file)
+    recorder.close()
+
+    replay_client = recording.ReplayClient(session_file, speed=0)
+    with pytest.raises(recording.ReplayError):
+        replay_client.pull('image')
+
+
+def test_cli_record_and_replay(session_file, fake_client, monkeypatch):
+    monkeypatch.setattr(docker, 'Client', lambda *args, **kwargs: fake_client)
+
+    parser = cli.make_parser()
+    ipaconfig = config.IPADockerConfig()
+
+    record_args = parser.parse_args(['--record', session_file, 'build'])
+    cli.run_action(ipaconfig, record_args, cli.build)
+    recorded_commands = list(fake_client.commands)
+
+    replay_args = parser.parse_args(
+        ['--replay', session_file, '--replay-speed', '0', 'build'])
+    cli.run_action(ipaconfig, replay_args, cli.build)
+
+    # the replay must not touch the original client
+    assert fake_client.commands == recorded_commands
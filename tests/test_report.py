@@ -0,0 +1,70 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for run reports and step history
+"""
+
+import pytest
+
+from ipadocker import report
+
+
+@pytest.mark.parametrize('seconds,expected', [
+    (None, '?'),
+    (4.4, '4s'),
+    (65, '1m 05s'),
+    (3725, '1h 02m 05s'),
+])
+def test_format_duration(seconds, expected):
+    assert report.format_duration(seconds) == expected
+
+
+def test_step_history():
+    history = report.StepHistory()
+    assert history.estimate('image', 'build') is None
+
+    run_report = report.RunReport(image='image')
+    run_report.add_step('build', 10)
+    run_report.add_step('install_server', 1, success=False)
+
+    for duration in range(report.HISTORY_SIZE * 2):
+        history.record('image', 'lint', duration)
+
+    history.record_report(run_report)
+    history.save()
+
+    loaded_history = report.StepHistory()
+    assert loaded_history.estimate('image', 'build') == 10
+    assert loaded_history.estimate('image', 'install_server') is None
+    assert loaded_history.estimate('other-image', 'build') is None
+    assert len(loaded_history.durations['image']['lint']) == (
+        report.HISTORY_SIZE)
+
+
+def test_step_history_concurrent_saves(tmpdir):
+    """
+    The runs saving the history at once do not lose each other's durations
+    """
+    import concurrent.futures
+
+    filename = str(tmpdir.join('step-durations.json'))
+    stale = report.StepHistory(filename)
+    stale.record('image', 'lint', 5)
+
+    def save(index):
+        history = report.StepHistory(filename)
+        history.record('image', 'build', index)
+        history.save()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(save, range(report.HISTORY_SIZE)))
+
+    stale.save()
+
+    loaded_history = report.StepHistory(filename)
+    assert sorted(loaded_history.durations['image']['build']) == list(
+        range(report.HISTORY_SIZE))
+    assert loaded_history.durations['image']['lint'] == [5]
+    assert not [name for name in tmpdir.listdir()
+                if name.basename.endswith('.tmp')]
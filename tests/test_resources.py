@@ -0,0 +1,92 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the container resource limits
+"""
+
+import pytest
+
+from ipadocker import aio, config, constants, container, resources
+from tests import fakes
+
+GIB = 1024 ** 3
+
+
+@pytest.mark.parametrize('value,expected', [
+    (512, 512),
+    ('512', 512),
+    ('512k', 512 * 1024),
+    ('8g', 8 * GIB),
+    ('8GB', 8 * GIB),
+])
+def test_parse_bytes(value, expected):
+    assert resources.parse_bytes(value) == expected
+
+
+@pytest.mark.parametrize('cpuset,expected', [
+    ('0', 1),
+    ('0-3', 4),
+    ('0-3,8,10-11', 7),
+])
+def test_parse_cpuset(cpuset, expected):
+    assert resources.parse_cpuset(cpuset) == expected
+
+
+@pytest.mark.parametrize('invalid', [
+    lambda: resources.parse_bytes('lots'),
+    lambda: resources.parse_cpuset('0-x'),
+])
+def test_invalid_limits(invalid):
+    with pytest.raises(ValueError):
+        invalid()
+
+
+@pytest.mark.parametrize('host_config,expected', [
+    ({}, 16),
+    ({'cpuset_cpus': '0-3'}, 4),
+    ({'cpu_quota': 250000}, 3),
+    ({'cpu_quota': 100000, 'cpu_period': 50000}, 2),
+    ({'cpuset_cpus': '0-3', 'cpu_quota': 150000}, 2),
+    ({'mem_limit': '6g'}, 6),
+    ({'mem_limit': '512m'}, 1),
+])
+def test_parallel_jobs(host_config, expected):
+    assert resources.parallel_jobs(
+        host_config, host_cpus=16, host_memory=32 * GIB) == expected
+
+
+def test_unset_limits_not_passed():
+    ipaconfig = config.IPADockerConfig(
+        {'host': {'cpuset_cpus': '0-1', 'mem_limit': '4g'}})
+    fake_client = fakes.FakeDockerClient(ncpu=8)
+
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    host_config = fake_client.containers[ipacontainer.container_id][
+        'HostConfig']
+    assert host_config['cpuset_cpus'] == '0-1'
+    assert host_config['mem_limit'] == '4g'
+    assert 'cpu_quota' not in host_config
+    assert 'cpu_period' not in host_config
+
+    assert ipacontainer.jobs == 2
+
+
+def test_build_dir_tmpfs():
+    ipaconfig = config.IPADockerConfig(
+        {'git_repo': '/src/freeipa', 'build_dir': {'tmpfs_size': '4g'}})
+    fake_client = fakes.FakeDockerClient()
+
+    ipacontainer = aio.run(
+        container.IPAContainer.create(fake_client, ipaconfig))
+
+    host_config = fake_client.containers[ipacontainer.container_id][
+        'HostConfig']
+    assert host_config['binds'][-1] == '/src/freeipa:/freeipa-source:rw,Z'
+    assert host_config['tmpfs'][-1] == '/freeipa:rw,exec,size=4g'
+
+    # the config of the run is not changed
+    assert ipaconfig['host']['tmpfs'] == constants.DEFAULT_HOST_CONFIG[
+        'tmpfs']
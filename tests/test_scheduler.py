@@ -0,0 +1,213 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for placement of containers on multiple Docker hosts
+"""
+
+import asyncio
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, config, scheduler
+from tests import fakes
+
+IMAGE = 'test-image:latest'
+
+
+class FailingDockerClient(fakes.FakeDockerClient):
+    """
+    Fake Docker daemon which cannot create containers
+    """
+    def create_container(self, image, host_config=None, **kwargs):
+        raise RuntimeError("no space left on device")
+
+
+@pytest.fixture()
+def ipaconfig():
+    return config.IPADockerConfig({'container': {'image': IMAGE}})
+
+
+def make_scheduler(slots, failing=()):
+    hosts = [
+        scheduler.DockerHost(i, 'tcp://host{}:2375'.format(i), slots=s,
+                             shared_sources=True)
+        for i, s in enumerate(slots)
+    ]
+
+    def client_factory(host):
+        client_class = fakes.FakeDockerClient
+        if host.index in failing:
+            client_class = FailingDockerClient
+
+        return client_class(base_url=host.base_url)
+
+    return scheduler.HostScheduler(hosts, client_factory)
+
+
+def place(host_scheduler, ipaconfig, count):
+    async def create_all():
+        return [await host_scheduler.create_container(ipaconfig)
+                for _i in range(count)]
+
+    return aio.run(create_all())
+
+
+def test_least_loaded_placement(ipaconfig):
+    host_scheduler = make_scheduler([2, 1])
+    containers = place(host_scheduler, ipaconfig, 3)
+
+    assert [c.host.index for c in containers] == [0, 1, 0]
+    assert [h.used for h in host_scheduler.hosts] == [2, 1]
+
+    aio.run(host_scheduler.release(containers[1]))
+    assert host_scheduler.hosts[1].used == 0
+
+
+def test_prefer_host_with_image(ipaconfig):
+    host_scheduler = make_scheduler([1, 1])
+    host_scheduler.hosts[1].images.add(IMAGE)
+
+    ipacontainer, = place(host_scheduler, ipaconfig, 1)
+    assert ipacontainer.host.index == 1
+
+
+def test_retry_on_other_host(ipaconfig):
+    host_scheduler = make_scheduler([4, 1], failing={0})
+
+    ipacontainer, = place(host_scheduler, ipaconfig, 1)
+
+    assert ipacontainer.host.index == 1
+    assert host_scheduler.hosts[0].failures == 1
+    assert host_scheduler.hosts[0].used == 0
+
+
+def test_no_host_available(ipaconfig):
+    host_scheduler = make_scheduler([1, 1], failing={0, 1})
+
+    with pytest.raises(scheduler.NoHostAvailable) as e:
+        place(host_scheduler, ipaconfig, 1)
+
+    assert len(e.value.errors) == 2
+    assert all(host.used == 0 for host in host_scheduler.hosts)
+
+
+def test_wait_for_free_slot(ipaconfig):
+    host_scheduler = make_scheduler([1])
+    order = []
+
+    async def run(name):
+        ipacontainer = await host_scheduler.create_container(ipaconfig)
+        order.append(('start', name))
+        await asyncio.sleep(0.01)
+        order.append(('end', name))
+        await host_scheduler.release(ipacontainer)
+
+    async def run_all():
+        await asyncio.gather(run('first'), run('second'))
+
+    aio.run(run_all())
+    assert order == [('start', 'first'), ('end', 'first'),
+                     ('start', 'second'), ('end', 'second')]
+
+
+@pytest.mark.parametrize('hosts_config', [
+    [],
+    [{'slots': 1}],
+    [{'base_url': 'tcp://host:2375', 'slots': 0}],
+])
+def test_invalid_inventory(hosts_config):
+    with pytest.raises(ValueError):
+        scheduler.hosts_from_config(hosts_config)
+
+
+def test_cli_multiple_hosts(monkeypatch):
+    daemons = {}
+
+    def make_client(base_url, **kwargs):
+        client_class = fakes.FakeDockerClient
+        if base_url == 'tcp://broken:2375':
+            client_class = FailingDockerClient
+
+        daemons[base_url] = client_class(base_url=base_url)
+        return daemons[base_url]
+
+    monkeypatch.setattr(docker, 'Client', make_client)
+
+    ipaconfig = config.IPADockerConfig({
+        'hosts': [
+            {'base_url': 'tcp://broken:2375', 'slots': 2,
+             'shared_sources': True},
+            {'base_url': 'tcp://builder:2375', 'slots': 1,
+             'shared_sources': True},
+        ]
+    })
+    args = cli.make_parser().parse_args(['build'])
+    cli.run_action(ipaconfig, args, cli.build)
+
+    assert not daemons['tcp://broken:2375'].commands
+    assert daemons['tcp://builder:2375'].commands
+
+
+@pytest.mark.parametrize('base_url,local', [
+    ('unix://var/run/docker.sock', True),
+    ('tcp://127.0.0.1:2375', True),
+    ('tcp://localhost:2375', True),
+    ('tcp://builder.example.test:2375', False),
+])
+def test_is_local(base_url, local):
+    assert scheduler.is_local(base_url) is local
+
+
+def test_remote_host_without_shared_sources(ipaconfig):
+    """
+    The git repo can not be bind-mounted on a remote host unless it is
+    shared with it
+    """
+    hosts = scheduler.hosts_from_config([
+        {'base_url': 'tcp://remote:2375', 'slots': 2},
+        {'base_url': 'tcp://shared:2375', 'shared_sources': True},
+    ])
+    clients = {}
+
+    def client_factory(host):
+        clients[host.base_url] = fakes.FakeDockerClient(
+            base_url=host.base_url)
+        return clients[host.base_url]
+
+    host_scheduler = scheduler.HostScheduler(hosts, client_factory)
+    ipacontainer = aio.run(host_scheduler.create_container(ipaconfig))
+    assert ipacontainer.host is hosts[1]
+    assert 'tcp://remote:2375' not in clients
+
+    with pytest.raises(scheduler.NoHostAvailable) as e:
+        aio.run(scheduler.HostScheduler(
+            hosts[:1], client_factory).create_container(ipaconfig))
+
+    assert 'shared_sources' in str(e.value)
+
+
+def test_place_before_create(ipaconfig):
+    """
+    The image is pulled on the placed host, where the container is then
+    created without pulling again
+    """
+    host_scheduler = make_scheduler([1, 1])
+
+    async def place_and_create():
+        host = await host_scheduler.place(ipaconfig)
+        assert host.used == 1
+        return await host_scheduler.create_container(ipaconfig, host=host)
+
+    ipacontainer = aio.run(place_and_create())
+    assert [h.used for h in host_scheduler.hosts] == [1, 0]
+
+    calls = [method for method, _args, _kwargs
+             in ipacontainer.host.docker_client.calls]
+    assert calls.count('pull') == 1
+    assert calls.index('pull') < calls.index('create_container')
+
+    host = aio.run(host_scheduler.place(ipaconfig))
+    aio.run(host_scheduler.release_host(host))
+    assert host.used == 0
@@ -0,0 +1,232 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for the queue service batching the runs
+"""
+
+import asyncio
+import json
+import logging
+import re
+
+import docker
+import pytest
+
+from ipadocker import aio, cli, config, service
+from tests import fakes
+from tests.conftest import git
+
+
+@pytest.fixture()
+def git_repo(git_repo):
+    git_repo.join('freeipa.spec.in').write('Version: 2\n')
+    git(git_repo, 'commit', '--quiet', '-am', 'version 2')
+    return git_repo
+
+
+@pytest.fixture()
+def daemon(monkeypatch):
+    daemon = fakes.FakeDockerClient(
+        exec_output=[b'test output\n'], exec_latency=0.005,
+        exit_codes={'test_failing.py': 1})
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    return daemon
+
+
+def run_service(git_repo, tmpdir, jobs):
+    """
+    Start the service, submit the jobs concurrently and stop it when they
+    finish
+
+    :param jobs: list of (commit, argv) tuples
+    :returns: list of (exit code, events) tuples of the jobs
+    """
+    ipaconfig = config.IPADockerConfig({
+        'git_repo': str(git_repo),
+        'metrics': {'textfile': str(tmpdir.join('ipadocker.prom'))}
+    })
+    args = cli.make_parser().parse_args(['serve', '--parallel', '1'])
+    queue = service.QueueService(ipaconfig, args, parallel=args.parallel)
+    socket_path = str(tmpdir.join('queue.sock'))
+
+    async def submit(commit, argv):
+        events = []
+        exit_code = await service.submit_async(
+            socket_path, commit, argv, events.append)
+        return exit_code, events
+
+    async def run_jobs():
+        server = asyncio.ensure_future(queue.serve(socket_path))
+        try:
+            while not tmpdir.join('queue.sock').check():
+                await asyncio.sleep(0.01)
+
+            return await asyncio.gather(
+                *[submit(commit, argv) for commit, argv in jobs])
+        finally:
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+    return aio.run(run_jobs())
+
+
+def test_coalesced_jobs(git_repo, tmpdir, daemon, caplog):
+    caplog.set_level(logging.INFO)
+    results = run_service(git_repo, tmpdir, [
+        ('HEAD', ['run-tests', 'test_xmlrpc/test_user_plugin.py']),
+        ('HEAD~1', ['run-tests', 'test_xmlrpc/test_user_plugin.py']),
+        ('HEAD', ['run-tests', 'test_xmlrpc/test_failing.py']),
+    ])
+
+    assert [exit_code for exit_code, _events in results] == [0, 0, 1]
+
+    # jobs for the same commit share the container and its installed server
+    created = [call for call in daemon.calls
+               if call[0] == 'create_container']
+    assert len(created) == 2
+    assert len([cmd for cmd in daemon.commands
+                if 'ipa-server-install' in cmd]) == 2
+    assert len([cmd for cmd in daemon.commands
+                if 'ipa-run-tests' in cmd]) == 3
+
+    batches = [events[0]['batch'] for _exit_code, events in results]
+    assert batches[0] == batches[2] != batches[1]
+
+    # the output of the commands is streamed to the client of the job
+    first_events = results[0][1]
+    assert {'event': 'log', 'message': 'test output'} in first_events
+    assert not [event for event in first_events
+                if 'test_failing.py' in event.get('message', '')]
+
+    reused = [step['name'] for step in results[2][1][-2]['report']['steps']
+              if step.get('reused')]
+    assert 'install_server' in reused
+    assert not daemon.containers
+
+    # the container start is accounted to the first job of each batch
+    metrics = tmpdir.join('ipadocker.prom').read()
+    assert re.search(
+        r'^ipadocker_runs_total\{action="run_tests",.*result="failure"\} 1$',
+        metrics, re.MULTILINE)
+    assert re.search(
+        r'^ipadocker_steps_total\{.*result="reused",step="install_server"\} '
+        r'1$', metrics, re.MULTILINE)
+    assert re.search(
+        r'^ipadocker_container_boot_duration_seconds_count\{.*\} 2$',
+        metrics, re.MULTILINE)
+
+
+@pytest.mark.parametrize('commit,argv', [
+    ('no-such-commit', ['run-tests']),
+    ('HEAD', ['bisect', 'HEAD~1', 'HEAD']),
+    ('HEAD', ['run-tests', '--no-such-option']),
+    ('HEAD', ['unit-tests', 'test_xmlrpc/test_user_plugin.py']),
+])
+def test_rejected_job(git_repo, tmpdir, daemon, commit, argv):
+    [(exit_code, events)] = run_service(git_repo, tmpdir, [(commit, argv)])
+
+    assert exit_code == 2
+    assert events[-1]['error']
+    assert not daemon.containers
+
+
+def test_dead_container_replaced(git_repo, tmpdir, daemon, monkeypatch):
+    """
+    The container which died is not re-used by the next job of the batch
+    """
+    exec_start = daemon.exec_start
+
+    def oom_kill(exec_id, **kwargs):
+        exec_id = exec_id['Id'] if isinstance(exec_id, dict) else exec_id
+        exec_info = daemon._execs[exec_id]
+        if 'test_oom.py' in exec_info['Cmd']:
+            daemon.die(next(iter(daemon.containers)))
+
+        return exec_start(exec_id, **kwargs)
+
+    monkeypatch.setattr(daemon, 'exec_start', oom_kill)
+    daemon.exit_codes['test_oom.py'] = 137
+
+    results = run_service(git_repo, tmpdir, [
+        ('HEAD', ['run-tests', 'test_xmlrpc/test_oom.py']),
+        ('HEAD', ['run-tests', 'test_xmlrpc/test_user_plugin.py']),
+    ])
+
+    assert [exit_code for exit_code, _events in results] == [137, 0]
+    assert [event['message'] for event in results[0][1]
+            if 'OOM killed' in event.get('message', '')]
+
+    created = [call for call in daemon.calls
+               if call[0] == 'create_container']
+    assert len(created) == 2
+    assert len([cmd for cmd in daemon.commands
+                if 'ipa-server-install' in cmd]) == 2
+    assert not daemon.containers
+
+
+def test_job_config(git_repo, tmpdir, monkeypatch):
+    """
+    The config file of the job is read by the client, its path is relative
+    to the working directory of the client
+    """
+    client_dir = tmpdir.mkdir('client')
+    client_dir.join('job.yaml').write(
+        'container:\n  image: freeipa/freeipa-builder:custom\n')
+    monkeypatch.chdir(client_dir)
+    argv = ['--config', 'job.yaml', 'run-tests', 'test_ipalib']
+
+    config_overrides = cli.submitted_config(argv)
+    assert config_overrides == {
+        'container': {'image': 'freeipa/freeipa-builder:custom'}}
+
+    monkeypatch.chdir(tmpdir)
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    queue = service.QueueService(
+        ipaconfig, cli.make_parser().parse_args(['serve']))
+    job = queue.parse_job(
+        {'commit': 'HEAD', 'argv': argv, 'config': config_overrides})
+    assert job.config_overrides == config_overrides
+
+    with pytest.raises(service.JobError):
+        queue.parse_job({'commit': 'HEAD', 'argv': argv,
+                         'config': {'no_such_section': {}}})
+
+
+class SlowClient:
+    """
+    Writer of the client connection which does not read anything
+    """
+    def __init__(self):
+        self.lines = []
+        self.transport = self
+
+    def is_closing(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return sum(len(line) for line in self.lines)
+
+    def write(self, data):
+        self.lines.append(data)
+
+
+def test_slow_client(monkeypatch):
+    monkeypatch.setattr(service, 'MAX_CLIENT_BUFFER', 100)
+    writer = SlowClient()
+    job = service.Job(1, 'HEAD', [], None, writer)
+
+    for index in range(10):
+        job.send('log', message='output line {}'.format(index))
+    job.send('report', report={})
+
+    events = [json.loads(line.decode()) for line in writer.lines]
+    assert [event['event'] for event in events] == ['log'] * 3 + ['report']
+    assert job.dropped == 7
+
+    # the client catches up
+    writer.lines = []
+    job.send('log', message='output line 10')
+    assert [json.loads(line.decode())['message'] for line in writer.lines] == [
+        '7 lines of output dropped, the client does not keep up',
+        'output line 10']
@@ -0,0 +1,158 @@
+# Author: Martin Babinsky <martbab@gmail.com>
+# See LICENSE file for license
+
+"""
+Tests for source snapshots and matrix runs using them
+"""
+
+import json
+import subprocess
+
+import docker
+import pytest
+
+from ipadocker import cli, config, snapshot
+from tests import fakes
+
+
+def test_snapshot_clean_repo(git_repo, tmpdir):
+    source_snapshot = snapshot.SourceSnapshot(
+        str(git_repo), root=str(tmpdir.join('snapshots')))
+    commit = source_snapshot.create()
+
+    head = subprocess.check_output(
+        ['git', '-C', str(git_repo), 'rev-parse', 'HEAD']).decode().strip()
+    assert commit == head
+
+
+def test_snapshot_local_changes(git_repo, tmpdir):
+    git_repo.join('freeipa.spec.in').write('Version: 2\n')
+
+    source_snapshot = snapshot.SourceSnapshot(
+        str(git_repo), root=str(tmpdir.join('snapshots')))
+    source_snapshot.create()
+
+    # changes made after the snapshot are not part of it
+    git_repo.join('freeipa.spec.in').write('Version: 3\n')
+
+    paths = [source_snapshot.checkout(name)
+             for name in ('registry/fedora:29', 'fedora:30')]
+
+    assert len(set(paths)) == 2
+    for path in paths:
+        with open('{}/freeipa.spec.in'.format(path)) as spec:
+            assert spec.read() == 'Version: 2\n'
+
+    source_snapshot.remove()
+    assert not tmpdir.join('snapshots').listdir()[0].listdir()
+    assert git_repo.join('freeipa.spec.in').read() == 'Version: 3\n'
+
+
+def test_snapshot_error(tmpdir):
+    source_snapshot = snapshot.SourceSnapshot(str(tmpdir.mkdir('empty')))
+
+    with pytest.raises(snapshot.SnapshotError):
+        source_snapshot.create()
+
+
+class BrokenImageDockerClient(fakes.FakeDockerClient):
+    """
+    Fake Docker daemon on which make fails in the containers of the 'broken'
+    image
+    """
+    def __init__(self, **kwargs):
+        super(BrokenImageDockerClient, self).__init__(
+            exit_codes={'# broken': 2}, **kwargs)
+
+    def exec_create(self, container, cmd, **kwargs):
+        if (self.containers[container]['Image'] == 'broken' and
+                'make' in cmd):
+            cmd = '{} # broken'.format(cmd)
+
+        return super(BrokenImageDockerClient, self).exec_create(
+            container, cmd, **kwargs)
+
+
+def test_matrix_run(git_repo, tmpdir, monkeypatch, capsys):
+    daemon = BrokenImageDockerClient(exec_latency=0.01)
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    report_file = tmpdir.join('report.json')
+    args = cli.make_parser().parse_args(
+        ['--matrix', 'fedora29,broken', '--matrix', 'custom:latest',
+         '--matrix-parallel', '2', '--report', str(report_file), 'build'])
+
+    image_names = cli.matrix_images(ipaconfig, args)
+    assert image_names == [
+        'ipa-docker-test-runner:fedora29', 'broken', 'custom:latest']
+
+    exit_code = cli.run_matrix(ipaconfig, args, cli.build, image_names)
+    assert exit_code == 2
+
+    # every run builds in its own checkout of the snapshot
+    git_binds = {kwargs['binds'][-1].split(':')[0]
+                 for method, _args, kwargs in daemon.calls
+                 if method == 'create_host_config'}
+    assert len(git_binds) == 3
+    assert str(git_repo) not in git_binds
+
+    output = capsys.readouterr()[0]
+    assert "Results of 'build'" in output
+    assert 'FAILED (2)' in output
+
+    runs = json.loads(report_file.read())['runs']
+    assert [run['image'] for run in runs] == image_names
+    assert [run['exit_code'] for run in runs] == [0, 2, 0]
+
+    # the failed step is followed by the cleanup
+    failed_step = runs[1]['steps'][-2]
+    assert failed_step['name'] == 'lint'
+    assert not failed_step['success']
+
+
+def test_matrix_checkout_during_pull(git_repo, monkeypatch):
+    """
+    The snapshot is checked out while the image is pulled
+    """
+    import time
+
+    intervals = {}
+
+    class SlowPullDockerClient(fakes.FakeDockerClient):
+        def pull(self, repository, **kwargs):
+            started = time.time()
+            time.sleep(0.2)
+            result = super(SlowPullDockerClient, self).pull(
+                repository, **kwargs)
+            intervals['pull'] = (started, time.time())
+            return result
+
+    checkout = snapshot.SourceSnapshot.checkout
+
+    def slow_checkout(self, name):
+        started = time.time()
+        time.sleep(0.2)
+        path = checkout(self, name)
+        intervals['checkout'] = (started, time.time())
+        return path
+
+    daemon = SlowPullDockerClient()
+    monkeypatch.setattr(docker, 'Client', lambda **kwargs: daemon)
+    monkeypatch.setattr(snapshot.SourceSnapshot, 'checkout', slow_checkout)
+
+    ipaconfig = config.IPADockerConfig({'git_repo': str(git_repo)})
+    args = cli.make_parser().parse_args(
+        ['--matrix', 'custom:latest', 'build'])
+    assert cli.run_matrix(ipaconfig, args, cli.build, ['custom:latest']) == 0
+
+    pull_started, pull_finished = intervals['pull']
+    checkout_started, checkout_finished = intervals['checkout']
+    assert checkout_started < pull_finished
+    assert pull_started < checkout_finished
+
+    # the container is created from the checkout only
+    create_index = [method for method, _args, _kwargs in daemon.calls].index(
+        'create_container')
+    git_bind = daemon.calls[create_index - 1][2]['binds'][-1]
+    assert not git_bind.startswith(str(git_repo) + ':')